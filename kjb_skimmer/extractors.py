@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Ways of pulling the topics out of a letter page and the verses out of a
+topic page. Every backend returns the same results as the original
+BeautifulSoup code:
+
+	topics  (strong text, a href) of each p in the first table's cells
+	verses  the title of the first a in the first strong of each
+	        span[itemprop=hasPart]
+
+"stream" needs nothing but the standard library and never builds a tree;
+"lxml" and "selectolax" are used when they are installed.
+"""
+import argparse
+import os
+import time
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+	import lxml.html
+except ImportError:
+	lxml = None
+
+try:
+	from selectolax.parser import HTMLParser as SelectolaxParser
+except ImportError:
+	SelectolaxParser = None
+
+VERSEMARK = b'itemprop="hasPart"'
+
+
+def decode(text):
+	return text.decode("utf-8", "replace") if isinstance(text, bytes) else text
+
+
+# BeautifulSoup with html.parser: the original extraction.
+
+def bs4_topics(text):
+	doc = BeautifulSoup(text, "html.parser")
+	topics = []
+	for col in doc.table.find_all("td"):
+		for line in col.find_all("p"):
+			try:
+				topics.append((line.strong.text, line.a["href"]))
+			except AttributeError:
+				pass
+	return topics
+
+
+def bs4_verses(text):
+	versedoc = BeautifulSoup(text, "html.parser")
+	return [vrs_line.strong.a["title"]
+		for vrs_line in versedoc.find_all("span", attrs={"itemprop":"hasPart"})]
+
+
+# lxml: a C parser building a light tree.
+
+def _first(element, tag):
+	return next(element.iter(tag), None)
+
+
+def lxml_topics(text):
+	table = _first(lxml.html.fromstring(text), "table")
+	topics = []
+	for col in table.iter("td"):
+		for line in col.iter("p"):
+			strong, a = _first(line, "strong"), _first(line, "a")
+			if strong is not None and a is not None:
+				topics.append((strong.text_content(), a.get("href")))
+	return topics
+
+
+def lxml_verses(text):
+	verses = []
+	for span in lxml.html.fromstring(text).xpath('//span[@itemprop="hasPart"]'):
+		verses.append(_first(_first(span, "strong"), "a").get("title"))
+	return verses
+
+
+# selectolax: a C parser with CSS selectors.
+
+def selectolax_topics(text):
+	table = SelectolaxParser(decode(text)).css_first("table")
+	topics = []
+	for col in table.css("td"):
+		for line in col.css("p"):
+			strong, a = line.css_first("strong"), line.css_first("a")
+			if strong is not None and a is not None:
+				topics.append((strong.text(), a.attributes.get("href")))
+	return topics
+
+
+def selectolax_verses(text):
+	return [span.css_first("strong").css_first("a").attributes.get("title")
+		for span in SelectolaxParser(decode(text)).css('span[itemprop="hasPart"]')]
+
+
+# stream: html.parser events, keeping only the state the targets need.
+
+class TopicParser(HTMLParser):
+	"""Collects (strong text, a href) for each p in the first table's cells."""
+
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.topics = []
+		self.tables = 0      # open tables, while in the first one
+		self.table_done = False
+		self.cells = 0
+		self.line = None     # [strong text parts, strong open, href] of the open p
+
+	def handle_starttag(self, tag, attrs):
+		if tag == "table" and not self.table_done:
+			self.tables += 1
+		elif not self.tables:
+			return
+		elif tag == "td":
+			self.cells += 1
+		elif tag == "p" and self.cells:
+			self.end_line()
+			self.line = [None, False, None]
+		elif self.line is not None:
+			if tag == "strong" and self.line[0] is None:
+				self.line[0], self.line[1] = [], True
+			elif tag == "a" and self.line[2] is None:
+				self.line[2] = dict(attrs).get("href")
+
+	def handle_endtag(self, tag):
+		if not self.tables:
+			return
+		if tag == "strong" and self.line is not None:
+			self.line[1] = False
+		elif tag == "p":
+			self.end_line()
+		elif tag == "td":
+			self.end_line()
+			self.cells -= 1
+		elif tag == "table":
+			self.end_line()
+			self.tables -= 1
+			self.table_done = not self.tables
+
+	def handle_data(self, data):
+		if self.line is not None and self.line[1]:
+			self.line[0].append(data)
+
+	def end_line(self):
+		if self.line is not None:
+			if self.line[0] is not None and self.line[2] is not None:
+				self.topics.append(("".join(self.line[0]), self.line[2]))
+			self.line = None
+
+
+class VerseParser(HTMLParser):
+	"""Collects the title of the first a in the first strong of each
+	span[itemprop=hasPart]."""
+
+	def __init__(self):
+		super().__init__(convert_charrefs=True)
+		self.verses = []
+		self.spans = 0       # open spans, while in a hasPart span
+		self.strong = 0      # 1 in the span's first strong, 2 once it's closed
+
+	def handle_starttag(self, tag, attrs):
+		if tag == "span":
+			if self.spans:
+				self.spans += 1
+			elif ("itemprop", "hasPart") in attrs:
+				self.spans, self.strong = 1, 0
+		elif not self.spans:
+			return
+		elif tag == "strong" and not self.strong:
+			self.strong = 1
+		elif tag == "a" and self.strong == 1:
+			self.verses.append(dict(attrs).get("title"))
+			self.strong = 2
+
+	def handle_endtag(self, tag):
+		if tag == "span" and self.spans:
+			self.spans -= 1
+		elif tag == "strong" and self.strong == 1:
+			self.strong = 2
+
+
+def stream_topics(text):
+	parser = TopicParser()
+	parser.feed(decode(text))
+	parser.close()
+	return parser.topics
+
+
+def stream_verses(text):
+	# everything before the first verse is page furniture, so skip it
+	start = text.find(VERSEMARK if isinstance(text, bytes) else VERSEMARK.decode())
+	if start < 0:
+		return []
+	start = text.rfind(b"<" if isinstance(text, bytes) else "<", 0, start)
+	parser = VerseParser()
+	parser.feed(decode(text[start:]))
+	parser.close()
+	return parser.verses
+
+
+EXTRACTORS = {"bs4": (bs4_topics, bs4_verses), "stream": (stream_topics, stream_verses)}
+if lxml is not None:
+	EXTRACTORS["lxml"] = (lxml_topics, lxml_verses)
+if SelectolaxParser is not None:
+	EXTRACTORS["selectolax"] = (selectolax_topics, selectolax_verses)
+
+# The fastest backend available.
+DEFAULT = next(name for name in ("selectolax", "lxml", "stream") if name in EXTRACTORS)
+
+
+def extract_topics(text, backend=DEFAULT):
+	"""The (topic, href) pairs listed on a letter page."""
+	return EXTRACTORS[backend][0](text)
+
+
+def extract_verses(text, backend=DEFAULT):
+	"""The verse titles listed on a topic page."""
+	return EXTRACTORS[backend][1](text)
+
+
+def benchmark(pagedir, backends=None, repeat=3):
+	"""Time every backend over the saved pages in pagedir (ie. the skimmer's
+	response cache), checking they all agree with bs4.
+
+	:returns: {backend: pages per second}"""
+	pages = []
+	for name in sorted(os.listdir(pagedir)):
+		with open(os.path.join(pagedir, name), "rb") as f:
+			pages.append(f.read())
+	pages = [(page, VERSEMARK in page) for page in pages]
+	pages = [(page, verses) for page, verses in pages if verses or b"<table" in page]
+	if not pages:
+		raise ValueError("no letter or topic pages found in %s" % pagedir)
+
+	expected = [extract_verses(page, "bs4") if verses else extract_topics(page, "bs4")
+		for page, verses in pages]
+	rates = {}
+	for backend in backends or EXTRACTORS:
+		best = None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			results = [extract_verses(page, backend) if verses else extract_topics(page, backend)
+				for page, verses in pages]
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+		if results != expected:
+			mismatched = sum(1 for a, b in zip(results, expected) if a != b)
+			print(f"{backend}: {mismatched} of {len(pages)} pages differ from bs4")
+		rates[backend] = len(pages) / best
+		print(f"{backend:>10}: {rates[backend]:8.1f} pages/s ({best*1000/len(pages):.2f} ms/page)")
+	return rates
+
+
+if __name__ == "__main__":
+	p = argparse.ArgumentParser(
+		description="Compare the extraction backends on saved pages")
+	p.add_argument(
+		"pagedir", help="Directory of saved pages, ie. the skimmer's cache",
+	)
+	p.add_argument(
+		"--backend", "-b", help="Only time this backend (repeatable)",
+		action="append", choices=sorted(EXTRACTORS), default=None,
+	)
+	p.add_argument(
+		"--repeat", help="Runs per backend, the best is reported",
+		type=int, default=3,
+	)
+	args = p.parse_args()
+	benchmark(args.pagedir, args.backend, args.repeat)
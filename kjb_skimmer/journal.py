@@ -0,0 +1,114 @@
+"""The skimmer's results as they come in: a JSONL file with one record per
+topic, either {"topic": ..., "verses": [...]} or {"topic": ..., "error": ...}
+for a topic that couldn't be fetched.
+
+Records are appended and flushed as topics complete, so the file can be read
+with read_journal() while a crawl is still writing it, and it is what a
+crawl resumes from. compact() turns it into the sorted, deduplicated json
+the skimmer has always written.
+"""
+import json
+import os
+import time
+
+# Seconds between fsyncs of the journal.
+FSYNC_INTERVAL = 5
+
+
+def read_journal(path, offsets=False):
+	"""A generator of the complete records in a journal, oldest first. A torn
+	last line, from a crash or a writer that hasn't finished it, is skipped.
+
+	:param offsets: Also yield where each record starts, as (offset, record)."""
+	offset = 0
+	with open(path, "rb") as f:
+		for line in f:
+			start, offset = offset, offset + len(line)
+			if not line.endswith(b"\n"):
+				return
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			yield (start, record) if offsets else record
+
+
+class Journal(object):
+	"""Appends topic records to a journal, fsyncing every FSYNC_INTERVAL
+	seconds and on close."""
+
+	def __init__(self, path, fsync_interval=FSYNC_INTERVAL):
+		self.path = path
+		self.fsync_interval = fsync_interval
+		self.done = set()
+		if os.path.exists(path):
+			end = 0
+			with open(path, "rb+") as f:
+				for line in f:
+					if not line.endswith(b"\n"):
+						break
+					end += len(line)
+					try:
+						record = json.loads(line)
+					except ValueError:
+						continue
+					if "verses" in record:
+						self.done.add(record["topic"])
+				# drop a torn last record so the next one starts on its own line
+				f.truncate(end)
+		self.f = open(path, "a", encoding="utf-8")
+		self.synced = time.monotonic()
+
+	def append(self, topic, verses=None, error=None):
+		record = {"topic": topic, "verses": verses} if error is None else {"topic": topic, "error": str(error)}
+		self.f.write(json.dumps(record) + "\n")
+		self.f.flush()
+		if verses is not None:
+			self.done.add(topic)
+		if time.monotonic() - self.synced > self.fsync_interval:
+			self.sync()
+
+	def sync(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.synced = time.monotonic()
+
+	def close(self):
+		if not self.f.closed:
+			self.sync()
+			self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def compact(path, output):
+	"""Write the journal at path to output as one json object of topic to
+	verses, sorted by topic, with each topic's latest successful record (or
+	an empty list if it only ever failed). Only record offsets are held in
+	memory, so large journals compact in flat memory.
+
+	:returns: The number of topics written."""
+	latest = {}
+	for offset, record in read_journal(path, offsets=True):
+		if "verses" in record or record["topic"] not in latest:
+			latest[record["topic"]] = offset if "verses" in record else None
+
+	tmp = output + ".tmp"
+	with open(path, "rb") as journal, open(tmp, "w") as f:
+		# the same text as json.dumps(items, indent=2, sort_keys=True)
+		f.write("{" if latest else "{}")
+		for i, topic in enumerate(sorted(latest)):
+			verses = []
+			if latest[topic] is not None:
+				journal.seek(latest[topic])
+				verses = json.loads(journal.readline())["verses"]
+			f.write(",\n  " if i else "\n  ")
+			f.write(json.dumps(topic) + ": " + json.dumps(verses, indent=2).replace("\n", "\n  "))
+		if latest:
+			f.write("\n}")
+	os.replace(tmp, output)
+	return len(latest)
@@ -1,63 +1,232 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import hashlib
+import http.client
+import os
+import random
 import string
-from time import sleep
-from bs4 import BeautifulSoup
-import urllib.request
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+from extractors import DEFAULT, EXTRACTORS, extract_topics, extract_verses
+from journal import Journal, compact
 
 SITE = "https://www.kingjamesbibleonline.org/{path}"
 VERSEPATH = "Bible-Verses-{a}"
 USER_AGENT = "Mozilla/5.0 (Windows; U; Windows NT 5.1; en-US; rv:1.9.0.7) Gecko/2009021910 Firefox/3.0.7"
 HEADERS = {"User-Agent": USER_AGENT}
+OUTPUT = "kjb_skimmer_output.txt"
+CACHEDIR = ".kjb_skimmer_cache"
+WORKERS = 8
+# Processes parsing topic pages; 0 parses them in the main process.
+PARSERS = os.cpu_count() or 1
+RETRIES = 4
+TIMEOUT = 30
+
+# Responses worth retrying: rate limiting and server errors.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+	"""A page could not be fetched."""
+
+
+class TokenBucket(object):
+	"""Allows rate acquisitions per second across every thread, with bursts of
+	up to capacity. A capacity of 1 spaces requests 1/rate seconds apart, as
+	sleeping 1/rate before each request did when they were made one by one."""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = float(rate)
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				delay = (1 - self.tokens) / self.rate
+			time.sleep(delay)
+
+
+class Fetcher(object):
+	"""Fetches pages of a site from a pool of threads, each keeping its own
+	connection alive. Requests are rate limited by a TokenBucket, retried with
+	exponential backoff, and cached on disk so a re-run only asks the site for
+	pages it hasn't got yet."""
+
+	def __init__(self, site=SITE, rps=3, cachedir=CACHEDIR, retries=RETRIES, timeout=TIMEOUT):
+		self.site = site
+		self.bucket = TokenBucket(rps)
+		self.cachedir = cachedir
+		self.retries = retries
+		self.timeout = timeout
+		self.local = threading.local()
+		if cachedir:
+			os.makedirs(cachedir, exist_ok=True)
+
+	def cache_path(self, url):
+		return os.path.join(self.cachedir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+	def get(self, path):
+		"""The body of the page at path on the site."""
+		url = self.site.format(path=path)
+		if self.cachedir:
+			try:
+				with open(self.cache_path(url), "rb") as f:
+					return f.read()
+			except FileNotFoundError:
+				pass
 
-def scrape(requests_per_second:int):
+		for attempt in range(self.retries + 1):
+			self.bucket.acquire()
+			try:
+				status, retry_after, body = self.request(url)
+			except (OSError, http.client.HTTPException) as err:
+				self.close()
+				status, retry_after, body = None, None, err
+			if status == 200:
+				break
+			if status is not None and status not in RETRY_STATUS:
+				raise FetchError("{} returned {}".format(url, status))
+			if attempt == self.retries:
+				raise FetchError("{} failed after {} attempts: {}".format(
+					url, attempt + 1, status or body))
+			time.sleep(retry_after or (2 ** attempt) * (0.5 + random.random()))
+
+		if self.cachedir:
+			path = self.cache_path(url)
+			with open(path + ".tmp", "wb") as f:
+				f.write(body)
+			os.replace(path + ".tmp", path)
+		return body
+
+	def request(self, url):
+		"""(status, retry after seconds, body) of a GET on this thread's
+		connection to the url's host."""
+		parts = urlsplit(url)
+		key = (parts.scheme, parts.netloc)
+		connection = getattr(self.local, "connection", None)
+		if connection is None or self.local.key != key:
+			self.close()
+			if parts.scheme == "https":
+				connection = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+			else:
+				connection = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+			self.local.connection, self.local.key = connection, key
+
+		target = parts.path or "/"
+		if parts.query:
+			target += "?" + parts.query
+		connection.request("GET", target, headers=HEADERS)
+		response = connection.getresponse()
+		body = response.read()
+		if response.will_close:
+			self.close()
+		retry_after = response.getheader("Retry-After")
+		return response.status, float(retry_after) if retry_after and retry_after.isdigit() else None, body
+
+	def close(self):
+		connection = getattr(self.local, "connection", None)
+		if connection is not None:
+			connection.close()
+			self.local.connection = None
+
+
+def journal_path(output):
+	"""The JSONL journal an output is compacted from."""
+	return os.path.splitext(output)[0] + ".jsonl"
+
+
+def scrape(requests_per_second:int, workers=WORKERS, site=SITE, cachedir=CACHEDIR,
+		output=OUTPUT, retries=RETRIES, backend=DEFAULT, parsers=PARSERS, fresh=False):
 	"""Scrapes the King James Bible Online website keyword-verse pairs and saves
 	to file.
-	
-	:param requests_per_second: The requests per second limit."""
-	items = {}
-
-	# Scrape topics by letter
-	verselist_paths = []
-	for letter in string.ascii_uppercase:
-		print(f"Scraping letter: {letter}")
-		sleep(1.0/float(requests_per_second))
-
-		url = SITE.format(path=VERSEPATH.format(a=letter))
-		text = urllib.request.urlopen(
-			urllib.request.Request(url, None, HEADERS)
-		).read()
-		doc = BeautifulSoup(text, "html.parser")
-		
-		for col in doc.table.find_all("td"):
-			for line in col.find_all("p"):
+
+	Each topic is appended to a JSONL journal next to the output as soon as
+	it is scraped, so memory stays flat and the journal can be read while the
+	crawl runs. A run carries on from the topics already in the journal, then
+	compacts it into the output. A letter or topic page that can't be fetched
+	is reported and skipped, and the next run retries it.
+
+	:param requests_per_second: The requests per second limit, shared by all
+		workers.
+	:param workers: How many requests may be in flight at once.
+	:param cachedir: Where responses are cached, or None not to cache.
+	:param backend: The extractors backend that parses pages.
+	:param parsers: How many processes parse topic pages, off the fetch
+		threads.
+	:param fresh: Start a new journal rather than carrying on from one."""
+	fetcher = Fetcher(site, requests_per_second, cachedir, retries)
+	path = journal_path(output)
+	if fresh and os.path.exists(path):
+		os.remove(path)
+	journal = Journal(path)
+	if journal.done:
+		print(f"Resuming with {len(journal.done)} topics from {path}")
+
+	parse_pool = ProcessPoolExecutor(parsers) if parsers else None
+	failed = 0
+	failed_letters = []
+	try:
+		with ThreadPoolExecutor(workers) as pool:
+			# Scrape topics by letter
+			def letter_topics(letter):
+				print(f"Scraping letter: {letter}")
 				try:
-					verselist_paths.append((line.strong.text, line.a["href"]))
-				except AttributeError:
-					pass
-	
-	# Scrape topics
-	for p in verselist_paths:
-		print("Scraping tag:", p[0])
-		sleep(1.0/float(requests_per_second))
-		items[p[0]] = []
-
-		url = SITE.format(path=p[1][3:])
-		try:
-			text = urllib.request.urlopen(
-				urllib.request.Request(url, None, HEADERS)
-			).read()
-		except:
-			continue
-		versedoc = BeautifulSoup(text, "html.parser")
-		for vrs_line in versedoc.find_all("span", attrs={"itemprop":"hasPart"}):
-			items[p[0]].append(vrs_line.strong.a["title"])
+					return extract_topics(fetcher.get(VERSEPATH.format(a=letter)), backend)
+				except FetchError as err:
+					print(f"Skipped letter: {letter}: {err}")
+					failed_letters.append(letter)
+					return []
+			verselist_paths = [p for topics in pool.map(letter_topics, string.ascii_uppercase)
+				for p in topics]
+
+			# Scrape topics: fetched by the threads, then parsed by the processes
+			def topic_page(p):
+				print("Scraping tag:", p[0])
+				return fetcher.get(p[1][3:])
+			pending = {pool.submit(topic_page, p): (p[0], False)
+				for p in dict(verselist_paths).items() if p[0] not in journal.done}
+			while pending:
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					topic, parsed = pending.pop(future)
+					if parsed:
+						journal.append(topic, future.result())
+						continue
+					try:
+						page = future.result()
+					except FetchError as err:
+						print(f"Skipped tag: {topic}: {err}")
+						journal.append(topic, error=err)
+						failed += 1
+						continue
+					if parse_pool is None:
+						journal.append(topic, extract_verses(page, backend))
+					else:
+						pending[parse_pool.submit(extract_verses, page, backend)] = (topic, True)
+	finally:
+		journal.close()
+		if parse_pool is not None:
+			parse_pool.shutdown()
 
+	if failed_letters:
+		print(f"Letters {', '.join(sorted(failed_letters))} failed, run again to retry them")
+	if failed:
+		print(f"{failed} topics failed, run again to retry them")
 	# Save to file
-	with open("kjb_skimmer_output.txt", "w") as f:
-		f.write(json.dumps(items, indent=2, sort_keys=True))
+	compact(path, output)
 
 
 if __name__ == "__main__":
@@ -69,11 +238,60 @@ if __name__ == "__main__":
 		type=int,
 		default=rps,
 	)
+	p.add_argument(
+		"--workers", "-w", help="How many requests may be in flight at once",
+		type=int,
+		default=WORKERS,
+	)
+	p.add_argument(
+		"--site", help="The site to scrape, with a {path} placeholder, ie. a "
+			"local stub server",
+		default=SITE,
+	)
+	p.add_argument(
+		"--cache-dir", help="Where to cache responses",
+		default=CACHEDIR,
+	)
+	p.add_argument(
+		"--no-cache", help="Don't read or write the response cache",
+		action="store_true",
+	)
+	p.add_argument(
+		"--output", "-o", help="Where to write the keyword-verse pairs",
+		default=OUTPUT,
+	)
+	p.add_argument(
+		"--parser", help="How to extract links and verses from pages",
+		choices=sorted(EXTRACTORS),
+		default=DEFAULT,
+	)
+	p.add_argument(
+		"--parsers", help="Processes parsing topic pages (0 parses in the "
+			"main process)",
+		type=int,
+		default=PARSERS,
+	)
+	p.add_argument(
+		"--fresh", help="Start a new journal instead of resuming the last one",
+		action="store_true",
+	)
+	p.add_argument(
+		"--compact", help="Only compact the journal into the output, ie. to "
+			"snapshot a crawl that is still running",
+		action="store_true",
+	)
+	p.add_argument(
+		"--retries", help="How many times to retry a failed request",
+		type=int,
+		default=RETRIES,
+	)
 	args = p.parse_args()
 	if args.rps:
 		rps = args.rps
-	
-	scrape(rps)
-
-
 
+	if args.compact:
+		print("Compacted {} topics into {}".format(
+			compact(journal_path(args.output), args.output), args.output))
+	else:
+		scrape(rps, args.workers, args.site, None if args.no_cache else args.cache_dir,
+			args.output, args.retries, args.parser, args.parsers, args.fresh)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Build translations' PDFs on a farm of workers through a redis stream.
+
+The coordinator puts a render job for every group of books of every
+translation on the pdfbuild:jobs stream, largest first, with the books'
+verse rows in the job, so a worker needs nothing but this code and the
+redis server. Workers on any number of nodes render each job with
+render_part(), store the fragment in redis for PART_TTL seconds and announce
+it on the build's results stream. The coordinator follows that stream for
+progress and merges a translation with merge_parts() as soon as its last
+fragment is in, while the workers carry on with the next one.
+
+	python pdf_builder/build_farm.py worker --processes 8
+	python pdf_builder/build_farm.py build --batch txt --output-dir out
+
+"build --local-workers 4" runs its own worker processes, to try the farm on
+one machine with a local redis.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+from pdf_builder import (OUTPUT, OUTPUTDIR, SOURCE, part_jobs, render_index_part,
+	render_part, verse_gen)
+from pdf_merge import merge_parts
+from verse_source import translation_sources, verse_source
+
+# the job queue and redis client are shared with redis_json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "redis_json"))
+from redis_client import get_redis_connection
+from stream_queue import ConsumerPool, QueueFull, StreamQueue
+
+JOBS = "pdfbuild:jobs"
+GROUP = "pdfbuild:renderers"
+RESULTS = "pdfbuild:{build}:results"
+PARTKEY = "pdfbuild:{build}:{translation}:{part:03d}"
+# Seconds a rendered fragment is kept for the coordinator to collect.
+PART_TTL = 6 * 3600
+# Jobs the stream may hold. Each carries its books' verses, so this bounds
+# the memory the queue takes in redis.
+MAX_BACKLOG = 256
+# Milliseconds the coordinator waits on the results stream at a time.
+RESULTS_BLOCK_MS = 1000
+# Seconds without a fragment coming in before the coordinator gives up, ie.
+# when no workers are running.
+STALL_TIMEOUT = 600
+
+
+class FarmError(Exception):
+	"""A distributed build could not be finished."""
+
+
+def farm_queue(rc=None):
+	"""The StreamQueue of render jobs."""
+	return StreamQueue(JOBS, GROUP, rc, max_backlog=MAX_BACKLOG)
+
+
+def render_job(id, job):
+	"""Render a job's books and hand the fragment back to its coordinator.
+
+	The ConsumerPool handler of the workers."""
+	start = time.time()
+	fd, path = tempfile.mkstemp(prefix="pdf_farm", suffix=".pdf")
+	os.close(fd)
+	try:
+		path, anchors = render_part((path, json.loads(job["books"])))
+		with open(path, "rb") as f:
+			data = f.read()
+	finally:
+		for leftover in (path, path + ".json", path + ".tmp"):
+			if os.path.exists(leftover):
+				os.remove(leftover)
+
+	rc = get_redis_connection()
+	key = PARTKEY.format(build=job["build"], translation=job["translation"], part=int(job["part"]))
+	pipeline = rc.raw_main.pipeline(transaction=False)
+	pipeline.set(key, data, ex=PART_TTL)
+	pipeline.xadd(RESULTS.format(build=job["build"]), {
+		"translation": job["translation"],
+		"part": job["part"],
+		"key": key,
+		"anchors": json.dumps(anchors),
+		"worker": "{}-{}".format(socket.gethostname(), os.getpid()),
+		"seconds": "{:.2f}".format(time.time() - start),
+		})
+	pipeline.execute()
+
+
+def farm_jobs(build, builds, partdir, translations, bookspergroup=1):
+	"""A generator of the render jobs of each translation in turn, rendering
+	its index page locally and filling in translations as it goes."""
+	for source, output in builds:
+		name = source.name
+		groups = [group for _, group in part_jobs(verse_gen(source), partdir, bookspergroup)]
+		index = render_index_part(os.path.join(partdir, name + "-000.pdf"))
+		translations[name] = {"output": output, "index": index, "total": len(groups),
+			"keys": {}, "anchors": {}, "started": time.time()}
+		print("Queueing {} parts of {}".format(len(groups), name))
+
+		# the biggest books first, so none is left rendering alone at the end
+		jobs = [(sum(len(row[3]) for _, rows in group for row in rows), part, group)
+			for part, group in enumerate(groups, 1)]
+		for _, part, group in sorted(jobs, key=lambda job: -job[0]):
+			yield {"build": build, "translation": name, "part": str(part),
+				"books": json.dumps(group)}
+
+
+def assemble(rc, name, translation, partdir):
+	"""Merge a translation's fragments into its PDF. The fragments are fetched
+	one at a time rather than in one reply of the whole translation."""
+	keys = [translation["keys"][part] for part in range(1, translation["total"] + 1)]
+	parts = [translation["index"]]
+	for part, key in enumerate(keys, 1):
+		data = rc.raw_main.get(key)
+		if data is None:
+			raise FarmError("fragment {} of {} expired before it was merged".format(part, name))
+		path = os.path.join(partdir, "{}-{:03d}.pdf".format(name, part))
+		with open(path, "wb") as f:
+			f.write(data)
+		parts.append((path, translation["anchors"][part]))
+	merge_parts(parts, translation["output"])
+	if keys:
+		rc.raw_main.delete(*keys)
+	print("Wrote {} in {:.1f}s".format(translation["output"], time.time() - translation["started"]))
+
+
+def build_on_farm(builds, bookspergroup=1, stall_timeout=STALL_TIMEOUT):
+	"""Build (source, output) translations on the farm: queue their render
+	jobs, follow the workers' progress and merge each PDF when it is done.
+
+	:raises FarmError: If a job failed on every attempt or no fragment came in
+		for stall_timeout seconds."""
+	rc = get_redis_connection()
+	queue = farm_queue(rc)
+	queue.create()
+	build = uuid.uuid4().hex[:12]
+	results = RESULTS.format(build=build)
+	dead = rc.x_rev_range(queue.dead)
+	last = {results: "0-0", queue.dead: dead[0][0] if dead else "0-0"}
+	partdir = tempfile.mkdtemp(prefix="pdf_farm")
+	translations = {}
+	done = set()
+	jobs = farm_jobs(build, builds, partdir, translations, bookspergroup)
+	job = next(jobs, None)
+	progress = time.time()
+	print("Build {} on {}".format(build, JOBS))
+	try:
+		while job is not None or len(done) < len(translations):
+			if job is not None:
+				try:
+					queue.put(job, block=False)
+					job = next(jobs, None)
+					progress = time.time()
+					continue
+				except QueueFull:
+					pass
+
+			for stream, entries in rc.main.xread(last, 100, RESULTS_BLOCK_MS) or []:
+				for id, fields in entries:
+					last[stream] = id
+					if stream == queue.dead:
+						if fields.get("build") == build:
+							raise FarmError("part {} of {} failed on every attempt".format(
+								fields["part"], fields["translation"]))
+						continue
+					progress = time.time()
+					name, part = fields["translation"], int(fields["part"])
+					translation = translations[name]
+					translation["keys"][part] = fields["key"]
+					translation["anchors"][part] = json.loads(fields["anchors"])
+					print("[{}] part {} by {} in {}s ({}/{})".format(name, part, fields["worker"],
+						fields["seconds"], len(translation["keys"]), translation["total"]))
+
+			for name, translation in translations.items():
+				if name not in done and len(translation["keys"]) == translation["total"]:
+					assemble(rc, name, translation, partdir)
+					done.add(name)
+
+			if time.time() - progress > stall_timeout:
+				raise FarmError("no fragment came in for {}s, are any workers running?".format(
+					stall_timeout))
+	finally:
+		rc.main.delete(results)
+		shutil.rmtree(partdir)
+
+
+def run_workers(processes=None, consumers=1):
+	"""Render jobs until SIGINT or SIGTERM. Rendering holds the GIL, so a
+	worker node wants a process per core more than threads."""
+	queue = farm_queue()
+	queue.create()
+	processes = processes or os.cpu_count() or 1
+	print("Rendering {} with {} processes".format(JOBS, processes))
+	print(ConsumerPool(queue, render_job, consumers, processes).run())
+
+
+def main():
+	p = argparse.ArgumentParser(
+		description="Build PDFs on a farm of workers through redis")
+	commands = p.add_subparsers(dest="command")
+	commands.required = True
+
+	worker = commands.add_parser("worker", help="Render jobs from the farm")
+	worker.add_argument(
+		"--processes", "-j", help="Worker processes (default: all cores)",
+		type=int, default=None,
+	)
+	worker.add_argument(
+		"--consumers", help="Consumer threads in each process",
+		type=int, default=1,
+	)
+
+	build = commands.add_parser("build", help="Queue a build and merge its PDFs")
+	build.add_argument(
+		"--source", "-s", help="The verse csv, txt/ or md/ translation "
+			"directory, or compiled verse store to build from",
+		default=SOURCE,
+	)
+	build.add_argument(
+		"--output", "-o", help="Where to write the PDF",
+		default=OUTPUT,
+	)
+	build.add_argument(
+		"--batch", "-b", help="Build every translation in this corpus "
+			"directory (ie. txt or md) into --output-dir instead",
+		default=None,
+	)
+	build.add_argument(
+		"--output-dir", help="Where --batch writes its PDFs",
+		default=OUTPUTDIR,
+	)
+	build.add_argument(
+		"--books-per-part", help="How many books each job renders",
+		type=int, default=1,
+	)
+	build.add_argument(
+		"--local-workers", help="Also run this many worker processes here",
+		type=int, default=0,
+	)
+	build.add_argument(
+		"--stall-timeout", help="Give up after this many seconds without progress",
+		type=int, default=STALL_TIMEOUT,
+	)
+	args = p.parse_args()
+
+	if args.command == "worker":
+		run_workers(args.processes, args.consumers)
+		return
+
+	if args.batch:
+		builds = [(source, os.path.join(args.output_dir, source.name + ".pdf"))
+			for source in translation_sources(args.batch)]
+	else:
+		builds = [(verse_source(args.source), args.output)]
+	pool = None
+	if args.local_workers:
+		pool = ConsumerPool(farm_queue(), render_job, 1, args.local_workers).start()
+	try:
+		build_on_farm(builds, args.books_per_part, args.stall_timeout)
+	finally:
+		if pool is not None:
+			pool.stop()
+			pool.join()
+
+
+if __name__ == "__main__":
+	main()
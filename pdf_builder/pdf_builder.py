@@ -1,6 +1,13 @@
 
+import argparse
 import copy
-import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
 from ctypes import alignment
 
 from reportlab.pdfgen.canvas import Canvas
@@ -9,6 +16,10 @@ from reportlab.lib.enums import TA_CENTER
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import Paragraph, SimpleDocTemplate, PageBreak, Spacer
 from reportlab.rl_config import canvas_basefontname as _baseFontName
+from reportlab.rl_config import defaultPageSize
+
+from pdf_merge import XREF, merge_parts
+from verse_source import translation_sources, verse_source
 
 # The books of the bible
 BOOKS = [
@@ -36,7 +47,7 @@ BOOKS = [
 	"Proverbs",
 	"Ecclesiastes",
 	"Song of Solomon",
-	"I saiah",
+	"Isaiah",
 	"Jeremiah",
 	"Lamentations",
 	"Ezekiel",
@@ -120,23 +131,82 @@ STYLEHEAD2CENTER = ParagraphStyle(
 )
 STYLEHEAD3 = STYLES['Heading3']
 
+SOURCE = "./csv/AMP_fixed.csv"
+OUTPUT = "pdf_builder/hello.pdf"
+OUTPUTDIR = "pdf_builder"
+CACHEDIR = "pdf_builder/.cache"
+
+# Bump whenever the layout code changes so cached parts are rendered again.
+CACHEVERSION = 1
+
+# How many flowables to keep queued ahead of the layout engine before the next
+# book is pulled from the source while streaming.
+STREAMLOWWATER = 64
+
 bookcurr = -1
 chaptercurr = -1
 chaptersbookmarked = []
 chapterindexes = []
-chaptercounts = [] # An array containing how many chapters are in each book
+chaptercounts = {} # How many chapters are in each book, filled in as books are read
+
+
+class FlowableStream(list):
+	"""A flowable list that refills itself one book at a time.
+
+	SimpleDocTemplate.build() takes flowables off the front of its list and
+	checks len() before every step, so topping the list up there keeps about
+	one book of Paragraphs alive instead of the whole bible."""
+
+	def __init__(self, chunks):
+		super().__init__()
+		self.chunks = iter(chunks)
+
+	def __len__(self):
+		while self.chunks is not None and list.__len__(self) < STREAMLOWWATER:
+			try:
+				self.extend(next(self.chunks))
+			except StopIteration:
+				self.chunks = None
+		return list.__len__(self)
+
+
+class PartDocTemplate(SimpleDocTemplate):
+	"""A doc template for one part of a parallel build.
+
+	Links to anchors that may live in another part are written as XREF links,
+	and the page and position of every anchor laid out is recorded so the
+	merge can point those links back here."""
+	xref = True
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.anchors = {}
+
+	def afterFlowable(self, flowable):
+		name = getattr(flowable, "anchor", None)
+		if name:
+			self.anchors[name] = (self.page-1, self.frame._y+flowable.height)
+
+
+def anchor_href(name, doc):
+	"""The link target for an anchor that may be in another part of the
+	document."""
+	if getattr(doc, "xref", False):
+		return XREF + name
+	return "#" + name
 
 
 def draw_chapter_index_page(book:int):
 	parts = []
 	parts.append(PageBreak())
-	parts.append(
-			Paragraph(
-				"{book}<a name='ChapterIndex{bookid}'/>".format(
-					book=BOOKS[book],
-					bookid=BOOKS[book].replace(" ", ""),
-					),
-				STYLETITLECENTER))
+	title = Paragraph(
+			"{book}<a name='ChapterIndex{bookid}'/>".format(
+				book=BOOKS[book],
+				bookid=BOOKS[book].replace(" ", ""),
+				),
+			STYLETITLECENTER)
+	title.anchor = "ChapterIndex" + BOOKS[book].replace(" ", "")
+	parts.append(title)
 	parts.append(Spacer(0,20))
 
 	text = ""
@@ -173,93 +243,235 @@ def draw_chapter_index_page(book:int):
 	return parts
 
 
-def chapter_counts(csvtext):
-	countslist = []
-	bookcurr = -1
+def count_chapters(rows):
+	"""Count the chapters in the rows of a single book."""
 	chaptercurr = -1
 	chaptercount = 0
-	spamreader = csv.reader(csvtext, delimiter=",", quotechar='"')
-	for row in spamreader:
-		book, chapter, verse, text = row
-		book = int(book)-1
-		chapter = int(chapter)
-
-		if bookcurr != book:
-			chaptercount = 0
-			bookcurr = book
-			countslist.append(0)
-
+	for book, chapter, verse, text in rows:
 		if chaptercurr != chapter:
 			chaptercurr = chapter
 			chaptercount += 1
+	return chaptercount
 
-		countslist[bookcurr] = chaptercount
-
-	return countslist
 
+def book_gen(rows):
+	"""A generator grouping verse rows into (bookindex, rows), one book at a
+	time."""
+	for book, bookrows in itertools.groupby(rows, key=lambda row: int(row[0])-1):
+		yield book, list(bookrows)
 
-def draw_book(csvtext):
-	generator = verse_gen(csvtext)
 
-	i = 0
-	bookcurr = -1
+def book_parts(book:int, rows):
+	"""The flowables for a book's chapter index page and all of its verses."""
 	chaptercurr = -1
 	parts = []
-	while True:
-		try:
-			book, chapter, verse, text = next(generator)
-			bookindex = int(book)-1
+	for i, (_, chapter, verse, text) in enumerate(rows):
+		parts.append(Paragraph("", STYLEHEAD1))
 
+		# Book
+		if i == 0:
+			parts += draw_chapter_index_page(book)
 			parts.append(Paragraph("", STYLEHEAD1))
 
-			# Book
-			if bookcurr != bookindex:
-				bookcurr = bookindex
-				chaptercurr = -1
-				print( BOOKS[bookcurr] )
-				parts += draw_chapter_index_page(bookcurr)
-				parts.append(Paragraph("", STYLEHEAD1))
-				
-			# Chapter
-			if chaptercurr != chapter:
-				chaptercurr = chapter
-				parts.append(
-					Paragraph(
-						"{book} {chapter}<a name='{bookid}{chapter}'/>".format(
-								chapter=chaptercurr, book=BOOKS[bookcurr],
-								bookid=BOOKS[bookcurr].replace(" ", ""),
-								),
-						STYLEHEAD3
-					)
+		# Chapter
+		if chaptercurr != chapter:
+			chaptercurr = chapter
+			heading = Paragraph(
+					"{book} {chapter}<a name='{bookid}{chapter}'/>".format(
+							chapter=chaptercurr, book=BOOKS[book],
+							bookid=BOOKS[book].replace(" ", ""),
+							),
+					STYLEHEAD3
 				)
-				parts.append(Paragraph("", STYLEHEAD1))
-
-			# Verse
-			parts.append(
-				Paragraph(
-					"{verse} {text}".format(verse=verse, text=text),
-					STYLENORM
-				) 
-			)
+			heading.anchor = "{}{}".format(BOOKS[book].replace(" ", ""), chaptercurr)
+			parts.append(heading)
 			parts.append(Paragraph("", STYLEHEAD1))
 
-		except StopIteration:
-			generator.close()
-			break
+		# Verse
+		parts.append(
+			Paragraph(
+				"{verse} {text}".format(verse=verse, text=text),
+				STYLENORM
+			) 
+		)
+		parts.append(Paragraph("", STYLEHEAD1))
 
-		i += 1
-	
+	return parts
+
+
+def book_flowables(rows):
+	"""A generator yielding the flowables of each book in turn, counting the
+	chapters of every book as it is read."""
+	for book, bookrows in book_gen(rows):
+		chaptercounts[book] = count_chapters(bookrows)
+		print( BOOKS[book] )
+		yield book_parts(book, bookrows)
+
+
+def draw_book(source, output=OUTPUT):
+	"""Lay out the bible in a single pass over the source, handing flowables
+	to the doc template a book at a time."""
 	print("Building ...")
-	summaryName = SimpleDocTemplate("pdf_builder/hello.pdf")
+	summaryName = SimpleDocTemplate(output)
 	summaryName._doSave = False
 	summaryName.build(
-			parts, onFirstPage=myOnFirstPage, 
+			FlowableStream(book_flowables(verse_gen(source))),
+			onFirstPage=myOnFirstPage, 
 			onLaterPages=myOnLaterPages)
 	summaryName.canv.save()
 
 	print("Done!")
 
 
+def save_part(doc, path):
+	"""Move a built part into place and write its anchors beside it.
+
+	The anchors are written last, so a part only counts as cached once it has
+	been completely written."""
+	os.replace(doc.filename, path)
+	with open(path + ".json.tmp", "w") as f:
+		json.dump(doc.anchors, f)
+	os.replace(path + ".json.tmp", path + ".json")
+	return path, doc.anchors
+
+
+def render_index_part(path):
+	"""Render the bible index page to a PDF of its own."""
+	doc = PartDocTemplate(path + ".tmp")
+	doc.build([Paragraph("", STYLEHEAD1)], onFirstPage=myOnFirstPage)
+	doc.anchors["BookIndex"] = (0, doc.pagesize[1])
+	return save_part(doc, path)
+
+
+def render_part(job):
+	"""Render a group of consecutive books to a PDF of their own.
+
+	:param job: The path to write and a list of (bookindex, rows) pairs."""
+	path, books = job
+	parts = []
+	for book, rows in books:
+		chaptercounts[book] = count_chapters(rows)
+		print( BOOKS[book] )
+		parts += book_parts(book, rows)
+
+	# A part starts on a fresh page, so drop the spacing and page break that
+	# separate a book from whatever came before it.
+	while not isinstance(parts.pop(0), PageBreak):
+		pass
+
+	doc = PartDocTemplate(path + ".tmp")
+	doc.build(parts, onFirstPage=myOnLaterPages, onLaterPages=myOnLaterPages)
+	return save_part(doc, path)
+
+
+class CachedPart(object):
+	"""A part found in the build cache, answering get() like the AsyncResult
+	of a part being rendered."""
+
+	def __init__(self, path):
+		self.path = path
+
+	def get(self):
+		with open(self.path + ".json") as f:
+			return self.path, json.load(f)
+
+
+def part_key(books=None):
+	"""A hash of everything that goes into laying out a part: the rows of its
+	books (or the book list, for the index page), the page size and styles.
+	"""
+	key = hashlib.sha256()
+	key.update(repr((CACHEVERSION, defaultPageSize, PAGEWIDTH, PAGEHEIGHT)).encode())
+	for style in (STYLENORM, STYLENORMCENTER, STYLETITLECENTER, STYLEHEAD1,
+			STYLEHEAD1CENTER, STYLEHEAD3):
+		key.update(repr(sorted(vars(style).items())).encode())
+	if books is None:
+		key.update(repr(BOOKS).encode())
+	else:
+		for book, rows in books:
+			key.update(repr((book, rows)).encode())
+	return key.hexdigest()
+
+
+def part_jobs(rows, partdir, bookspergroup=1, cached=False):
+	"""A generator of render_part() jobs, bookspergroup books at a time.
+
+	Cached parts are named after their part_key() so unchanged books are found
+	again on the next build."""
+	books = book_gen(rows)
+	i = 0
+	while True:
+		group = list(itertools.islice(books, bookspergroup))
+		if not group:
+			return
+		i += 1
+		name = part_key(group) if cached else "part{:03d}".format(i)
+		yield os.path.join(partdir, name + ".pdf"), group
+
+
+def submit_part(pool, func, job, path):
+	"""Start rendering a part unless an identical one is already cached."""
+	if os.path.exists(path + ".json"):
+		return CachedPart(path)
+	return pool.apply_async(func, (job,))
+
+
+def prune_cache(cachedir, keep):
+	"""Delete the parts in a cache directory that aren't in keep, ie. those
+	left behind by books, styles or page sizes that have since changed.
+
+	Only files named after a part_key() are touched.
+
+	:param keep: The paths of the parts to keep.
+	:returns: How many parts were deleted."""
+	keep = {os.path.basename(path).partition(".")[0] for path in keep}
+	pruned = set()
+	for name in os.listdir(cachedir):
+		key = name.partition(".")[0]
+		if len(key) == 64 and all(c in "0123456789abcdef" for c in key) and key not in keep:
+			os.remove(os.path.join(cachedir, name))
+			pruned.add(key)
+	return len(pruned)
+
+
+def draw_book_parallel(source, output=OUTPUT, jobs=None, bookspergroup=1,
+		cachedir=None, prune=True):
+	"""Lay out groups of books as separate PDFs in a process pool, then merge
+	them and rebuild the links between them.
+
+	With a cachedir the parts are kept there keyed on their content, and only
+	the books whose rows or settings changed are laid out again. After a
+	successful build the parts it didn't use are pruned from the cache,
+	unless prune is False.
+
+	:returns: The paths of the parts the PDF was merged from."""
+	print("Building with {} workers ...".format(jobs or os.cpu_count()))
+	partdir = cachedir or tempfile.mkdtemp(prefix="pdf_builder")
+	os.makedirs(partdir, exist_ok=True)
+	try:
+		with multiprocessing.Pool(jobs) as pool:
+			name = part_key() if cachedir else "part000"
+			path = os.path.join(partdir, name + ".pdf")
+			results = [submit_part(pool, render_index_part, path, path)]
+			for job in part_jobs(verse_gen(source), partdir, bookspergroup,
+					cachedir is not None):
+				results.append(submit_part(pool, render_part, job, job[0]))
+			print("Reusing {} of {} parts".format(
+				sum(isinstance(r, CachedPart) for r in results), len(results)))
+			parts = [r.get() for r in results]
+
+		print("Merging ...")
+		merge_parts(parts, output)
+	finally:
+		if not cachedir:
+			shutil.rmtree(partdir)
+
+	if cachedir and prune:
+		print("Pruned {} stale parts".format(prune_cache(cachedir, [path for path, _ in parts])))
+	print("Done!")
+	return [path for path, _ in parts]
+
+
 def myOnFirstPage(canvas, doc):
 	# Title
 	p = Paragraph("""Bible Index
@@ -292,11 +504,12 @@ def myOnFirstPage(canvas, doc):
 		posy += 650
 
 		p = Paragraph("""
-				<a href=#ChapterIndex{bookid} color=blue>{bk}</a>
+				<a href='{href}' color=blue>{bk}</a>
 				"""
 				.format(
 					bk=BOOKS[i],
-					bookid=BOOKS[i].replace(" ", ""),
+					href=anchor_href(
+						"ChapterIndex" + BOOKS[i].replace(" ", ""), doc),
 					),
 				style=STYLENORMCENTER)
 		p.wrap(100,100)
@@ -307,30 +520,109 @@ def myOnFirstPage(canvas, doc):
 
 def myOnLaterPages(canvas, doc):
 	p = Paragraph(
-			"""<a href=#BookIndex color=blue>Book Index</a>""",
+			"""<a href='{href}' color=blue>Book Index</a>""".format(
+				href=anchor_href("BookIndex", doc)),
 			style=STYLENORMCENTER)
 	p.wrap(100,0)
 	p.drawOn(canvas, PAGEWIDTH/2 - 50, PAGEHEIGHT-0)
 
 
-def verse_gen(csvtxt):
-	"""A generator looping through every verse in the bible."""
-	spamreader = csv.reader(csvtxt, delimiter=",", quotechar='"')
-	i = 0
-	for row in spamreader:
+def verse_gen(source):
+	"""A generator looping through every verse in the bible.
+
+	:param source: A VerseSource, or any iterable of book,chapter,verse,text
+		rows such as a csv.reader."""
+	for row in source:
 		book, chapter, verse, text = row
 		yield row
 	return
 
 
-def main():
-	global chaptercounts
+def build_translation(job):
+	"""Build one translation's PDF with draw_book(), from a process pool."""
+	source, output = job
+	draw_book(source, output)
+	return output
+
+
+def draw_translations(corpus, outputdir=OUTPUTDIR, jobs=None, parallel=False,
+		bookspergroup=1, cachedir=None):
+	"""Build a PDF of every translation in a corpus directory like txt/ or md/,
+	named after the translation.
+
+	The translations are built concurrently, one per worker. In parallel mode
+	they are built one after another instead, each spread over every worker.
+	"""
+	builds = [(source, os.path.join(outputdir, source.name + ".pdf"))
+		for source in translation_sources(corpus)]
+	if parallel:
+		# the translations share the cache, so it is pruned once they are all built
+		used = []
+		for source, output in builds:
+			print(source.name)
+			used += draw_book_parallel(source, output, jobs, bookspergroup, cachedir,
+				prune=False)
+		if cachedir:
+			print("Pruned {} stale parts".format(prune_cache(cachedir, used)))
+		return
 
-	# Load csv
-	with open("./csv/AMP_fixed.csv") as csvtext:
-		chaptercounts = chapter_counts(csvtext)
-	with open("./csv/AMP_fixed.csv") as csvtext:
-		draw_book(csvtext)
+	with multiprocessing.Pool(jobs) as pool:
+		for output in pool.imap_unordered(build_translation, builds):
+			print("Wrote", output)
+
+
+def main():
+	p = argparse.ArgumentParser()
+	p.add_argument(
+		"--source", "-s", help="The verse csv, txt/ or md/ translation "
+			"directory, or compiled verse store to build from",
+		default=SOURCE,
+	)
+	p.add_argument(
+		"--batch", "-b", help="Build every translation in this corpus "
+			"directory (ie. txt or md) into --output-dir instead",
+		default=None,
+	)
+	p.add_argument(
+		"--output-dir", help="Where --batch writes its PDFs",
+		default=OUTPUTDIR,
+	)
+	p.add_argument(
+		"--output", "-o", help="Where to write the PDF",
+		default=OUTPUT,
+	)
+	p.add_argument(
+		"--parallel", "-p", help="Render books in a process pool and merge them",
+		action="store_true",
+	)
+	p.add_argument(
+		"--jobs", "-j", help="How many worker processes to use (default: all cores)",
+		type=int,
+		default=None,
+	)
+	p.add_argument(
+		"--books-per-part", help="How many books each worker renders at a time",
+		type=int,
+		default=1,
+	)
+	p.add_argument(
+		"--cache", "-c", help="Keep rendered parts in this directory and only "
+			"render books that changed since the last build (implies --parallel)",
+		nargs="?",
+		const=CACHEDIR,
+		default=None,
+	)
+	args = p.parse_args()
+
+	parallel = args.parallel or args.cache
+	if args.batch:
+		draw_translations(args.batch, args.output_dir, args.jobs, parallel,
+			args.books_per_part, args.cache)
+	elif parallel:
+		draw_book_parallel(verse_source(args.source), args.output, args.jobs,
+			args.books_per_part, args.cache)
+	else:
+		draw_book(verse_source(args.source), args.output)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+from pypdf import PdfWriter
+from pypdf.generic import (ArrayObject, Destination, Fit, FloatObject,
+		NameObject, NullObject, NumberObject)
+
+# Links between separately rendered parts are written as URI links with this
+# scheme and pointed at their real destination once the parts are merged.
+XREF = "xref:"
+
+
+def merge_parts(parts, output):
+	"""Join rendered parts into one PDF and rebuild the links between them.
+
+	:param parts: (path, anchors) pairs in document order, where anchors maps
+		a destination name to its (page, top) within that part.
+	:param output: The path of the merged PDF."""
+	writer = PdfWriter()
+	anchors = {}
+	for path, partanchors in parts:
+		offset = len(writer.pages)
+		writer.append(path)
+		for name, (page, top) in partanchors.items():
+			anchors[name] = (offset + page, top)
+
+	fixup_links(writer, anchors)
+	for name, (page, top) in anchors.items():
+		writer.add_named_destination_object(
+			Destination(name, writer.pages[page].indirect_reference,
+				Fit.xyz(top=top)))
+
+	with open(output, "wb") as f:
+		writer.write(f)
+
+
+def fixup_links(writer, anchors):
+	"""Turn every XREF link in the merged document into a go-to link to the
+	page and position of the anchor it names."""
+	for pdfpage in writer.pages:
+		for annot in pdfpage.get("/Annots", []):
+			annot = annot.get_object()
+			action = annot.get("/A")
+			if action is None or action.get("/S") != "/URI":
+				continue
+			uri = str(action["/URI"])
+			if not uri.startswith(XREF):
+				continue
+
+			name = uri[len(XREF):]
+			if name not in anchors:
+				raise ValueError(
+					"undefined destination target for '%s'" % name)
+			page, top = anchors[name]
+			annot[NameObject("/Dest")] = ArrayObject([
+				writer.pages[page].indirect_reference,
+				NameObject("/XYZ"),
+				NullObject(),
+				FloatObject(top),
+				NumberObject(0),
+			])
+			del annot["/A"]
@@ -0,0 +1,256 @@
+"""Parse lists of verse references, such as "John 3:16, Rom 3:23, 1 Jn 1:9,
+Romans 10:9-10", into spans of BBCCCVVV verse ids.
+
+Every book name in key_english.csv and abbreviation in
+key_abbreviations_english.csv, together with their "1Jn", "I John",
+"First John" and "1st John" forms and singular or plural forms such as
+"Psalm" and "Revelations", is compiled into a prefix trie when a
+ReferenceParser is made. The trie is written out as one regular expression,
+so a whole list is tokenized in a single finditer pass and books are matched
+longest first without trying every name in turn.
+
+References in a list carry on from the one before them:
+
+	John 3:16, 18       verse 18 of John 3
+	Rom 3:23; 5:8       Romans 5:8
+	Gen 1-3             chapters 1 to 3
+	Gen 50:26-Exo 1:5   across books
+	Jude 5              single chapter books take a verse
+"""
+import argparse
+import csv
+import os
+import re
+import time
+
+from verse_store import split_id, verse_id
+
+# the key tables in the repository's csv/, wherever this is run from
+CSVDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "csv")
+BOOKS = os.path.join(CSVDIR, "key_english.csv")
+ABBREVIATIONS = os.path.join(CSVDIR, "key_abbreviations_english.csv")
+
+# A span of whole chapters runs from verse 1 to the highest verse an id can hold.
+FIRSTVERSE = 1
+LASTVERSE = 999
+
+# Books with one chapter, whose references give a verse rather than a chapter.
+SINGLECHAPTER = {31, 57, 63, 64, 65}
+
+# What may come between a reference and one that carries on from it.
+SEPARATORS = " \t\n,;&"
+
+NUMBERED = {"1": ("i", "first", "1st"), "2": ("ii", "second", "2nd"), "3": ("iii", "third", "3rd")}
+
+# Last words of book names that are also written in the singular or plural.
+INFLECTIONS = {"psalms": "psalm", "proverbs": "proverb", "lamentations": "lamentation",
+	"chronicles": "chronicle", "kings": "king", "acts": "act", "revelation": "revelations"}
+
+REFERENCE = (r"(?<![^\W\d_])(?:({book})\.?\s*)?(\d+)(?:\s*[:.]\s*(\d+))?"
+	r"(?:\s*[-–—]\s*(?:({book})\.?\s*)?(\d+)(?:\s*[:.]\s*(\d+))?)?")
+
+
+def normalize(name):
+	"""The form of a book name that names are looked up by."""
+	return " ".join(name.lower().split())
+
+
+def name_forms(name):
+	"""The forms a book name is written in: "1 John" is also "1John", "I John",
+	"First John" and "1st John", and "1 Kings" is also "1 King"."""
+	forms = [name]
+	head, space, last = name.rpartition(" ")
+	if last.lower() in INFLECTIONS:
+		forms.append(head + space + INFLECTIONS[last.lower()])
+	for form in list(forms):
+		number, _, rest = form.partition(" ")
+		if number in NUMBERED and rest:
+			forms.append(number + rest)
+			forms.extend(prefix + " " + rest for prefix in NUMBERED[number])
+	return forms
+
+
+def trie_pattern(trie):
+	"""A regular expression matching the names in a trie of nested dicts,
+	longest first. An empty key marks the end of a name."""
+	branches = []
+	for char in sorted(trie):
+		if char:
+			branches.append((r"\s+" if char == " " else re.escape(char)) + trie_pattern(trie[char]))
+	if not branches:
+		return ""
+	pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+	if "" in trie:
+		if len(branches) == 1 and len(pattern) > 1:
+			pattern = "(?:" + pattern + ")"
+		pattern += "?"
+	return pattern
+
+
+class ReferenceParser(object):
+	"""Resolves book names and abbreviations and parses reference lists."""
+
+	def __init__(self, books=BOOKS, abbreviations=ABBREVIATIONS):
+		self.names = {}
+		self.ids = {}
+		with open(books, newline="", encoding="utf-8") as f:
+			reader = csv.reader(f)
+			next(reader, None)
+			for row in reader:
+				self.names[int(row[0])] = row[1]
+		with open(abbreviations, newline="", encoding="utf-8") as f:
+			reader = csv.reader(f)
+			next(reader, None)
+			rows = [(row[1], int(row[2])) for row in reader]
+
+		# names given outright win over the forms made from them
+		rows += [(name, book) for book, name in self.names.items()]
+		for name, book in rows + [(form, book) for name, book in rows for form in name_forms(name)[1:]]:
+			self.ids.setdefault(normalize(name.replace(".", "")), book)
+
+		trie = {}
+		for name in self.ids:
+			node = trie
+			for char in name:
+				node = node.setdefault(char, {})
+			node[""] = True
+		book = trie_pattern(trie)
+		self.pattern = re.compile(REFERENCE.format(book=book), re.IGNORECASE)
+
+	def book_id(self, name):
+		"""The id of the book a name or abbreviation stands for, or None."""
+		return self.ids.get(normalize(name.replace(".", "")))
+
+	def book_name(self, book):
+		return self.names[book]
+
+	def parse(self, text):
+		"""The (first, last) verse id span of every reference in a list.
+
+		:raises ValueError: If a reference doesn't follow a book or is out of
+			range."""
+		spans = []
+		ids = self.ids
+		book = chapter = None
+		end = 0
+		for match in self.pattern.finditer(text):
+			name, c1, v1, name2, c2, v2 = match.groups()
+			if name:
+				book, chapter = ids[" ".join(name.lower().split())], None
+			elif book is None or text[end:match.start()].strip(SEPARATORS):
+				# ie. "3:16" alone, or after a book that isn't known
+				raise ValueError("no book before %r" % match.group(0))
+			end = match.end()
+
+			# start: a verse of a chapter, or a whole chapter with no verse
+			if v1 is not None:
+				chapter, verse = int(c1), int(v1)
+			elif chapter is not None and not name:
+				verse = int(c1)
+			elif book in SINGLECHAPTER:
+				chapter, verse = 1, int(c1)
+			else:
+				chapter, verse = int(c1), None
+			first = verse_id(book, chapter, FIRSTVERSE if verse is None else verse)
+
+			if c2 is None:
+				last = first if verse is not None else verse_id(book, chapter, LASTVERSE)
+			else:
+				if name2:
+					book = ids[" ".join(name2.lower().split())]
+				if v2 is not None:
+					chapter, verse = int(c2), int(v2)
+				elif name2 and book in SINGLECHAPTER:
+					chapter, verse = 1, int(c2)
+				elif verse is not None and not name2:
+					verse = int(c2)
+				else:
+					chapter, verse = int(c2), None
+				last = verse_id(book, chapter, LASTVERSE if verse is None else verse)
+
+			if chapter > 999 or (verse or 0) > 999 or last < first:
+				raise ValueError("%r is not a range of verses" % match.group(0))
+			# a bare number after a whole chapter is another chapter
+			if verse is None:
+				chapter = None
+			spans.append((first, last))
+		return spans
+
+	def parse_all(self, texts):
+		"""The spans of each of many reference lists."""
+		parse = self.parse
+		return [parse(text) for text in texts]
+
+	def format(self, first, last):
+		"""A span of verse ids as a reference, ie. "Romans 10:9-10"."""
+		book, chapter, verse = split_id(first)
+		book2, chapter2, verse2 = split_id(last)
+		reference = "%s %d" % (self.names[book], chapter)
+		if verse2 == LASTVERSE and verse == FIRSTVERSE:
+			if (book2, chapter2) == (book, chapter):
+				return reference
+			if book2 == book:
+				return "%s-%d" % (reference, chapter2)
+			return "%s-%s %d" % (reference, self.names[book2], chapter2)
+		reference += ":%d" % verse
+		if first == last:
+			return reference
+		if (book2, chapter2) == (book, chapter):
+			return "%s-%d" % (reference, verse2)
+		if book2 == book:
+			return "%s-%d:%d" % (reference, chapter2, verse2)
+		return "%s-%s %d:%d" % (reference, self.names[book2], chapter2, verse2)
+
+
+_parser = None
+
+
+def parser():
+	"""The ReferenceParser for the key tables in csv/, made on first use."""
+	global _parser
+	if _parser is None:
+		_parser = ReferenceParser()
+	return _parser
+
+
+def parse_references(text):
+	"""The (first, last) verse id span of every reference in a list."""
+	return parser().parse(text)
+
+
+def resolve_book(name):
+	"""The id of the book a name or abbreviation stands for, or None."""
+	return parser().book_id(name)
+
+
+def main():
+	p = argparse.ArgumentParser(
+		description="Parse verse references into BBCCCVVV id spans")
+	p.add_argument(
+		"references", help="Reference lists, ie. \"John 3:16, Rom 3:23\"",
+		nargs="+",
+	)
+	p.add_argument(
+		"--benchmark", help="Parse the references this many times and report "
+			"the rate",
+		type=int, default=0,
+	)
+	args = p.parse_args()
+
+	references = ReferenceParser()
+	for text in args.references:
+		for first, last in references.parse(text):
+			print("%08d %08d  %s" % (first, last, references.format(first, last)))
+
+	if args.benchmark:
+		texts = args.references * args.benchmark
+		count = sum(len(spans) for spans in references.parse_all(args.references)) * args.benchmark
+		start = time.perf_counter()
+		references.parse_all(texts)
+		elapsed = time.perf_counter() - start
+		print("Parsed {} references in {:.1f}ms ({:.0f} references/ms)".format(
+			count, elapsed * 1000, count / elapsed / 1000))
+
+
+if __name__ == "__main__":
+	main()
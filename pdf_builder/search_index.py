@@ -0,0 +1,382 @@
+"""A full-text index of the verses of one or more translations, ranked by BM25.
+
+Every verse of every translation is a document, numbered in the order the
+translations and their verses were indexed, so each translation is one range
+of documents. An index file holds, in native byte order:
+
+	header        magic, document count, term count, translation count,
+	              average document length, length of the names blob
+	names         the translation names, newline separated, padded to 4
+	translations  the first document of each translation, plus one for the
+	              end (uint32 each)
+	ids           the BBCCCVVV id of every document (uint32 each)
+	norms         the BM25 length normalisation k1*(1-b+b*len/avglen) of every
+	              document (float32 each)
+	textoffsets   where each document's text starts in the text blob, plus one
+	              for the end (uint32 each)
+	termoffsets   where each term starts in the term blob, plus one for the
+	              end (uint32 each)
+	postoffsets   where each term's postings start in the postings blob, plus
+	              one for the end (uint32 each)
+	first         the first document of each term's postings (uint32 each)
+	widths        the size of each term's document gaps: 1, 2 or 4 (uint8 each,
+	              padded to 4)
+	terms         the UTF-8 terms, back to back in sorted order
+	postings      for each term, the gaps between its documents after the first,
+	              each width bytes, then the term's frequency in each of its
+	              documents (uint8 each, capped at 255)
+	text          the UTF-8 text of every document, back to back
+
+Frequent terms have small gaps, so most postings take one byte for the
+document and one for the frequency. Postings are decoded, intersected and
+scored as numpy arrays over the mapped file. Phrases are checked against the
+stored text of the best scoring documents holding all of their terms, until
+there are enough results.
+"""
+import argparse
+import math
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+from verse_store import OUTPUTDIR, split_id
+
+MAGIC = b"VSEARCH1"
+HEADER = struct.Struct("=8sIIIfI")
+INDEXEXT = ".vsearch"
+OUTPUT = os.path.join(OUTPUTDIR, "verses" + INDEXEXT)
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+TOKEN = re.compile(r"[^\W_]+")
+PHRASE = re.compile(r'"([^"]*)"')
+GAPCODES = {1: "B", 2: "H", 4: "I"}
+GAPTYPES = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+
+
+def tokenize(text):
+	"""The lower-cased words of a text, ie. "The LORD'S day" is
+	["the", "lord", "s", "day"]."""
+	return TOKEN.findall(text.lower())
+
+
+def parse_query(query):
+	"""The (terms, phrases) of a query, where a phrase is a list of the terms
+	of a quoted part of it."""
+	phrases = [tokenize(phrase) for phrase in PHRASE.findall(query)]
+	phrases = [phrase for phrase in phrases if len(phrase) > 1]
+	terms = tokenize(PHRASE.sub(" ", query))
+	for phrase in phrases:
+		terms.extend(phrase)
+	return list(dict.fromkeys(terms)), phrases
+
+
+def pad4(data):
+	return data + b"\0" * (-len(data) % 4)
+
+
+def compile_index(sources, path):
+	"""Index the verses of every source (a VerseSource or VerseStore) into an
+	index file at path.
+
+	:returns: The number of documents indexed."""
+	names = []
+	starts = array("I")
+	ids = array("I")
+	lengths = array("I")
+	textoffsets = array("I")
+	text = bytearray()
+	postings = {}
+
+	for source in sources:
+		names.append(source.name)
+		starts.append(len(ids))
+		for book, chapter, verse, verse_text in source:
+			doc = len(ids)
+			ids.append(int(book)*1000000 + int(chapter)*1000 + int(verse))
+			textoffsets.append(len(text))
+			text += verse_text.encode("utf-8")
+			tokens = tokenize(verse_text)
+			lengths.append(len(tokens))
+			for term, tf in _counts(tokens).items():
+				entry = postings.get(term)
+				if entry is None:
+					entry = postings[term] = (array("I"), bytearray())
+				entry[0].append(doc)
+				entry[1].append(min(tf, 255))
+	starts.append(len(ids))
+	textoffsets.append(len(text))
+
+	avglen = sum(lengths) / len(lengths) if lengths else 0.0
+	norms = array("f", (K1 * (1 - B + B * length / avglen) if avglen else K1
+		for length in lengths))
+
+	terms = sorted(postings)
+	termblob = bytearray()
+	termoffsets = array("I")
+	postblob = bytearray()
+	postoffsets = array("I")
+	first = array("I")
+	widths = bytearray()
+	for term in terms:
+		docs, tfs = postings[term]
+		gaps = array("I", (docs[i] - docs[i-1] for i in range(1, len(docs))))
+		width = 1 if not gaps or max(gaps) < 0x100 else 2 if max(gaps) < 0x10000 else 4
+		termoffsets.append(len(termblob))
+		termblob += term.encode("utf-8")
+		postoffsets.append(len(postblob))
+		first.append(docs[0])
+		widths.append(width)
+		postblob += array(GAPCODES[width], gaps).tobytes()
+		postblob += tfs
+	termoffsets.append(len(termblob))
+	postoffsets.append(len(postblob))
+
+	namesblob = pad4("\n".join(names).encode("utf-8"))
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(HEADER.pack(MAGIC, len(ids), len(terms), len(names), avglen,
+			len(namesblob)))
+		f.write(namesblob)
+		for table in (starts, ids, norms, textoffsets, termoffsets, postoffsets,
+				first):
+			f.write(table.tobytes())
+		f.write(pad4(bytes(widths)))
+		f.write(termblob)
+		f.write(postblob)
+		f.write(text)
+	os.replace(tmp, path)
+	return len(ids)
+
+
+def _counts(tokens):
+	counts = {}
+	for token in tokens:
+		counts[token] = counts.get(token, 0) + 1
+	return counts
+
+
+class SearchIndex(object):
+	"""Read-only access to a compiled index through mmap."""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		(magic, self.count, self.termcount, translations, self.avglen,
+			nameslen) = HEADER.unpack_from(self.mm)
+		if magic != MAGIC:
+			raise ValueError("%s is not a search index" % path)
+
+		view = memoryview(self.mm)
+		pos = HEADER.size
+		names = bytes(view[pos:pos+nameslen]).rstrip(b"\0").decode("utf-8")
+		self.names = names.split("\n") if names else []
+		pos += nameslen
+
+		def table(code, count):
+			nonlocal pos
+			size = 4 * count
+			section = view[pos:pos+size].cast(code)
+			pos += size
+			return section
+
+		self.starts = table("I", translations + 1)
+		self.ids = table("I", self.count)
+		self.norms = np.frombuffer(self.mm, dtype=np.float32, count=self.count, offset=pos)
+		pos += 4 * self.count
+		self.textoffsets = table("I", self.count + 1)
+		termoffsets = table("I", self.termcount + 1)
+		self.postoffsets = table("I", self.termcount + 1)
+		self.first = table("I", self.termcount)
+		self.widths = view[pos:pos+self.termcount]
+		pos += self.termcount + (-self.termcount % 4)
+
+		termblob = view[pos:pos+termoffsets[-1]]
+		self.terms = {bytes(termblob[termoffsets[i]:termoffsets[i+1]]).decode("utf-8"): i
+			for i in range(self.termcount)}
+		pos += termoffsets[-1]
+		termblob.release()
+		self.poststart = pos
+		self.textstart = pos + self.postoffsets[-1]
+		termoffsets.release()
+		self.view = view
+
+	def __getstate__(self):
+		return {"path": self.path}
+
+	def __setstate__(self, state):
+		self.__init__(state["path"])
+
+	def __len__(self):
+		return self.count
+
+	def close(self):
+		del self.norms
+		for section in (self.starts, self.ids, self.textoffsets,
+				self.postoffsets, self.first, self.widths, self.view):
+			section.release()
+		self.mm.close()
+
+	def translation(self, doc):
+		"""The name of the translation a document belongs to."""
+		return self.names[bisect_left(self.starts, doc + 1) - 1]
+
+	def text(self, doc):
+		"""The text of a document."""
+		start = self.textstart
+		return self.mm[start+self.textoffsets[doc]:start+self.textoffsets[doc+1]].decode("utf-8")
+
+	def postings(self, term):
+		"""The (documents, frequencies) of a term as numpy arrays, or None if it
+		isn't indexed. The documents are in ascending order."""
+		i = self.terms.get(term)
+		if i is None:
+			return None
+		start = self.poststart + self.postoffsets[i]
+		end = self.poststart + self.postoffsets[i+1]
+		width = self.widths[i]
+		df = (end - start) // (width + 1)
+		gaps = np.frombuffer(self.mm, dtype=GAPTYPES[width], count=df-1, offset=start)
+		docs = np.empty(df, dtype=np.int64)
+		docs[0] = self.first[i]
+		np.cumsum(gaps, dtype=np.int64, out=docs[1:])
+		docs[1:] += docs[0]
+		tfs = np.frombuffer(self.mm, dtype=np.uint8, count=df, offset=start+width*(df-1))
+		return docs, tfs
+
+	def doc_range(self, translations):
+		"""The (start, end) document ranges of the named translations.
+
+		:raises ValueError: If a translation isn't in the index."""
+		ranges = []
+		for name in translations:
+			if name not in self.names:
+				raise ValueError("translation %r is not in the index, it has %s" % (
+					name, ", ".join(self.names) or "none"))
+			i = self.names.index(name)
+			ranges.append((self.starts[i], self.starts[i+1]))
+		return ranges
+
+	def search(self, query, limit=10, translations=None):
+		"""The best documents for a query, ranked by BM25, as dicts of
+		translation, id, score and text, best first.
+
+		Every word of the query must appear in a document, and every quoted
+		phrase must appear as written. translations limits the search to the
+		named translations.
+
+		:raises ValueError: If a translation isn't in the index."""
+		ranges = self.doc_range(translations) if translations else None
+		terms, phrases = parse_query(query)
+		if not terms:
+			return []
+		postings = []
+		for term in terms:
+			entry = self.postings(term)
+			if entry is None:
+				return []
+			postings.append(entry)
+		postings.sort(key=lambda entry: len(entry[0]))
+
+		# candidates are the rarest term's documents that hold every other term
+		candidates = postings[0][0]
+		if translations:
+			candidates = np.concatenate([
+				candidates[np.searchsorted(candidates, lo):np.searchsorted(candidates, hi)]
+				for lo, hi in ranges])
+		for docs, tfs in postings[1:]:
+			found = np.searchsorted(docs, candidates).clip(max=len(docs)-1)
+			candidates = candidates[docs[found] == candidates]
+			if not len(candidates):
+				return []
+
+		scores = np.zeros(len(candidates))
+		norms = self.norms[candidates]
+		for docs, tfs in postings:
+			df = len(docs)
+			idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+			tf = tfs[np.searchsorted(docs, candidates)].astype(np.float64)
+			scores += idf * tf * (K1 + 1) / (tf + norms)
+
+		if phrases:
+			# check phrases best first, until there are enough results
+			order = np.lexsort((candidates, -scores))
+			best = []
+			for i in order:
+				if all(self._has_phrase(candidates[i], phrase) for phrase in phrases):
+					best.append(i)
+					if len(best) == limit:
+						break
+		else:
+			best = np.argpartition(-scores, limit)[:limit] if len(scores) > limit else np.arange(len(scores))
+			best = best[np.lexsort((candidates[best], -scores[best]))]
+		return [{"translation": self.translation(int(candidates[i])),
+				"id": self.ids[candidates[i]], "score": round(float(scores[i]), 4),
+				"text": self.text(candidates[i])}
+			for i in best]
+
+	def _has_phrase(self, doc, phrase):
+		tokens = tokenize(self.text(doc))
+		n = len(phrase)
+		return any(tokens[i:i+n] == phrase for i in range(len(tokens) - n + 1))
+
+
+def main():
+	from verse_source import translation_sources, verse_source
+
+	p = argparse.ArgumentParser(
+		description="Build or query a full-text index of translations")
+	p.add_argument(
+		"sources", help="Verse csv files, txt/md translation directories or "
+			"verse stores to index",
+		nargs="*",
+	)
+	p.add_argument(
+		"--batch", "-b", help="Index every translation in this corpus "
+			"directory (ie. txt or md)",
+		default=None,
+	)
+	p.add_argument(
+		"--index", "-i", help="The index file to build or query",
+		default=OUTPUT,
+	)
+	p.add_argument(
+		"--query", "-q", help='Search the index, ie. "love one another" or '
+			'\'"the word" beginning\'',
+		default=None,
+	)
+	p.add_argument(
+		"--translation", "-t", help="Only search this translation (repeatable)",
+		action="append", default=None,
+	)
+	p.add_argument(
+		"--limit", "-n", help="How many results to show",
+		type=int, default=10,
+	)
+	args = p.parse_args()
+
+	sources = [verse_source(path) for path in args.sources]
+	if args.batch:
+		sources += translation_sources(args.batch)
+	if sources:
+		os.makedirs(os.path.dirname(args.index) or ".", exist_ok=True)
+		print("Indexed {} verses into {}".format(
+			compile_index(sources, args.index), args.index))
+	if args.query:
+		index = SearchIndex(args.index)
+		for result in index.search(args.query, args.limit, args.translation):
+			book, chapter, verse = split_id(result["id"])
+			print("{:.2f} {} {}:{}:{} {}".format(result["score"],
+				result["translation"], book, chapter, verse, result["text"]))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+import csv
+import os
+from abc import ABC, abstractmethod
+
+from verse_store import STOREEXT, VerseStore
+
+# The verse prefix of each line in the txt and md corpora, ie. "[1:1] " and
+# "**[1:1]** ".
+TXTOPEN, TXTCLOSE = "[", "] "
+MDOPEN, MDCLOSE = "**[", "]** "
+
+
+class VerseSource(ABC):
+	"""A translation's verses, iterated as (book, chapter, verse, text) rows in
+	canon order. Book, chapter and verse are the strings found in the source,
+	with books numbered from 1."""
+
+	def __init__(self, path):
+		self.path = path
+
+	@abstractmethod
+	def __iter__(self):
+		"""The (book, chapter, verse, text) rows of the translation."""
+
+	@property
+	def name(self):
+		"""A short name for the translation, used to name its output."""
+		return os.path.splitext(os.path.basename(os.path.normpath(self.path)))[0]
+
+
+class CsvVerseSource(VerseSource):
+	"""Verses from a csv of book,chapter,verse,text rows, like AMP_fixed.csv."""
+
+	def __iter__(self):
+		with open(self.path, newline="", encoding="utf-8") as csvtext:
+			for row in csv.reader(csvtext, delimiter=",", quotechar='"'):
+				book, chapter, verse, text = row
+				yield row
+
+
+class BookFilesVerseSource(VerseSource):
+	"""Verses from a directory holding one file per book, each named
+	"<book number> <book name> - <version>.<extension>" with one verse per line
+	behind a "<open>chapter:verse<close>" prefix. Other lines are skipped."""
+	extension = None
+	prefix = None
+	suffix = None
+
+	def book_files(self):
+		"""The (book, path) of every book file, in canon order."""
+		books = []
+		for filename in os.listdir(self.path):
+			number, _, rest = filename.partition(" ")
+			if filename.endswith(self.extension) and number.isdigit():
+				books.append((int(number), os.path.join(self.path, filename)))
+		books.sort()
+		return books
+
+	def __iter__(self):
+		prefix, suffix = self.prefix, self.suffix
+		skip = len(prefix)
+		for book, path in self.book_files():
+			book = str(book)
+			with open(path, encoding="utf-8-sig") as f:
+				for line in f:
+					if not line.startswith(prefix):
+						continue
+					ref, sep, text = line[skip:].partition(suffix)
+					chapter, _, verse = ref.partition(":")
+					if not sep or not chapter.isdigit() or not verse.isdigit():
+						continue
+					yield [book, chapter, verse, text.rstrip("\n")]
+
+
+class TxtVerseSource(BookFilesVerseSource):
+	"""Verses from a translation directory under txt/."""
+	extension = ".txt"
+	prefix = TXTOPEN
+	suffix = TXTCLOSE
+
+
+class MdVerseSource(BookFilesVerseSource):
+	"""Verses from a translation directory under md/."""
+	extension = ".md"
+	prefix = MDOPEN
+	suffix = MDCLOSE
+
+
+def verse_source(path):
+	"""The VerseSource for a csv file, a txt/md translation directory or a
+	compiled VerseStore."""
+	if os.path.isdir(path):
+		extensions = {os.path.splitext(f)[1] for f in os.listdir(path)}
+		for source in (TxtVerseSource, MdVerseSource):
+			if source.extension in extensions:
+				return source(path)
+		raise ValueError("no .txt or .md book files found in %s" % path)
+	if path.endswith(".csv"):
+		return CsvVerseSource(path)
+	if path.endswith(STOREEXT):
+		return VerseStore(path)
+	raise ValueError("unknown verse source %s" % path)
+
+
+def translation_sources(corpus):
+	"""A VerseSource for every translation directory in a corpus such as txt/
+	or md/, sorted by name."""
+	return [verse_source(os.path.join(corpus, name))
+		for name in sorted(os.listdir(corpus))
+		if os.path.isdir(os.path.join(corpus, name))]
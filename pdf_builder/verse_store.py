@@ -0,0 +1,211 @@
+"""A compiled, memory-mapped store of one translation's verses.
+
+A store file holds, in native byte order:
+
+	header    magic, verse count, book count
+	ids       the BBCCCVVV id of every verse, ascending (uint32 each)
+	offsets   where each verse's text starts in the text blob, plus one for
+	          the end of the blob (uint32 each)
+	chapters  for every book and chapter number, the index of the chapter's
+	          first verse or NOVERSE (uint32 each)
+	text      the UTF-8 text of every verse, back to back in id order
+
+Because the text is in id order, a range of verse ids is a single slice of the
+blob and a single verse is found directly through the chapter table.
+"""
+import argparse
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+MAGIC = b"VSTORE01"
+HEADER = struct.Struct("=8sII")
+STOREEXT = ".vstore"
+OUTPUTDIR = "vstore"
+
+# Chapter numbers run up to 150 (Psalms), so each book gets 151 slots in the
+# chapter table, indexed by chapter number.
+CHAPTERSLOTS = 151
+NOVERSE = 0xFFFFFFFF
+
+
+def verse_id(book, chapter, verse):
+	"""The BBCCCVVV id of a verse, ie. Genesis 1:1 is 1001001."""
+	return int(book)*1000000 + int(chapter)*1000 + int(verse)
+
+
+def split_id(vid):
+	"""The (book, chapter, verse) of a BBCCCVVV verse id."""
+	return vid // 1000000, vid // 1000 % 1000, vid % 1000
+
+
+def compile_store(rows, path):
+	"""Compile book,chapter,verse,text rows into a store file at path.
+
+	:returns: The number of verses written."""
+	verses = sorted((verse_id(book, chapter, verse), text.encode("utf-8"))
+		for book, chapter, verse, text in rows)
+
+	ids = array("I")
+	offsets = array("I")
+	offset = 0
+	for vid, text in verses:
+		if ids and ids[-1] == vid:
+			raise ValueError("verse %08d appears more than once" % vid)
+		ids.append(vid)
+		offsets.append(offset)
+		offset += len(text)
+	offsets.append(offset)
+
+	books = split_id(ids[-1])[0] if ids else 0
+	chapters = array("I", [NOVERSE]) * (books * CHAPTERSLOTS)
+	for i in range(len(ids)-1, -1, -1):
+		book, chapter, _ = split_id(ids[i])
+		if chapter >= CHAPTERSLOTS:
+			raise ValueError("verse %08d is past the last chapter slot" % ids[i])
+		chapters[(book-1)*CHAPTERSLOTS + chapter] = i
+
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(HEADER.pack(MAGIC, len(ids), books))
+		f.write(ids.tobytes())
+		f.write(offsets.tobytes())
+		f.write(chapters.tobytes())
+		for vid, text in verses:
+			f.write(text)
+	os.replace(tmp, path)
+	return len(ids)
+
+
+class VerseStore(object):
+	"""Read-only access to a compiled store through mmap.
+
+	Iterating a store yields the same book,chapter,verse,text rows as a
+	VerseSource, so it can be handed to pdf_builder or a loader as-is."""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as f:
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, self.books = HEADER.unpack_from(self.mm)
+		if magic != MAGIC:
+			raise ValueError("%s is not a verse store" % path)
+
+		view = memoryview(self.mm)
+		pos = HEADER.size
+		end = pos + 4*self.count
+		self.ids = view[pos:end].cast("I")
+		pos, end = end, end + 4*(self.count+1)
+		self.offsets = view[pos:end].cast("I")
+		pos, end = end, end + 4*self.books*CHAPTERSLOTS
+		self.chapters = view[pos:end].cast("I")
+		self.textstart = end
+
+	def __getstate__(self):
+		return {"path": self.path}
+
+	def __setstate__(self, state):
+		self.__init__(state["path"])
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for i in range(self.count):
+			book, chapter, verse = split_id(self.ids[i])
+			yield [str(book), str(chapter), str(verse), self.text(i)]
+
+	@property
+	def name(self):
+		"""The translation's name, taken from the store's file name."""
+		return os.path.splitext(os.path.basename(self.path))[0]
+
+	def close(self):
+		self.ids.release()
+		self.offsets.release()
+		self.chapters.release()
+		self.mm.close()
+
+	def index(self, vid):
+		"""The position of a verse id in the store, or None if it is missing.
+
+		Verses are numbered from 1 within a chapter, so the chapter table
+		normally gives the position directly; a search of the ids covers any
+		gaps."""
+		book, chapter, verse = split_id(vid)
+		if 1 <= book <= self.books and chapter < CHAPTERSLOTS:
+			first = self.chapters[(book-1)*CHAPTERSLOTS + chapter]
+			i = first + verse - 1
+			if first != NOVERSE and 0 <= i < self.count and self.ids[i] == vid:
+				return i
+		i = bisect_left(self.ids, vid)
+		if i < self.count and self.ids[i] == vid:
+			return i
+		return None
+
+	def text(self, i):
+		"""The text of the verse at position i."""
+		start = self.textstart
+		return self.mm[start+self.offsets[i]:start+self.offsets[i+1]].decode("utf-8")
+
+	def get(self, vid):
+		"""The text of a verse id, or None if the store doesn't have it."""
+		i = self.index(vid)
+		if i is None:
+			return None
+		return self.text(i)
+
+	def span(self, start, end):
+		"""The positions of the verses with ids from start to end inclusive, as
+		a (first, stop) pair for slicing."""
+		return bisect_left(self.ids, start), bisect_right(self.ids, end)
+
+	def text_between(self, start, end):
+		"""The raw UTF-8 text of every verse with an id from start to end
+		inclusive, as one memoryview into the store."""
+		first, stop = self.span(start, end)
+		start = self.textstart
+		return memoryview(self.mm)[start+self.offsets[first]:start+self.offsets[stop]]
+
+	def between(self, start, end):
+		"""A generator of (verse id, text) for every verse with an id from start
+		to end inclusive, ie. between(1001001, 2001005) is Genesis 1:1 through
+		Exodus 1:5."""
+		first, stop = self.span(start, end)
+		for i in range(first, stop):
+			yield self.ids[i], self.text(i)
+
+
+def main():
+	from verse_source import translation_sources, verse_source
+
+	p = argparse.ArgumentParser(
+		description="Compile translations into verse stores")
+	p.add_argument(
+		"sources", help="Verse csv files or txt/md translation directories",
+		nargs="*",
+	)
+	p.add_argument(
+		"--batch", "-b", help="Compile every translation in this corpus "
+			"directory (ie. txt or md)",
+		default=None,
+	)
+	p.add_argument(
+		"--output-dir", "-o", help="Where to write the stores",
+		default=OUTPUTDIR,
+	)
+	args = p.parse_args()
+
+	sources = [verse_source(path) for path in args.sources]
+	if args.batch:
+		sources += translation_sources(args.batch)
+	os.makedirs(args.output_dir, exist_ok=True)
+	for source in sources:
+		path = os.path.join(args.output_dir, source.name + STOREEXT)
+		print("Compiled {} verses into {}".format(compile_store(source, path), path))
+
+
+if __name__ == "__main__":
+	main()
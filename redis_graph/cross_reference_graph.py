@@ -0,0 +1,233 @@
+import collections
+import csv
+import json
+import os
+import sys
+
+from redis.exceptions import ResponseError
+
+# the redis client and verse ids are shared with redis_json and pdf_builder
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "pdf_builder"))
+sys.path.insert(0, os.path.join(HERE, "..", "redis_json"))
+from redis_client import batched, get_redis_connection
+from settings import CONFIG_DATA
+from verse_store import split_id, verse_id
+
+GRAPH = CONFIG_DATA.get("REDIS_GRAPH_NAME", "crossrefs")
+# Query results are cached under graphquery:*, which clear_cache_hash_keys purges.
+CACHE_PREFIX = "graphquery:"
+CACHE_TTL = CONFIG_DATA.get("REDIS_GRAPH_CACHE_TTL", 3600)
+# Rows sent in each UNWIND query, and queries sent in each pipeline.
+BATCH_SIZE = 1000
+PIPELINE_DEPTH = 10
+
+# OSIS book names used by the openbible.info cross_references.txt, in canon order.
+OSIS_BOOKS = ["Gen", "Exod", "Lev", "Num", "Deut", "Josh", "Judg", "Ruth", "1Sam",
+    "2Sam", "1Kgs", "2Kgs", "1Chr", "2Chr", "Ezra", "Neh", "Esth", "Job", "Ps",
+    "Prov", "Eccl", "Song", "Isa", "Jer", "Lam", "Ezek", "Dan", "Hos", "Joel",
+    "Amos", "Obad", "Jonah", "Mic", "Nah", "Hab", "Zeph", "Hag", "Zech", "Mal",
+    "Matt", "Mark", "Luke", "John", "Acts", "Rom", "1Cor", "2Cor", "Gal", "Eph",
+    "Phil", "Col", "1Thess", "2Thess", "1Tim", "2Tim", "Titus", "Phlm", "Heb",
+    "Jas", "1Pet", "2Pet", "1John", "2John", "3John", "Jude", "Rev"]
+OSIS_BOOK_IDS = {name: i + 1 for i, name in enumerate(OSIS_BOOKS)}
+
+def osis_verse_id(ref):
+    """
+    The BBCCCVVV id of an OSIS reference, ie. "Gen.1.1" is 1001001.
+    """
+    book, chapter, verse = ref.split(".")
+    return verse_id(OSIS_BOOK_IDS[book], chapter, verse)
+
+def read_cross_references(path):
+    """
+    (vid, r, sv, ev) rows, as in the cross_reference table, from either the
+    openbible.info cross_references.txt or a csv of the table. r is the
+    relevance (openbible votes), ev is 0 unless the reference is a range.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for row in csv.reader(f):
+                if row and row[0].isdigit():
+                    yield tuple(int(value) for value in row[:4])
+            return
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3 or not fields[0][:1].isalnum() or fields[0] == "From Verse":
+                continue
+            start, _, end = fields[1].partition("-")
+            yield (osis_verse_id(fields[0]), int(fields[2]),
+                osis_verse_id(start), osis_verse_id(end) if end else 0)
+
+def cypher_value(value):
+    """
+    A python value as a cypher literal, for query parameters.
+    """
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ",".join(cypher_value(v) for v in value)
+    if isinstance(value, dict):
+        return "{%s}" % ",".join("%s:%s" % (k, cypher_value(v)) for k, v in value.items())
+    if isinstance(value, str):
+        return json.dumps(value)
+    if value is None:
+        return "null"
+    return repr(value)
+
+def cypher(query, **params):
+    """
+    A query with its parameters in the CYPHER header RedisGraph expects.
+    """
+    if not params:
+        return query
+    return "CYPHER %s %s" % (" ".join("%s=%s" % (name, cypher_value(value))
+        for name, value in params.items()), query)
+
+class CrossReferenceGraph(object):
+    """
+    The cross reference graph: (:Verse {id, b, c, v}) nodes joined by
+    [:REF {r, ev}] edges from a verse to the start verse of each of its
+    cross references, and (:Book {id, name, testament, genre}) nodes.
+    Writes go to main in batched UNWIND queries; reads go to the replicas
+    with GRAPH.RO_QUERY and are cached under graphquery:*.
+    """
+
+    def __init__(self, rc=None, graph=GRAPH):
+        self.rc = rc or get_redis_connection()
+        self.graph = graph
+
+    def query(self, query, **params):
+        """
+        Run a write query on main. Returns the result rows.
+        """
+        return self._rows(self.rc.main.execute_command("GRAPH.QUERY", self.graph, cypher(query, **params)))
+
+    def read(self, query, **params):
+        """
+        Run a read only query on a replica. Returns the result rows.
+        """
+        return self._rows(self.rc.replica.execute_command("GRAPH.RO_QUERY", self.graph, cypher(query, **params)))
+
+    @staticmethod
+    def _rows(reply):
+        # [header, rows, statistics], or just [statistics] when nothing is returned
+        return reply[1] if len(reply) == 3 else []
+
+    @staticmethod
+    def _stats(reply):
+        # statistics are lines like "Relationships created: 2"
+        stats = {}
+        for line in reply[-1]:
+            name, _, value = line.partition(": ")
+            try:
+                stats[name] = float(value.split()[0])
+            except (IndexError, ValueError):
+                pass
+        return stats
+
+    def run_batches(self, query, rows, batch_size=BATCH_SIZE):
+        """
+        Run query once per batch of rows, passed as $rows, sending
+        PIPELINE_DEPTH queries per round trip.
+        Returns the number of rows sent and the query statistics, such as
+        "Relationships created", summed over every batch.
+        """
+        sent = 0
+        stats = collections.Counter()
+        for group in batched(batched(rows, batch_size), PIPELINE_DEPTH):
+            pipeline = self.rc.main.pipeline(transaction=False)
+            for batch in group:
+                pipeline.execute_command("GRAPH.QUERY", self.graph, cypher(query, rows=batch))
+                sent += len(batch)
+            for reply in pipeline.execute():
+                stats.update(self._stats(reply))
+        return sent, stats
+
+    def create_indexes(self):
+        for label in ("Verse", "Book"):
+            try:
+                self.query("CREATE INDEX ON :%s(id)" % label)
+            except ResponseError as err:
+                if "already indexed" not in str(err):
+                    raise
+
+    def load_books(self, books, batch_size=BATCH_SIZE):
+        """
+        Merge Book nodes from {id, name, testament, genre} dicts.
+        Returns the number of books.
+        """
+        return self.run_batches(
+            "UNWIND $rows AS row MERGE (b:Book {id: row.id}) "
+            "SET b.name = row.name, b.testament = row.testament, b.genre = row.genre",
+            books, batch_size)[0]
+
+    def load_verses(self, vids, batch_size=BATCH_SIZE):
+        """
+        Merge a Verse node for each BBCCCVVV id.
+        Returns the number of ids.
+        """
+        return self.run_batches(
+            "UNWIND $rows AS row MERGE (v:Verse {id: row[0]}) "
+            "SET v.b = row[1], v.c = row[2], v.v = row[3]",
+            ((vid,) + split_id(vid) for vid in vids), batch_size)[0]
+
+    def load_references(self, references, batch_size=BATCH_SIZE):
+        """
+        Create a REF edge for each (vid, r, sv, ev) cross reference. Both
+        verses must already have nodes; a reference to a verse without one is
+        dropped.
+        Returns the number of references read and of edges created.
+        """
+        sent, stats = self.run_batches(
+            "UNWIND $rows AS ref "
+            "MATCH (a:Verse {id: ref[0]}), (b:Verse {id: ref[2]}) "
+            "CREATE (a)-[:REF {r: ref[1], ev: ref[3]}]->(b)",
+            references, batch_size)
+        return sent, int(stats["Relationships created"])
+
+    def delete(self):
+        """
+        Drop the whole graph.
+        """
+        if self.rc.main.exists(self.graph):
+            return self.rc.main.execute_command("GRAPH.DELETE", self.graph)
+
+    def cached(self, name, run, *args):
+        """
+        The result of run(), cached under graphquery:<graph>:<name>:<args>.
+        """
+        key = "%s%s:%s:%s" % (CACHE_PREFIX, self.graph, name, ":".join(str(a) for a in args))
+        result = self.rc.get_json_dump(key)
+        if result is None:
+            result = run()
+            self.rc.set_json_dump(key, result, CACHE_TTL)
+        return result
+
+    def related(self, vid, k=10):
+        """
+        The k cross references of a verse with the most votes, as
+        {"sv", "ev", "r"} dicts, best first. ev is 0 unless the reference
+        is a range.
+        """
+        def run():
+            rows = self.read(
+                "MATCH (:Verse {id: $id})-[ref:REF]->(b:Verse) "
+                "RETURN b.id, ref.ev, ref.r ORDER BY ref.r DESC, b.id LIMIT $k",
+                id=int(vid), k=int(k))
+            return [{"sv": sv, "ev": ev, "r": r} for sv, ev, r in rows]
+        return self.cached("related", run, vid, k)
+
+    def neighborhood(self, vid, hops=2, limit=100, min_votes=0):
+        """
+        The verses within hops cross references of a verse, following only
+        references with at least min_votes votes, as {"id", "hops"} dicts,
+        nearest first.
+        """
+        def run():
+            # variable length patterns can't take their bounds as parameters
+            rows = self.read(
+                "MATCH p = (a:Verse {id: $id})-[:REF*1..%d]->(b:Verse) "
+                "WHERE b <> a AND all(ref IN relationships(p) WHERE ref.r >= $min_votes) "
+                "RETURN b.id, min(length(p)) AS hops ORDER BY hops, b.id LIMIT $limit" % int(hops),
+                id=int(vid), min_votes=int(min_votes), limit=int(limit))
+            return [{"id": id, "hops": distance} for id, distance in rows]
+        return self.cached("neighborhood", run, vid, hops, limit, min_votes)
@@ -1,14 +1,100 @@
-key_files = {"version":"csv/bible_version_key.csv", 
+import argparse
+import csv
+import time
+
+from cross_reference_graph import CrossReferenceGraph, read_cross_references
+from redis_client import clear_cache_hash_keys, importer_lock, suppress_redis_bgsave
+from verse_source import verse_source
+from verse_store import verse_id
+
+key_files = {"version":"csv/bible_version_key.csv",
          "books_english":"csv/key_english.csv",
          "genre":"csv/key_genre_english.csv",
          "key_abbreviations_english":"csv/key_abbreviations_english.csv"
          }
-key_columns = {"version":["id","book_file_prefix", "abbreviation","language","name", "wiki", "unknown_1","domain", "unknown_2"], 
+key_columns = {"version":["id","book_file_prefix", "abbreviation","language","name", "wiki", "unknown_1","domain", "unknown_2"],
            "books_english":["id","book_name","testament","genre_id"],
            "genre":["id", "genre"],
            "key_abbreviations_english":["id","abbreviation"]
            }
 
+CROSS_REFERENCES = "cross_references.txt"
+# The translation whose verses become the graph's Verse nodes.
+VERSES = "txt/KJV"
+
 def load_keys():
+    """
+    The rows of every key table as dicts, named by key_columns.
+    """
+    keys = {}
     for key in key_files:
-        
\ No newline at end of file
+        with open(key_files[key], newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=",")
+            next(reader, None)
+            keys[key] = [dict(zip(key_columns[key], row)) for row in reader]
+    return keys
+
+def books(keys):
+    """
+    {id, name, testament, genre} for every book, for the Book nodes.
+    """
+    genres = {row["id"]: row["genre"] for row in keys["genre"]}
+    return [{"id": int(row["id"]), "name": row["book_name"], "testament": row["testament"],
+            "genre": genres.get(row["genre_id"], "")}
+        for row in keys["books_english"]]
+
+@importer_lock
+@suppress_redis_bgsave()
+@clear_cache_hash_keys
+def load_graph(references, verses, batch_size):
+    """
+    Rebuild the cross reference graph: Book nodes, a Verse node for every
+    verse of the verses translation and a REF edge for every cross reference.
+    """
+    graph = CrossReferenceGraph()
+    start = time.time()
+    graph.delete()
+    graph.create_indexes()
+
+    step = time.time()
+    count = graph.load_books(books(load_keys()), batch_size)
+    print("Loaded {} books in {:.1f}s".format(count, time.time() - step))
+
+    step = time.time()
+    count = graph.load_verses((verse_id(book, chapter, verse)
+        for book, chapter, verse, _ in verse_source(verses)), batch_size)
+    elapsed = time.time() - step
+    print("Loaded {} verses in {:.1f}s ({:.0f} rows/sec)".format(
+        count, elapsed, count / elapsed if elapsed else 0))
+
+    step = time.time()
+    sent, count = graph.load_references(read_cross_references(references), batch_size)
+    elapsed = time.time() - step
+    print("Loaded {} cross references in {:.1f}s ({:.0f} rows/sec)".format(
+        count, elapsed, sent / elapsed if elapsed else 0))
+    if sent > count:
+        print("Dropped {} of {} cross references to verses that aren't in {}".format(
+            sent - count, sent, verses))
+    print("Built graph {} in {:.1f}s".format(graph.graph, time.time() - start))
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Load the cross references into RedisGraph")
+    p.add_argument(
+        "--references", "-r", help="openbible.info cross_references.txt, or a "
+            "csv of vid,r,sv,ev rows",
+        default=CROSS_REFERENCES,
+    )
+    p.add_argument(
+        "--verses", "-v", help="Translation whose verses become the graph's nodes",
+        default=VERSES,
+    )
+    p.add_argument(
+        "--batch-size", help="Rows sent in each query",
+        type=int, default=1000,
+    )
+    args = p.parse_args()
+    load_graph(args.references, args.verses, args.batch_size)
+
+if __name__ == "__main__":
+    main()
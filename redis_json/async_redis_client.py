@@ -0,0 +1,620 @@
+import asyncio
+import contextlib
+import json
+import time
+import uuid
+
+# redis.asyncio ships with redis-py 4.2 and later, see requirements.txt.
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError, RedisError, ResponseError, TimeoutError
+
+from redis_client import (LOCK_ACQUIRE_SCRIPT, LOCK_RELEASE_SCRIPT, LOCK_RELEASED_SUFFIX,
+    LOCK_RENEW_SCRIPT, LOGGER, NP_CHUNK_SIZE, NP_HEADER, NP_MAGIC, POOL_HEALTH_CHECK_INTERVAL,
+    POOL_MAX_CONNECTIONS, POOL_TIMEOUT, ROOT_PATH, LockError, RedisConnection, RedisLock, batched,
+    decode_np_array, decode_np_header, encode_np_array, json_reply, lock_script, np_chunk_key,
+    np_encoder, pipeline_counters, prepend_lockname, redis_servers, verse_index_key, verse_key)
+from settings import CONFIG_DATA
+
+# The lock scripts' AsyncScript objects, by source. See lock_script().
+_lock_scripts = {}
+
+class AsyncRedisLock(RedisLock):
+    """
+    A RedisLock for the event loop: waiters await the release channel
+    instead of blocking a thread, and the lease is renewed by a task.
+
+        async with AsyncRedisLock(rc.main, "importer", renew=True) as lock:
+            ... lock.token ...
+    """
+    async def attempt(self, identifier):
+        return int(await lock_script(self.conn, LOCK_ACQUIRE_SCRIPT, _lock_scripts)(
+            keys=[self.key, self.fence_key], args=[identifier, self.lease()], client=self.conn))
+
+    async def acquire(self, blocking=True, timeout=None):
+        if self.identifier is not None:
+            raise RuntimeError("lock %s is already held" % self.key)
+        identifier = str(uuid.uuid4())
+        end = time.monotonic() + ((self.acquire_timeout if timeout is None else timeout) if blocking else 0)
+        result = await self.attempt(identifier)
+        pubsub = None
+        try:
+            while result <= 0:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if pubsub is None:
+                    # subscribe, then try again in case it was released in between
+                    pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                    await pubsub.subscribe(*self.channels())
+                elif result < 0:
+                    await wait_for_message(pubsub, min(remaining, -result / 1000.0))
+                result = await self.attempt(identifier)
+        finally:
+            if pubsub is not None:
+                await pubsub.reset()
+
+        self.identifier, self.token, self.lost = identifier, result, False
+        if self.renew_lease:
+            self.renewer = asyncio.ensure_future(self.keep_renewed())
+        return result
+
+    async def renew(self, lock_timeout=None):
+        if self.identifier is None:
+            return False
+        return bool(await lock_script(self.conn, LOCK_RENEW_SCRIPT, _lock_scripts)(
+            keys=[self.key], args=[self.identifier, self.lease(lock_timeout)], client=self.conn))
+
+    async def keep_renewed(self):
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3.0)
+            try:
+                if not await self.renew():
+                    self.lost = True
+                    LOGGER.warning("Lock %s:%s expired or was removed while it was held.",
+                        self.key, self.identifier)
+                    return
+            except RedisError as err:
+                LOGGER.warning("Could not renew lock %s:%s: %s", self.key, self.identifier, err)
+
+    async def release(self):
+        if self.renewer is not None:
+            self.renewer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.renewer
+            self.renewer = None
+        identifier, self.identifier = self.identifier, None
+        if identifier is None:
+            return False
+        return await release_lock(self.conn, self.name, identifier)
+
+    async def __aenter__(self):
+        if not await self.acquire():
+            raise LockError("could not acquire lock %s within %ss" % (self.key, self.acquire_timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+async def wait_for_message(pubsub, timeout):
+    """
+    The next message on a pubsub's channels, or None after timeout seconds.
+    """
+    end = time.monotonic() + timeout
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return None
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+        if message is not None:
+            while await pubsub.get_message(ignore_subscribe_messages=True, timeout=0) is not None:
+                pass
+            return message
+
+async def acquire_lock_with_timeout(conn, lockname, acquire_timeout=30, lock_timeout=30):
+    """
+    Create a cross process lock in redis cache with timeout, waiting on the
+    event loop rather than blocking a thread. Returns the lock's identifier
+    for release_lock(), or False. See AsyncRedisLock.
+    """
+    lock = AsyncRedisLock(conn, lockname, lock_timeout, acquire_timeout)
+    if await lock.acquire():
+        return lock.identifier
+    return False
+
+async def release_lock(conn, lockname, identifier):
+    """
+    Release a cross process lock acquired in redis cache, if it is still ours,
+    and wake its waiters.
+    """
+    ln = prepend_lockname(lockname)
+    return bool(await lock_script(conn, LOCK_RELEASE_SCRIPT, _lock_scripts)(
+        keys=[ln], args=[identifier, ln + LOCK_RELEASED_SUFFIX], client=conn))
+
+@contextlib.asynccontextmanager
+async def importer_lock(rc, lock_timeout=None):
+    """
+    Async counterpart of the importer_lock decorator. Yields True if the importer
+    lock was acquired, or False if another import is already in progress.
+    The lease is renewed while the block runs, and the lock is released when
+    it exits, or a lease after the process dies.
+
+        async with importer_lock(rc) as locked:
+            if locked:
+                ...
+    """
+    lock_to = lock_timeout or CONFIG_DATA["IMPORTER_LOCK_TIMEOUT"]
+    lock = AsyncRedisLock(rc.main, "importer", lock_timeout=lock_to, renew=True)
+    if not await lock.acquire(blocking=False):
+        LOGGER.info("Importer process was teminated because another import is alredy in progress.")
+        yield False
+        return
+    lock_id = lock.identifier
+    LOGGER.info("Importer lock aquired %s:%s with fencing token %s", lock.key, lock_id, lock.token)
+    try:
+        yield True
+    finally:
+        if await lock.release():
+            LOGGER.info("%s:%s lock released", lock.key, lock_id)
+        else:
+            LOGGER.warning("%s:%s lock had already expired or been removed.", lock.key, lock_id)
+
+@contextlib.asynccontextmanager
+async def suppress_redis_bgsave(rc, connection_name="redis_cache"):
+    """
+    Async counterpart of the suppress_redis_bgsave decorator: disables bgsave on
+    main for the duration of the block, then restores it and runs a bgsave.
+    """
+    config_save = "3600 1 1800 10"
+    await rc.main.config_set("save", "")
+    LOGGER.info("Disabled bgsave for %s", connection_name)
+    try:
+        yield
+    finally:
+        await rc.main.config_set("save", config_save)
+        LOGGER.info("Enabled bgsave... save:%s for %s", config_save, connection_name)
+        try:
+            await rc.main.bgsave()
+        except ResponseError:
+            LOGGER.info("BGSave already in progress")
+
+class AsyncRedisConnection(object):
+    """
+    An asyncio connection to the redis server with the data methods of
+    RedisConnection: json, keys, hashes, sets, lists, streams, numpy arrays,
+    passages and counters. Writes only go to main. Reads go to the replica
+    with the fewest requests in flight and fall back to main if no replica
+    answers. It has no read cache and records no method metrics; those stay
+    with RedisConnection.
+
+        async with AsyncRedisConnection() as rc:
+            verse = await rc.get_json_value("verse:01001001")
+    """
+    BATCH_SIZE = RedisConnection.BATCH_SIZE
+    SCAN_COUNT = RedisConnection.SCAN_COUNT
+    PRECISION = RedisConnection.PRECISION
+    sanitize_json_key = staticmethod(RedisConnection.sanitize_json_key)
+
+    def __init__(self, decode_responses=True, main_uri=None, replica_uri=None, **kwargs):
+        self.main_parts, self.replica_parts, username, password = redis_servers(main_uri, replica_uri)
+        if not self.replica_parts:
+            raise ValueError("no valid redis replica uri found.")
+        if not self.main_parts:
+            raise ValueError("no valid redis main uri found.")
+
+        def client(parts, decode_responses=decode_responses):
+            return aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+                host=parts[0],
+                port=int(parts[1]),
+                username=username,
+                password=password,
+                decode_responses=decode_responses,
+                max_connections=POOL_MAX_CONNECTIONS,
+                timeout=POOL_TIMEOUT,
+                health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+                **kwargs))
+        self.main = client(self.main_parts)
+        self.replicas = [client(parts) for parts in self.replica_parts]
+        # binary values such as numpy arrays need clients that don't decode
+        if decode_responses:
+            self.raw_main = client(self.main_parts, False)
+            self.raw_replicas = [client(parts, False) for parts in self.replica_parts]
+        else:
+            self.raw_main, self.raw_replicas = self.main, self.replicas
+        self.outstanding = [0] * len(self.replicas)
+        self.decode_responses = decode_responses
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        for client in {id(c): c for c in [self.main, self.raw_main] + self.replicas + self.raw_replicas}.values():
+            await client.connection_pool.disconnect()
+
+    async def route(self, request, raw=False):
+        """
+        The result of awaiting request(client) on the least busy replica,
+        failing over to the others and then to main.
+        """
+        replicas, main = (self.raw_replicas, self.raw_main) if raw else (self.replicas, self.main)
+        order = sorted(range(len(replicas)), key=lambda i: self.outstanding[i])
+        for i in order:
+            self.outstanding[i] += 1
+            try:
+                return await request(replicas[i])
+            except (ConnectionError, TimeoutError) as err:
+                LOGGER.warning("Redis replica %s failed, trying the next: %s",
+                    ":".join(self.replica_parts[i]), err)
+            finally:
+                self.outstanding[i] -= 1
+        return await request(main)
+
+    async def read(self, name, *args, **kwargs):
+        """
+        Run a read command on the least busy replica, failing over to the
+        others and then to main.
+        """
+        return await self.route(lambda client: getattr(client, name)(*args, **kwargs))
+
+    async def read_pipeline(self, commands, raw=False):
+        """
+        Run (command, *args) read commands in one pipeline on the least busy
+        replica, failing over like read(). Returns their replies.
+        """
+        async def request(client):
+            pipeline = client.pipeline(transaction=False)
+            for command in commands:
+                pipeline.execute_command(*command)
+            return await pipeline.execute()
+        return await self.route(request, raw)
+
+    # json
+
+    async def get_json_value(self, base, path=None):
+        """
+        retrieve a RedisJSON object from the base cache key or
+        from any node in the object using its x_path.
+        """
+        value = await self.read("execute_command", "JSON.GET", base, path or ROOT_PATH)
+        return json.loads(value) if value is not None else None
+
+    async def get_json_obj_keys(self, base, path="."):
+        return await self.read("execute_command", "JSON.OBJKEYS", base, path or ROOT_PATH)
+
+    async def set_json_value(self, base, key, value):
+        """
+        Save the value under the key name (key) at the redis cache location (base),
+        creating the base document first if it doesn't exist.
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        pipeline.execute_command("JSON.SET", base, ROOT_PATH,
+            json.dumps({"created": time.time()}), "NX")
+        pipeline.execute_command("JSON.SET", base, key or ROOT_PATH,
+            json.dumps(value, default=np_encoder))
+        return (await pipeline.execute())[-1]
+
+    async def del_json_value(self, base, path=ROOT_PATH):
+        return await self.main.execute_command("JSON.DEL", base, path)
+
+    async def get_json_dump(self, key_name):
+        json_string = await self.read("get", key_name)
+        if json_string:
+            return json.loads(json_string)
+        return None
+
+    async def set_json_dump(self, key_name, json_data, ex=None):
+        return await self.main.set(key_name, json.dumps(json_data, default=np_encoder), ex=ex)
+
+    # keys and strings
+
+    async def get_by_key(self, key):
+        return await self.read("get", key)
+
+    async def get_string(self, key):
+        return await self.read("get", key)
+
+    async def set_string(self, key, value):
+        return await self.main.set(key, value)
+
+    async def key_exist(self, key_name):
+        return await self.read("exists", key_name)
+
+    async def del_key(self, key):
+        return await self.main.delete(key)
+
+    async def del_keys(self, keys, batch_size=None, unlink=True):
+        """
+        Delete keys with one variadic UNLINK (or DEL) per batch.
+        Returns the number of keys removed by each batch.
+        """
+        command = self.main.unlink if unlink else self.main.delete
+        return [await command(*batch) for batch in batched(keys, batch_size or self.BATCH_SIZE)]
+
+    async def scan_keys(self, key_filter="*", count=None, type=None):
+        """
+        Iterate the keys matching key_filter on a replica with SCAN.
+        """
+        replica = self.replicas[min(range(len(self.replicas)), key=lambda i: self.outstanding[i])]
+        async for key in replica.scan_iter(key_filter, count or self.SCAN_COUNT, type):
+            yield key
+
+    async def get_passage(self, translation, start, end, batch_size=None):
+        """
+        The verse documents of a translation with ids from start to end
+        inclusive, in order. See RedisConnection.get_passage.
+        """
+        return (await self.get_passages(translation, [(start, end)], batch_size))[0]
+
+    async def get_passages(self, translation, spans, batch_size=None):
+        """
+        The verse documents of each (start, end) span of verse ids, with one
+        pipeline of ZRANGEBYSCOREs and one of JSON.MGETs for all of them.
+        """
+        if not spans:
+            return []
+        spans_ids = await self.read_pipeline([("ZRANGEBYSCORE", verse_index_key(translation), start, end)
+            for start, end in spans])
+        commands, counts = [], []
+        for ids in spans_ids:
+            batches = list(batched(ids, batch_size or self.BATCH_SIZE))
+            commands += [["JSON.MGET"] + [verse_key(translation, int(vid)) for vid in batch] + [ROOT_PATH]
+                for batch in batches]
+            counts.append(len(batches))
+        results = iter(await self.read_pipeline(commands) if commands else [])
+        passages = []
+        for count in counts:
+            passages.append([json_reply(verse) for _, verses in zip(range(count), results)
+                for verse in verses if verse is not None])
+        return passages
+
+    async def get_keys(self, key_filter="*", count=None, type=None):
+        return [key async for key in self.scan_keys(key_filter, count, type)]
+
+    async def get_key_exists(self, key_filter="*", count=None, type=None):
+        if not type and not RedisConnection.GLOB_CHARACTERS.search(key_filter):
+            return await self.key_exist(key_filter) > 0
+        async for key in self.scan_keys(key_filter, count, type):
+            return True
+        return False
+
+    async def save(self, bg=True):
+        if bg:
+            await self.main.bgsave()
+        else:
+            await self.main.save()
+
+    # numpy arrays
+
+    async def get_np_array(self, key):
+        """
+        The numpy array stored at key by set_np_array, or None.
+        """
+        encoded = await self.route(lambda client: client.get(key), raw=True)
+        if encoded is None:
+            return None
+        chunks = None
+        count = decode_np_header(encoded)[3]
+        if count:
+            chunks = await self.route(lambda client: client.mget(
+                [np_chunk_key(key, i) for i in range(count)]), raw=True)
+        return decode_np_array(encoded, chunks)
+
+    async def set_np_array(self, key, np_array_numeric, compression=None, ex=None, chunk_size=None):
+        """
+        Store a numpy array at key. See RedisConnection.set_np_array.
+        """
+        header, chunks = encode_np_array(np_array_numeric, compression, chunk_size or NP_CHUNK_SIZE)
+        old_header = await self.raw_main.getrange(key, 0, NP_HEADER.size - 1)
+        old_count = 0
+        if len(old_header) == NP_HEADER.size and old_header[:4] == NP_MAGIC:
+            old_count = NP_HEADER.unpack(old_header)[4]
+        count = len(chunks) if len(chunks) > 1 else 0
+
+        pipeline = self.raw_main.pipeline(transaction=True)
+        if count:
+            pipeline.set(key, header, ex=ex)
+            for i, chunk in enumerate(chunks):
+                pipeline.set(np_chunk_key(key, i), chunk, ex=ex)
+        else:
+            pipeline.set(key, header)
+            pipeline.append(key, chunks[0])
+            if ex:
+                pipeline.expire(key, ex)
+        stale = [np_chunk_key(key, i) for i in range(count, old_count)]
+        if stale:
+            pipeline.unlink(*stale)
+        await pipeline.execute()
+        return 1
+
+    # hashes
+
+    async def get_hash_key_value(self, hash_name, key_name):
+        return await self.read("hget", hash_name, key_name)
+
+    async def get_hash_all(self, hash_name):
+        return await self.read("hgetall", hash_name)
+
+    get_hash = get_hash_all
+
+    async def get_keys_for_hash(self, hash_name):
+        return await self.read("hkeys", hash_name)
+
+    async def get_hash_key_exists(self, hash_name, key_name):
+        return await self.read("hexists", hash_name, key_name)
+
+    async def get_hash_key_count(self, hash_name):
+        return await self.read("hlen", hash_name)
+
+    async def set_hash_value_by_key(self, hash_name, key, value):
+        return await self.main.hset(hash_name, key, value)
+
+    async def set_hash_values(self, key, d_values):
+        return await self.main.hset(key, mapping=d_values)
+
+    async def remove_hash_value_by_key(self, hash_name, key):
+        return await self.main.hdel(hash_name, key)
+
+    async def get_application_endpoint(self, name):
+        return await self.get_hash_key_value("endpoints", name)
+
+    async def set_application_endpoint(self, name, value):
+        return await self.set_hash_value_by_key("endpoints", name, value)
+
+    async def get_application_endpoint_names(self):
+        return await self.get_keys_for_hash("endpoints")
+
+    # sets
+
+    async def add_to_set(self, set_name, value):
+        return await self.main.sadd(set_name, value)
+
+    async def add_values_to_set(self, set_name, values):
+        values = list(values)
+        if values:
+            await self.main.sadd(set_name, *values)
+        return True
+
+    async def get_set_members(self, name):
+        return set(await self.read("smembers", name))
+
+    async def get_in_set(self, set_name, value):
+        return await self.read("sismember", set_name, value)
+
+    async def remove_values_from_set(self, set_name, values):
+        values = list(values)
+        if values:
+            await self.main.srem(set_name, *values)
+        return True
+
+    remove_from_set = remove_values_from_set
+
+    async def pop_set(self, set_name, count=1):
+        return await self.main.spop(set_name, count)
+
+    # lists
+
+    async def add_list(self, key, values):
+        """
+        Create a list and add values or just append the values if the list already exists
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        for batch in batched(reversed(values), self.BATCH_SIZE):
+            pipeline.lpush(key, *batch)
+        await pipeline.execute()
+        return True
+
+    async def get_list(self, key):
+        if await self.key_exist(key):
+            return await self.read("lrange", key, 0, -1)
+        return None
+
+    # streams
+
+    async def x_add(self, stream_name, d_values, maxlen=None, approximate=True):
+        if d_values is None:
+            raise ValueError("No items specified to save to log.")
+        return await self.main.xadd(stream_name, d_values, maxlen=maxlen, approximate=approximate)
+
+    async def x_autoclaim(self, stream_name, group_name, consumer_name, min_idle_time, start="0-0", count=None):
+        """
+        Claim entries pending for more than min_idle_time milliseconds for
+        consumer_name. Returns the id to continue scanning from and the
+        claimed (id, fields) entries, as RedisConnection.x_autoclaim does.
+        """
+        args = ["XAUTOCLAIM", stream_name, group_name, consumer_name, int(min_idle_time), start]
+        if count:
+            args += ["COUNT", count]
+        reply = await self.main.execute_command(*args)
+        entries = []
+        for entry in reply[1]:
+            if entry and entry[1] is not None:
+                fields = entry[1]
+                if not isinstance(fields, dict):
+                    fields = dict(zip(fields[::2], fields[1::2]))
+                entries.append((entry[0], fields))
+        return reply[0], entries
+
+    async def x_len(self, stream_name):
+        return await self.read("xlen", stream_name)
+
+    async def x_del(self, stream_name, id):
+        return await self.main.xdel(stream_name, id)
+
+    async def x_group_create(self, stream_name, group_name, mkstream=True, id="$"):
+        """
+        Create a consumer group reading the stream from after id. Returns
+        False if it already exists.
+        """
+        try:
+            return await self.main.xgroup_create(stream_name, group_name, id=id, mkstream=mkstream)
+        except ResponseError as err:
+            if not str(err).startswith("BUSYGROUP"):
+                raise
+            return False
+
+    async def x_group_delete_consumer(self, stream_name, group_name, consumer_name):
+        return await self.main.xgroup_delconsumer(stream_name, group_name, consumer_name)
+
+    async def x_group_delete(self, stream_name, group_name):
+        if await self.get_key_exists(stream_name):
+            return await self.main.xgroup_destroy(stream_name, group_name)
+
+    async def x_pending(self, stream_name, group_name):
+        return await self.read("xpending", stream_name, group_name)
+
+    async def x_read(self, streams:dict, count=8, block=5000):
+        """
+        Wait on multiple streams for new data without blocking the event loop.
+        """
+        return await self.read("xread", streams, count, block)
+
+    async def x_read_group(self, group_name, consumer_name, streams, count=None, block=None, noack=False):
+        return await self.main.xreadgroup(group_name, consumer_name, streams, count, block, noack)
+
+    async def x_ack(self, stream_name, group_name, l_ids):
+        """
+        Acknowledge ids in one pipeline. Returns whether each id was
+        acknowledged, keyed by id.
+        """
+        l_ids = list(l_ids)
+        pipeline = self.main.pipeline(transaction=False)
+        for id in l_ids:
+            pipeline.xack(stream_name, group_name, id)
+        return dict(zip(l_ids, await pipeline.execute()))
+
+    async def x_ack_batch(self, stream_name, group_name, l_ids, batch_size=None):
+        """
+        Acknowledge ids with one variadic XACK per batch, sent in a single pipeline.
+        Returns the number of messages acknowledged by each batch.
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        for batch in batched(l_ids, batch_size or self.BATCH_SIZE):
+            pipeline.xack(stream_name, group_name, *batch)
+        return await pipeline.execute()
+
+    async def x_range(self, log_name, min_ts="-", max_ts="+", count_items=None):
+        return await self.read("xrange", log_name, min_ts, max_ts, count_items)
+
+    async def x_rev_range(self, log_name, min_ts="+", max_ts="-", count_items=1):
+        return await self.read("xrevrange", log_name, min_ts, max_ts, count_items)
+
+    async def x_trim(self, stream_name, maxlen, approximate=True):
+        return await self.main.xtrim(stream_name, maxlen, approximate)
+
+    # sorted sets and counters
+
+    async def zset_add_increment(self, name, key):
+        await self.main.zadd(name, {key: 1}, incr=True)
+
+    async def zset_add_index(self, name, idx, value):
+        await self.main.zadd(name, {idx: value})
+
+    async def zset_remove(self, name, values):
+        await self.main.zrem(name, values)
+
+    async def update_counter(self, name, count=1, now=None):
+        pipeline = self.main.pipeline()
+        pipeline_counters(pipeline, {(name, now or time.time()): count})
+        await pipeline.execute()
@@ -1,41 +1,149 @@
-import pandas as pd
+import argparse
 import csv
-key_files = {"version":"csv/bible_version_key.csv", 
+import multiprocessing
+import os
+import sys
+import time
+
+from redis_client import (ROOT_PATH, clear_cache_hash_keys, get_redis_connection,
+    importer_lock, suppress_redis_bgsave, verse_key)
+
+# the verse sources are shared with pdf_builder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pdf_builder"))
+from verse_source import translation_sources, verse_source
+from verse_store import verse_id
+
+key_files = {"version":"csv/bible_version_key.csv",
          "books_english":"csv/key_english.csv",
          "genre":"csv/key_genre_english.csv",
          "key_abbreviations_english":"csv/key_abbreviations_english.csv"
          }
-key_columns = {"version":["id","book_file_prefix", "abbreviation","language","name", "EMPTY", "wiki", "unknown_1","domain", "unknown_2"], 
+key_columns = {"version":["id","book_file_prefix", "abbreviation","language","name", "EMPTY", "wiki", "unknown_1","domain", "unknown_2"],
            "books_english":["id","book_name","testament","genre_id"],
            "genre":["id", "genre"],
            "key_abbreviations_english":["id","abbreviation", "book_id", "NONE"]
            }
 
-def load_version() -> dict:
-    version = []
-    with open(key_files["version"], newline='') as csvfile:
+CORPUS = "txt"
+# Each key table is one json document, "key:<csv name>", keyed by row id.
+KEY_PREFIX = "key:"
+TRANSLATIONS = "translations"
+BATCH_SIZE = 1000
+
+def load_key_table(name) -> list:
+    """
+    The rows of a key table csv as dicts, named by key_columns.
+    """
+    table = []
+    with open(key_files[name], newline='') as csvfile:
         reader = csv.reader(csvfile, delimiter=",")
-        row_c = 0
-        columns = key_columns["version"]
+        columns = key_columns[name]
+        next(reader, None)
         for row in reader:
-            r_data = {}
-            if row_c > 0:
-                
-                for i in range(len(columns)):
-                    r_data[columns[i]] = row[i]
-                    
-                version.append(r_data)
-            row_c += 1
-        return version
-    
-    
-    
-    
+            table.append(dict(zip(columns, row)))
+        return table
+
+def load_version() -> list:
+    return load_key_table("version")
+
+def verse_documents(source, vids=None):
+    """
+    A (key, path, document) triple for every verse of a translation, for
+    RedisConnection.set_json_values(). The verse ids are appended to vids as
+    they go, so the source is only read once for the verse index too.
+    """
+    for book, chapter, verse, text in source:
+        vid = verse_id(book, chapter, verse)
+        if vids is not None:
+            vids.append(vid)
+        yield verse_key(source.name, vid), ROOT_PATH, {
+            "id": vid, "b": int(book), "c": int(chapter), "v": int(verse), "t": text}
+
+def import_key_tables(batch_size=BATCH_SIZE):
+    rc = get_redis_connection()
+    documents = []
+    rows = 0
+    for name, path in key_files.items():
+        table = load_key_table(name)
+        rows += len(table)
+        key = KEY_PREFIX + os.path.splitext(os.path.basename(path))[0]
+        documents.append((key, ROOT_PATH, {row["id"]: row for row in table}))
+    rc.set_json_values(documents, batch_size)
+    return rows
+
+def import_translation(job):
+    """
+    Load one translation's verses and their verse index, a pipelined batch
+    at a time. Runs in a worker process.
+    """
+    path, batch_size = job
+    source = verse_source(path)
+    start = time.time()
+    rc = get_redis_connection()
+    vids = []
+    loaded = rc.set_json_values(verse_documents(source, vids), batch_size)
+    rc.index_verses(source.name, vids, batch_size)
+    rc.add_to_set(TRANSLATIONS, source.name)
+    return source.name, loaded, time.time() - start
+
+@importer_lock
+@suppress_redis_bgsave()
+@clear_cache_hash_keys
+def import_all(paths, jobs=None, batch_size=BATCH_SIZE):
+    """
+    Load the key tables and the verses of every translation in paths, with
+    the translations spread over a pool of jobs worker processes.
+    """
+    start = time.time()
+    rows = import_key_tables(batch_size)
+    print("Loaded {} key table rows".format(rows))
+
+    work = [(path, batch_size) for path in paths]
+    if jobs == 1 or len(work) < 2:
+        results = map(import_translation, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(min(jobs or os.cpu_count(), len(work)))
+        results = pool.imap_unordered(import_translation, work)
+    try:
+        for name, loaded, elapsed in results:
+            rows += loaded
+            print("Loaded {} verses of {} in {:.1f}s ({:.0f} rows/sec)".format(
+                loaded, name, elapsed, loaded / elapsed if elapsed else 0))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    print("Loaded {} rows in {:.1f}s ({:.0f} rows/sec)".format(
+        rows, elapsed, rows / elapsed if elapsed else 0))
+    return rows
+
 def main():
-    if "__main__" in __name__:
-        print(load_version())
-            
-        
-main()
-        
-        
\ No newline at end of file
+    p = argparse.ArgumentParser(
+        description="Load the key tables and translations into RedisJSON")
+    p.add_argument(
+        "sources", help="Verse csv files, txt/md translation directories or verse stores",
+        nargs="*",
+    )
+    p.add_argument(
+        "--batch", "-b", help="Load every translation in this corpus directory "
+            "(ie. txt or md), unless sources are given",
+        default=CORPUS,
+    )
+    p.add_argument(
+        "--jobs", "-j", help="Worker processes (default: one per CPU)",
+        type=int, default=None,
+    )
+    p.add_argument(
+        "--batch-size", help="Documents written per pipeline",
+        type=int, default=BATCH_SIZE,
+    )
+    args = p.parse_args()
+
+    paths = args.sources or [source.path for source in translation_sources(args.batch)]
+    import_all(paths, args.jobs, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,1064 @@
+import atexit
+import bisect
+import collections
+import functools
+import inspect
+import itertools
 import json
+import logging
 import math
 import numpy as np
+import queue
 import random
 import re
 import redis
+import threading
 import time
 import struct
 import uuid
+import zlib
 
 import numpy as np
-from datetime import datetime
 from redis.exceptions import ResponseError
-from rejson import Client as RejClient, Path
 
 from settings import CONFIG_DATA
 
-LOGGER = object()
-LOGGER.warning = lambda x : print(x)
-LOGGER.info = lambda x : print(x)
+LOGGER = logging.getLogger(__name__)
+
+ROOT_PATH = "."
+
+# Connection pools are shared by every client of the same server in a process.
+POOL_MAX_CONNECTIONS = CONFIG_DATA.get("REDIS_POOL_MAX_CONNECTIONS", 50)
+# Seconds to wait for a free connection when a pool is exhausted.
+POOL_TIMEOUT = CONFIG_DATA.get("REDIS_POOL_TIMEOUT", 20)
+# Connections idle for longer than this are PINGed before they are reused.
+POOL_HEALTH_CHECK_INTERVAL = CONFIG_DATA.get("REDIS_POOL_HEALTH_CHECK_INTERVAL", 30)
+# Connections idle for longer than this are closed by reap_idle_connections().
+POOL_IDLE_TIMEOUT = CONFIG_DATA.get("REDIS_POOL_IDLE_TIMEOUT", 300)
+# Seconds a replica is left out of the read rotation after a connection error.
+REPLICA_EJECT_SECONDS = CONFIG_DATA.get("REDIS_REPLICA_EJECT_SECONDS", 30)
+# Options for RedisConnection.enable_read_cache(), ie. {"max_entries": 10000,
+# "ttl": 60, "tracking": True}. The read cache is off when this is not set.
+READ_CACHE = CONFIG_DATA.get("REDIS_READ_CACHE")
+# numpy arrays with a larger payload are split over several keys, well inside
+# redis's 512MB value limit and without one huge value blocking the server.
+NP_CHUNK_SIZE = CONFIG_DATA.get("REDIS_NP_CHUNK_SIZE", 64 * 1024 * 1024)
+# Options for RedisConnection.enable_metrics(), ie. {"interval": 10}. Method
+# metrics are off when this is not set.
+METRICS = CONFIG_DATA.get("REDIS_METRICS")
+# Seconds between flushes of the in-process metrics to redis.
+METRICS_INTERVAL = 10
+
+# magic, compression, ndim, dtype length, chunk count, payload bytes; followed
+# by the dtype string and the shape, padded so the payload starts 16 aligned.
+NP_MAGIC = b"NPA1"
+NP_HEADER = struct.Struct(">4sBBBxIQ")
+NP_ALIGN = 16
+NP_COMPRESSION = {None: 0, "zlib": 1}
+
+# Each verse is a json document, indexed per translation by a sorted set of
+# BBCCCVVV ids scored by the id itself.
+VERSE_KEY = "verse:%s:%08d"
+VERSE_INDEX = "verseidx:%s"
+
+# Counters are a hash per precision and name, count:<precision>:<name>, of
+# sample start time to count; count:known: is a sorted set of <precision>:<name>.
+COUNTER_PRECISION = [1, 60, 300, 3600, 18000, 86400]
+COUNTER_PREFIX = "count:"
+COUNTER_KNOWN = "count:known:"
+# Upper bounds in milliseconds of the latency histogram buckets; slower calls
+# are counted in "inf".
+LATENCY_BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+LATENCY_LABELS = ["%g" % bound for bound in LATENCY_BUCKETS] + ["inf"]
+
+# A lock's fencing token counter and the channel its releases are published on.
+LOCK_FENCE_SUFFIX = ":fence"
+LOCK_RELEASED_SUFFIX = ":released"
+# Takes the lock for ARGV[2] ms and returns the next fencing token, or minus
+# the ms left on the holder's lease. A lock left without an expiry is given one.
+LOCK_ACQUIRE_SCRIPT = """
+if redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return redis.call("incr", KEYS[2])
+end
+local ttl = redis.call("pttl", KEYS[1])
+if ttl == -1 then
+    redis.call("pexpire", KEYS[1], ARGV[2])
+    ttl = tonumber(ARGV[2])
+end
+return -math.max(ttl, 0)
+"""
+# Deletes the lock only if it still holds our identifier, and wakes the waiters.
+LOCK_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("del", KEYS[1])
+    redis.call("publish", ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+# Restarts the lease, only if the lock still holds our identifier.
+LOCK_RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_pools = {}
+_connections = {}
+# The lock scripts' Script objects, by source. See lock_script().
+_lock_scripts = {}
+_pools_lock = threading.Lock()
+_last_reap = time.time()
+_metrics = None
+# Whether a RedisConnection method is being recorded on this thread.
+_instrumenting = threading.local()
+
+class LockError(Exception):
+    """A lock could not be acquired."""
 
 def np_encoder(object):
     if isinstance(object, np.generic):
         return object.item()
 
+def verse_key(translation, vid):
+    return VERSE_KEY % (translation, vid)
+
+def verse_index_key(translation):
+    return VERSE_INDEX % translation
+
+def np_chunk_key(key, chunk):
+    return "%s:chunk:%s" % (key, chunk)
+
+def encode_np_array(array, compression=None, chunk_size=NP_CHUNK_SIZE, level=1):
+    """
+    Encode a numpy array as a header and its payload split into chunk_size
+    memoryviews. Without compression the chunks are views of the array's own
+    memory (of a contiguous copy if it wasn't C contiguous). The header's chunk
+    count is 0 when the payload fits in one chunk and is stored with it.
+    """
+    if compression not in NP_COMPRESSION:
+        raise ValueError("unknown compression %s" % compression)
+    if array.dtype.hasobject:
+        raise ValueError("arrays of python objects can't be stored")
+    payload = memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    if compression == "zlib":
+        payload = memoryview(zlib.compress(payload, level))
+    size = len(payload)
+    chunks = [payload[i:i + chunk_size] for i in range(0, size, chunk_size)] or [payload]
+    dtype = array.dtype.str.encode()
+    header = NP_HEADER.pack(NP_MAGIC, NP_COMPRESSION[compression], array.ndim, len(dtype),
+        len(chunks) if len(chunks) > 1 else 0, size)
+    header += dtype + struct.pack(">%dQ" % array.ndim, *array.shape)
+    header += b"\0" * (-len(header) % NP_ALIGN)
+    return header, chunks
+
+def decode_np_header(value):
+    """
+    The (compression, dtype, shape, chunk count, payload bytes, payload offset)
+    of an encoded array.
+    """
+    magic, compression, ndim, dtype_len, chunks, size = NP_HEADER.unpack_from(value)
+    if magic != NP_MAGIC:
+        raise ValueError("not an encoded numpy array")
+    offset = NP_HEADER.size
+    dtype = np.dtype(bytes(value[offset:offset + dtype_len]).decode())
+    offset += dtype_len
+    shape = struct.unpack_from(">%dQ" % ndim, value, offset)
+    offset += 8 * ndim
+    offset += -offset % NP_ALIGN
+    compression = {code: name for name, code in NP_COMPRESSION.items()}[compression]
+    return compression, dtype, shape, chunks, size, offset
+
+def decode_np_array(value, chunks=None):
+    """
+    Decode an array from the value written under its key and, for a chunked
+    array, the values of its chunk keys in order. An uncompressed array stored
+    in one value is a read-only view of value, made with np.frombuffer
+    without copying.
+    """
+    compression, dtype, shape, count, size, offset = decode_np_header(value)
+    if count:
+        if chunks is None or len(chunks) != count or any(c is None for c in chunks):
+            raise ValueError("chunks of the array are missing")
+        payload = bytearray(size)
+        pos = 0
+        for chunk in chunks:
+            payload[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    else:
+        payload = memoryview(value)[offset:offset + size]
+    if compression == "zlib":
+        payload = zlib.decompress(payload)
+    return np.frombuffer(payload, dtype=dtype).reshape(shape)
+
+def json_reply(value):
+    return None if value is None else json.loads(value)
+
+class JsonCommands(object):
+    """
+    The RedisJSON commands, sent as they are. The replies are decoded by the
+    response callbacks a JsonClient sets, so they work in pipelines too.
+    """
+    def jsonget(self, name, path=ROOT_PATH):
+        return self.execute_command("JSON.GET", name, path)
+
+    def jsonmget(self, path, *names):
+        return self.execute_command("JSON.MGET", *(names + (path,)))
+
+    def jsonset(self, name, path, obj, nx=False, xx=False):
+        args = [name, path, json.dumps(obj, default=np_encoder)]
+        if nx:
+            args.append("NX")
+        elif xx:
+            args.append("XX")
+        return self.execute_command("JSON.SET", *args)
+
+    def jsondel(self, name, path=ROOT_PATH):
+        return self.execute_command("JSON.DEL", name, path)
+
+    def jsonobjkeys(self, name, path=ROOT_PATH):
+        return self.execute_command("JSON.OBJKEYS", name, path)
+
+class JsonPipeline(JsonCommands, redis.client.Pipeline):
+    pass
+
+class JsonClient(JsonCommands, redis.Redis):
+    """
+    A redis client with the RedisJSON commands, in place of rejson, which
+    pins redis-py 3.5.
+    """
+    JSON_CALLBACKS = {
+        "JSON.GET": json_reply,
+        "JSON.MGET": lambda values: [json_reply(value) for value in values],
+        "JSON.SET": lambda reply: reply in ("OK", b"OK"),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for command, callback in self.JSON_CALLBACKS.items():
+            self.set_response_callback(command, callback)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return JsonPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class PooledConnection(redis.Connection):
+    """
+    A pooled connection that remembers when it was last used, so idle
+    connections can be reaped.
+    """
+    last_used = 0
+
+    def send_packed_command(self, command, check_health=True):
+        self.last_used = time.time()
+        return super().send_packed_command(command, check_health)
+
+def connection_pool(host, port, decode_responses=True, **kwargs):
+    """
+    The process-wide connection pool for a server, created on first use.
+    Pools are bounded by POOL_MAX_CONNECTIONS and block for up to POOL_TIMEOUT
+    seconds when every connection is busy.
+    """
+    key = (host, int(port), decode_responses, repr(sorted(kwargs.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = redis.BlockingConnectionPool(
+                connection_class=PooledConnection,
+                max_connections=POOL_MAX_CONNECTIONS,
+                timeout=POOL_TIMEOUT,
+                health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+                host=host,
+                port=int(port),
+                decode_responses=decode_responses,
+                **kwargs)
+            _pools[key] = pool
+        return pool
+
+def reap_idle_connections(max_idle=POOL_IDLE_TIMEOUT):
+    """
+    Disconnect pooled connections that have not been used for max_idle seconds.
+    A reaped connection stays in its pool and reconnects on its next use.
+    """
+    global _last_reap
+    _last_reap = time.time()
+    cutoff = _last_reap - max_idle
+    reaped = 0
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        idle = []
+        while True:
+            try:
+                idle.append(pool.pool.get_nowait())
+            except queue.Empty:
+                break
+        for connection in idle:
+            if connection is not None and connection._sock is not None \
+                    and connection.last_used < cutoff:
+                connection.disconnect()
+                reaped += 1
+            pool.pool.put_nowait(connection)
+    if reaped:
+        LOGGER.info("Reaped %s idle redis connections", reaped)
+    return reaped
+
+def redis_servers(main_uri=None, replica_uri=None):
+    """
+    The [host, port] of main, a [host, port] for each replica (shuffled), and
+    the username and password, from the arguments or CONFIG_DATA.
+    """
+    if not "REDIS_REPLICAS" in CONFIG_DATA and not replica_uri:
+        raise KeyError("REDIS_REPLICAS not found in config")
+    if not "REDIS_MAIN_SERVER" in CONFIG_DATA and not main_uri:
+        raise KeyError("REDIS_MAIN_SERVER not found in config")
+    if not "REDIS_CACHE_PASSWORD" in CONFIG_DATA:
+        raise KeyError("REDIS_CACHE_PASSWORD is not found in config")
+    password = CONFIG_DATA["REDIS_CACHE_PASSWORD"]  if not CONFIG_DATA["REDIS_CACHE_PASSWORD"] == "" else None
+    username = None
+    if not password is None:
+        username = "default"
+    replicas = replica_uri or CONFIG_DATA["REDIS_REPLICAS"]
+    main = main_uri or CONFIG_DATA["REDIS_MAIN_SERVER"][0]
+    replica_parts = []
+    main_parts = []
+    if isinstance(replicas, str):
+        replicas = [replicas]
+    if isinstance(replicas, (list, tuple)):
+        replica_parts = [r.split(':') for r in replicas if r]
+        # spread idle processes over the replicas rather than all starting on the first
+        random.shuffle(replica_parts)
+
+    if isinstance(main, list):
+        # if we have a list of main instances just take the first one provided
+        main = main[0]
+    if isinstance(main, str):
+        main_parts = main.split(':')
+    return main_parts, replica_parts, username, password
+
+def get_redis_connection(main_uri=None, replica_uri=None, decode_responses=True):
+    """
+    The process-wide RedisConnection for a main and replica, created on first use.
+    Use this rather than RedisConnection() so clients share their connection
+    pools instead of opening new connections for every call.
+    """
+    if isinstance(replica_uri, list):
+        replica_uri = tuple(replica_uri)
+    key = (main_uri, replica_uri, decode_responses)
+    with _pools_lock:
+        rc = _connections.get(key)
+    if rc is None:
+        rc = RedisConnection(decode_responses=decode_responses,
+            main_uri=main_uri,
+            replica_uri=list(replica_uri) if isinstance(replica_uri, tuple) else replica_uri)
+        with _pools_lock:
+            rc = _connections.setdefault(key, rc)
+    if time.time() - _last_reap > POOL_IDLE_TIMEOUT:
+        reap_idle_connections()
+    return rc
+
+class ReplicaRouter(object):
+    """
+    Spreads reads over every replica. Each call goes to the healthy replica
+    with the fewest requests in flight, then the lowest average latency.
+    A replica that fails with a connection error or timeout is ejected for
+    REPLICA_EJECT_SECONDS and the call is retried on the next one, falling
+    back to main when no replica is left.
+    Any client method can be called on the router as if it were a client.
+    Iterators such as scan_iter stay on one replica while they are consumed,
+    and pipelines are only routed when they are executed.
+    """
+    # Weight of the newest sample in each replica's moving average latency.
+    LATENCY_ALPHA = 0.2
+    # Seconds for an unrefreshed average latency to halve, so a replica whose
+    # samples were slow, ie. while it connected, is tried again before long.
+    LATENCY_HALF_LIFE = 5
+
+    def __init__(self, replicas, fallback, names=None):
+        self.replicas = list(replicas)
+        self.fallback = fallback
+        self.names = names or [str(i) for i in range(len(self.replicas))]
+        self.lock = threading.Lock()
+        self.outstanding = [0] * len(self.replicas)
+        self.requests = [0] * len(self.replicas)
+        self.errors = [0] * len(self.replicas)
+        self.latency = [0.0] * len(self.replicas)
+        self.sampled = [0.0] * len(self.replicas)
+        self.ejected_until = [0.0] * len(self.replicas)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        attr = getattr(self.replicas[0], name)
+        if not callable(attr):
+            return attr
+        if name == "pipeline":
+            return functools.partial(RoutedPipeline, self)
+        if inspect.isgeneratorfunction(attr):
+            return functools.partial(self.call_iter, name)
+        return functools.partial(self.call, name)
+
+    def decayed_latency(self, i, now):
+        """
+        The average latency of a replica, halved for every LATENCY_HALF_LIFE
+        seconds since it was last sampled.
+        """
+        return self.latency[i] * 0.5 ** ((now - self.sampled[i]) / self.LATENCY_HALF_LIFE)
+
+    def candidates(self):
+        """
+        The healthy replicas, best first.
+        """
+        now = time.time()
+        with self.lock:
+            healthy = [i for i in range(len(self.replicas)) if self.ejected_until[i] <= now]
+            return sorted(healthy, key=lambda i: (self.outstanding[i], self.decayed_latency(i, now)))
+
+    def begin(self, i):
+        with self.lock:
+            self.outstanding[i] += 1
+            self.requests[i] += 1
+
+    def end(self, i, elapsed=None):
+        """
+        A request to a replica is over, taking elapsed seconds if it succeeded.
+        """
+        now = time.time()
+        with self.lock:
+            self.outstanding[i] -= 1
+            if elapsed is None:
+                return
+            if self.latency[i]:
+                self.latency[i] = self.decayed_latency(i, now)
+                self.latency[i] += self.LATENCY_ALPHA * (elapsed - self.latency[i])
+            else:
+                self.latency[i] = elapsed
+            self.sampled[i] = now
+
+    def eject(self, i, err):
+        with self.lock:
+            self.errors[i] += 1
+            self.ejected_until[i] = time.time() + REPLICA_EJECT_SECONDS
+        LOGGER.warning("Ejected redis replica %s for %ss: %s",
+            self.names[i], REPLICA_EJECT_SECONDS, err)
+
+    def route(self, request):
+        """
+        The result of request(client) on the best replica, failing over to
+        the others and then to main.
+        """
+        for i in self.candidates():
+            self.begin(i)
+            start = time.time()
+            try:
+                result = request(self.replicas[i])
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as err:
+                self.end(i)
+                self.eject(i, err)
+                continue
+            except Exception:
+                self.end(i)
+                raise
+            self.end(i, time.time() - start)
+            return result
+        return request(self.fallback)
+
+    def call(self, name, *args, **kwargs):
+        """
+        Run a client method on the best replica, failing over to the others
+        and then to main.
+        """
+        return self.route(lambda client: getattr(client, name)(*args, **kwargs))
+
+    def call_iter(self, name, *args, **kwargs):
+        """
+        Iterate a client generator method, such as scan_iter, on the best
+        replica. The first item is timed as the replica's latency, since it
+        takes the first round trip. If the replica fails part way the
+        iteration starts again on the next one, skipping the items already
+        yielded.
+        """
+        seen = set()
+        for i in self.candidates():
+            self.begin(i)
+            elapsed = None
+            try:
+                start = time.time()
+                for item in getattr(self.replicas[i], name)(*args, **kwargs):
+                    if elapsed is None:
+                        elapsed = time.time() - start
+                    if item not in seen:
+                        seen.add(item)
+                        yield item
+                if elapsed is None:
+                    elapsed = time.time() - start
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as err:
+                self.end(i)
+                self.eject(i, err)
+                continue
+            except BaseException:
+                self.end(i)
+                raise
+            self.end(i, elapsed)
+            return
+        for item in getattr(self.fallback, name)(*args, **kwargs):
+            if item not in seen:
+                yield item
+
+    def stats(self):
+        """
+        Requests, errors, requests in flight, average latency and health of
+        each replica.
+        """
+        now = time.time()
+        with self.lock:
+            return {self.names[i]: {
+                    "requests": self.requests[i],
+                    "errors": self.errors[i],
+                    "outstanding": self.outstanding[i],
+                    "latency_ms": round(self.decayed_latency(i, now) * 1000, 3),
+                    "healthy": self.ejected_until[i] <= now,
+                } for i in range(len(self.replicas))}
+
+class RoutedPipeline(object):
+    """
+    A pipeline on a ReplicaRouter. Commands are queued here and only sent
+    when execute() is called, as one routed request that is timed and fails
+    over like any other read.
+    """
+    def __init__(self, router, *args, **kwargs):
+        self.router = router
+        self.args = args
+        self.kwargs = kwargs
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+
+        def request(client):
+            pipeline = client.pipeline(*self.args, **self.kwargs)
+            for name, args, kwargs in commands:
+                getattr(pipeline, name)(*args, **kwargs)
+            return pipeline.execute(raise_on_error)
+        return self.router.route(request)
+
+def batched(values, batch_size):
+    """
+    Split values into lists of at most batch_size items.
+    """
+    values = iter(values)
+    while True:
+        batch = list(itertools.islice(values, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def value_size(value):
+    """
+    Approximate size in bytes of a decoded redis value, for bounding ReadCache.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(json.dumps(value, default=np_encoder))
+
+class ReadCache(object):
+    """
+    An in-process LRU cache of decoded redis reads, bounded by entry count and
+    by the approximate size of the values, with a time to live on each entry.
+    Entries are indexed by the redis key they were read from so a write or an
+    invalidation message drops every cached read of that key.
+    Cached values are shared between callers and must not be modified.
+    """
+    MISSING = object()
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (redis key, read) -> (expires, size, value), least recently used first
+        self.entries = collections.OrderedDict()
+        self.by_key = {}
+        self.bytes = 0
+        # Bumped by every invalidation, so a read that raced a write isn't cached.
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, *read):
+        """
+        The cached value of a read of key, or ReadCache.MISSING.
+        """
+        entry_key = (key,) + read
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(entry_key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(entry_key)
+            self.misses += 1
+            return self.MISSING
+
+    def set(self, key, value, *read, epoch=None):
+        """
+        Cache the value of a read of key. Pass the epoch taken before the
+        value was read from redis; if anything was invalidated since then the
+        value may be stale and is not cached.
+        """
+        size = value_size(value)
+        if size > self.max_bytes:
+            return
+        entry_key = (key,) + read
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            if entry_key in self.entries:
+                self._remove(entry_key)
+            self.entries[entry_key] = (time.monotonic() + self.ttl, size, value)
+            self.by_key.setdefault(key, set()).add(entry_key)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_key):
+        _, size, _ = self.entries.pop(entry_key)
+        self.bytes -= size
+        keys = self.by_key[entry_key[0]]
+        keys.discard(entry_key)
+        if not keys:
+            del self.by_key[entry_key[0]]
+
+    def invalidate(self, *keys):
+        """
+        Drop every cached read of the keys.
+        """
+        with self.lock:
+            self.epoch += 1
+            for key in keys:
+                for entry_key in list(self.by_key.get(key, ())):
+                    self._remove(entry_key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.by_key.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Hits, misses, hit ratio, size and eviction figures.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+class CacheInvalidator(object):
+    """
+    Keeps a ReadCache in step with writes made by every client, using redis
+    server assisted client side caching in broadcast mode: main sends the name
+    of each modified key that matches one of the prefixes (or of every key,
+    without prefixes) and it is dropped from the cache.
+    redis-py 3.5 only speaks RESP2, where invalidations are redirected to a
+    connection subscribed to __redis__:invalidate, so tracking is turned on for
+    that subscribed connection itself. Tracking is lost when the connection
+    drops, so it is turned back on and the whole cache cleared on reconnect.
+    """
+    CHANNEL = "__redis__:invalidate"
+
+    def __init__(self, client, cache, prefixes=None):
+        self.client = client
+        self.cache = cache
+        self.prefixes = list(prefixes or [])
+        self.pubsub = None
+        self.thread = None
+
+    def start(self):
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        connection = self.client.connection_pool.get_connection("pubsub")
+        connection.register_connect_callback(self.on_connect)
+        connection.register_connect_callback(self.pubsub.on_connect)
+        self.pubsub.connection = connection
+        self.on_connect(connection)
+        self.pubsub.subscribe(**{self.CHANNEL: self.handle})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread = None
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+    def on_connect(self, connection):
+        connection.send_command("CLIENT", "ID")
+        client_id = connection.read_response()
+        args = ["CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST"]
+        for prefix in self.prefixes:
+            args += ["PREFIX", prefix]
+        connection.send_command(*args)
+        connection.read_response()
+        # writes made while we weren't tracking went unreported
+        self.cache.clear()
+
+    def handle(self, message):
+        keys = message["data"]
+        if keys is None:
+            # FLUSHDB / FLUSHALL
+            self.cache.clear()
+        else:
+            self.cache.invalidate(*[k.decode() if isinstance(k, bytes) else k for k in keys])
+
+def pipeline_counters(pipeline, counts):
+    """
+    Queue counter increments on a pipeline. counts maps (name, unix time) to
+    an amount, which is added to the sample holding that time in every
+    precision of the name's counter. Returns the number of HINCRBYs queued.
+    """
+    known = {}
+    increments = collections.defaultdict(int)
+    for (name, now), amount in counts.items():
+        for prec in COUNTER_PRECISION:
+            hash = '%s:%s' % (prec, name)
+            known[hash] = 0
+            increments[(hash, int(now / prec) * prec)] += amount
+    if known:
+        pipeline.zadd(COUNTER_KNOWN, known)
+    for (hash, pnow), amount in increments.items():
+        pipeline.hincrby(COUNTER_PREFIX + hash, pnow, amount)
+    return len(increments)
+
+class Metrics(object):
+    """
+    Call, error and latency counts of instrumented methods, added up
+    in-process and written to the count:* counters in one pipeline every
+    interval seconds by a background thread, instead of a write per call.
+    Each method has the counters calls:<method>, errors:<method>,
+    us:<method> (total microseconds) and latency:<method>:<bucket>, a
+    histogram over LATENCY_BUCKETS.
+    """
+    def __init__(self, client, interval=METRICS_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = collections.defaultdict(int)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.flushes = 0
+        self.failures = 0
+
+    def record(self, name, seconds=None, error=False):
+        """
+        Count a call of name that took seconds, or only the call when seconds
+        is None.
+        """
+        now = int(time.time())
+        with self.lock:
+            counts = self.counts
+            counts[("calls:" + name, now)] += 1
+            if error:
+                counts[("errors:" + name, now)] += 1
+            if seconds is not None:
+                counts[("us:" + name, now)] += int(seconds * 1000000)
+                bucket = LATENCY_LABELS[bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)]
+                counts[("latency:%s:%s" % (name, bucket), now)] += 1
+
+    def flush(self):
+        """
+        Write the counts recorded since the last flush. Counts that can't be
+        written are kept for the next one. Returns the number of samples written.
+        """
+        with self.lock:
+            counts, self.counts = self.counts, collections.defaultdict(int)
+        if not counts:
+            return 0
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            written = pipeline_counters(pipeline, counts)
+            pipeline.execute()
+        except redis.exceptions.RedisError as err:
+            LOGGER.warning("Could not flush %d metrics, keeping them for the next flush: %s",
+                len(counts), err)
+            with self.lock:
+                for key, amount in counts.items():
+                    self.counts[key] += amount
+            self.failures += 1
+            return 0
+        self.flushes += 1
+        return written
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="redis-metrics", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """
+        Stop the flushing thread and flush what is left.
+        """
+        atexit.unregister(self.stop)
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+def instrument(method, timed=True, log=False, nested=True):
+    """
+    Record each call of method, whether it raised and, if timed, how long it
+    took in the process' Metrics when they are on (see
+    RedisConnection.enable_metrics). With log, each call's time is also
+    logged at debug.
+    Unless nested, a call made while another un-nested method is running on
+    the same thread, ie. one client method calling another, isn't recorded:
+    its time is already part of the outer call's.
+    """
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def instrumented(*args, **kwargs):
+        metrics = _metrics
+        if metrics is None and not log:
+            return method(*args, **kwargs)
+        if not nested:
+            if getattr(_instrumenting, "active", False):
+                return method(*args, **kwargs)
+            _instrumenting.active = True
+        start = time.perf_counter()
+        error = True
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            if not nested:
+                _instrumenting.active = False
+            if metrics is not None:
+                metrics.record(name, elapsed if timed else None, error)
+            if log:
+                LOGGER.debug("%s.%s took %.1f msec", method.__module__, name, elapsed * 1000)
+    return instrumented
+
+def count(method):
+    """
+    Count the calls and errors of method.
+    """
+    return instrument(method, timed=False)
+
+def timeit(method):
+    """
+    Count the calls, errors and latency of method and log how long each call took.
+    """
+    return instrument(method, log=True)
+
+def instrument_methods(cls):
+    """
+    Instrument every public method of a class, so each call made from outside
+    it is recorded once. Helpers are _ prefixed to be left out.
+    """
+    for name, value in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.isfunction(value):
+            setattr(cls, name, instrument(value, nested=False))
+    return cls
+
+class RedisLock(object):
+    """
+    A cross process lock held in key lock:<lockname> for a lease of
+    lock_timeout seconds.
+    Acquiring is one atomic SET NX PX, which also INCRs lock:<lockname>:fence
+    for a fencing token: every holder gets a larger token than the one before
+    it, so a resource can turn away writes from a holder whose lease ran out.
+    A waiter doesn't poll. It blocks on the channel release() publishes to
+    (and on the key's keyspace notifications, when the server sends them)
+    until the lock is released or the holder's lease runs out.
+    With renew, a thread renews the lease every lock_timeout/3 seconds while
+    the lock is held, so a long import keeps it however long it takes, but a
+    crashed one frees it within a lease.
+
+        with RedisLock(conn, "importer", renew=True) as lock:
+            ... lock.token ...
+    """
+    def __init__(self, conn, lockname, lock_timeout=30, acquire_timeout=30, renew=False):
+        self.conn = conn
+        self.name = lockname
+        self.key = prepend_lockname(lockname)
+        self.fence_key = self.key + LOCK_FENCE_SUFFIX
+        self.channel = self.key + LOCK_RELEASED_SUFFIX
+        self.lock_timeout = lock_timeout
+        self.acquire_timeout = acquire_timeout
+        self.renew_lease = renew
+        self.identifier = None
+        self.token = None
+        self.lost = False
+        self.renewer = None
+        self.renewing = None
+
+    def channels(self):
+        db = self.conn.connection_pool.connection_kwargs.get("db", 0)
+        return [self.channel, "__keyspace@%s__:%s" % (db, self.key)]
+
+    def attempt(self, identifier):
+        """
+        One atomic acquisition attempt. Returns the fencing token if the lock
+        was acquired, otherwise minus the milliseconds left on its lease.
+        """
+        return int(lock_script(self.conn, LOCK_ACQUIRE_SCRIPT)(
+            keys=[self.key, self.fence_key], args=[identifier, self.lease()], client=self.conn))
+
+    def lease(self, lock_timeout=None):
+        """
+        The lease in whole milliseconds.
+        """
+        return int(math.ceil((lock_timeout or self.lock_timeout) * 1000))
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Acquire the lock, waiting up to timeout seconds (acquire_timeout by
+        default) if blocking. Returns the fencing token, or False.
+        """
+        if self.identifier is not None:
+            raise RuntimeError("lock %s is already held" % self.key)
+        identifier = str(uuid.uuid4())
+        end = time.monotonic() + ((self.acquire_timeout if timeout is None else timeout) if blocking else 0)
+        result = self.attempt(identifier)
+        pubsub = None
+        try:
+            while result <= 0:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if pubsub is None:
+                    # subscribe, then try again in case it was released in between
+                    pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(*self.channels())
+                elif result < 0:
+                    wait_for_message(pubsub, min(remaining, -result / 1000.0))
+                result = self.attempt(identifier)
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+        self.identifier, self.token, self.lost = identifier, result, False
+        if self.renew_lease:
+            self.renewing = threading.Event()
+            self.renewer = threading.Thread(target=self.keep_renewed, args=(self.renewing,),
+                name="renew-%s" % self.key, daemon=True)
+            self.renewer.start()
+        return result
+
+    def renew(self, lock_timeout=None):
+        """
+        Restart the lease, for lock_timeout seconds if given. Returns False if
+        the lock is no longer held.
+        """
+        if self.identifier is None:
+            return False
+        return bool(lock_script(self.conn, LOCK_RENEW_SCRIPT)(
+            keys=[self.key], args=[self.identifier, self.lease(lock_timeout)], client=self.conn))
+
+    def keep_renewed(self, stopped):
+        while not stopped.wait(self.lock_timeout / 3.0):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    LOGGER.warning("Lock %s:%s expired or was removed while it was held.",
+                        self.key, self.identifier)
+                    return
+            except redis.exceptions.RedisError as err:
+                LOGGER.warning("Could not renew lock %s:%s: %s", self.key, self.identifier, err)
+
+    def release(self):
+        """
+        Release the lock if it is still ours and wake the waiters. Returns
+        False if it had already expired or been taken.
+        """
+        if self.renewing is not None:
+            self.renewing.set()
+            self.renewer.join()
+            self.renewing = self.renewer = None
+        identifier, self.identifier = self.identifier, None
+        if identifier is None:
+            return False
+        return release_lock(self.conn, self.name, identifier)
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError("could not acquire lock %s within %ss" % (self.key, self.acquire_timeout))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def wait_for_message(pubsub, timeout):
+    """
+    The next message on a pubsub's channels, or None after timeout seconds.
+    """
+    end = time.monotonic() + timeout
+    while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return None
+        # subscribe confirmations come back as None too, so wait out the rest
+        message = pubsub.get_message(timeout=remaining)
+        if message is not None:
+            # one release can be announced twice, by the release and the keyspace
+            while pubsub.get_message(timeout=0) is not None:
+                pass
+            return message
+
 def aquire_lock_with_timeout( conn, lockname, acquire_timeout=30, lock_timeout=30):
     """
-    Create a cross process lock in redis cache with timeout.
+    Create a cross process lock in redis cache with timeout. Returns the
+    lock's identifier for release_lock(), or False. See RedisLock.
     """
-    ln = prepend_lockname(lockname)
-    identifier = str(uuid.uuid4())
-    lock_timeout = int(math.ceil(lock_timeout))
-    end = time.time() + acquire_timeout
-    lockname = 'lock:' + lockname
-    while time.time() < end:
-        if conn.setnx(ln, identifier):
-            conn.expire(ln, lock_timeout)
-            return identifier
-        elif not conn.tll(ln):
-            conn.expire(ln, lock_timeout)
-        time.sleep(.001)
+    lock = RedisLock(conn, lockname, lock_timeout, acquire_timeout)
+    if lock.acquire():
+        return lock.identifier
     return False
 
 def clear_importer_lock(conn):
@@ -46,32 +1066,32 @@ def clear_importer_lock(conn):
     Clear an importer lock without regard to other processes (ie ABORT)
     """
     if not conn:
-        conn = RedisConnection()
+        conn = get_redis_connection()
     ln = prepend_lockname("importer")
     conn.del_key(ln)
 
 
 def release_lock(conn, lockname, identifier):
     """
-    Release a cross process lock acquired in redis cache
+    Release a cross process lock acquired in redis cache, if it still holds
+    identifier, and wake its waiters.
     """
-    pipe = conn.pipeline(True)
     ln = prepend_lockname(lockname)
-    while True:
-        try:
-            pipe.watch(ln)
-            if pipe.get(ln) == identifier:
-                pipe.multi()
-                pipe.delete(ln)
-                pipe.execute()
-                return True
-            pipe.unwatch()
-            break
-        except redis.exceptions.WatchError:
-            LOGGER.info("Could not release lock %s, perhaps it's already been removed." % (ln))
-            pass
-        LOGGER.warning("The lock %s could not be found. It may have timedout or been deleted.")
-    return False
+    released = lock_script(conn, LOCK_RELEASE_SCRIPT)(
+        keys=[ln], args=[identifier, ln + LOCK_RELEASED_SUFFIX], client=conn)
+    return bool(released)
+
+def lock_script(conn, source, scripts=_lock_scripts):
+    """
+    The Script for one of the LOCK_*_SCRIPT sources, made once per process
+    so its sha is only computed once and each call is a bare EVALSHA. It is
+    registered with whichever client asked first, so callers pass their own
+    as client=.
+    """
+    script = scripts.get(source)
+    if script is None:
+        script = scripts.setdefault(source, conn.register_script(source))
+    return script
 
 def prepend_lockname(lockname):
     return "lock:" + lockname
@@ -79,47 +1099,37 @@ def prepend_lockname(lockname):
 def importer_lock(func):
     """
     Check if an importer lock already exists.  If so exit, otherwise allow the import to proceed.
-    Lock is release when the import completes, raises an exception or after a timeout.
+    The lock's lease is renewed while the import runs. It is released when the
+    import completes or raises an exception, or a lease after the process dies.
     """
     def wrapper(*args, **kwargs):
-        rc = RedisConnection()
-        lock_id = rc.get_by_key(prepend_lockname("importer"))
-        LOGGER.info("Importer lock %s exists..." % (lock_id))
-        if not lock_id:
-            conn = rc.main
-            lock_to = CONFIG_DATA["IMPORTER_LOCK_TIMEOUT"]
-            lock_id = aquire_lock_with_timeout(conn, "importer",lock_timeout=lock_to)
-            try:
-                if lock_id:
-                    LOGGER.info("Importer lock aquired %s:%s and will expire at %s ..." ,prepend_lockname("importer"), 
-                        lock_id, 
-                        datetime.fromtimestamp(time.time() + lock_to))
-                    return func(*args, **kwargs)
-                else:
-                    LOGGER.info("Import was teminated because another process is alredy importing data.")
-            except Exception as err:
-                LOGGER.error("Exception occured during import: %s", err.__doc__, exc_info=True)
-            finally:
-                if release_lock(conn, "importer", lock_id):
-                    LOGGER.info("%s:%s lock released" % (prepend_lockname("importer"), lock_id) )
-                else:
-                    conn.delete("importer")
-                    LOGGER.warning("%s:%s lock release attempted, but it did not return True, unsafe delete performed instead.", prepend_lockname("importer"), lock_id)
-        else:
+        rc = get_redis_connection()
+        lock_to = CONFIG_DATA["IMPORTER_LOCK_TIMEOUT"]
+        lock = RedisLock(rc.main, "importer", lock_timeout=lock_to, renew=True)
+        if not lock.acquire(blocking=False):
             LOGGER.info("Importer process was teminated because another import is alredy in progress.")
             return False
+        LOGGER.info("Importer lock aquired %s:%s with fencing token %s, renewed every %ss ...",
+            lock.key, lock.identifier, lock.token, lock_to / 3.0)
+        identifier = lock.identifier
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            LOGGER.error("Exception occured during import: %s", err.__doc__, exc_info=True)
+        finally:
+            if lock.release():
+                LOGGER.info("%s:%s lock released" % (lock.key, identifier))
+            else:
+                LOGGER.warning("%s:%s lock had already expired or been removed.", lock.key, identifier)
     return wrapper
 
 def clear_cache_hash_keys(func):
     def wrapper(*args, **kwargs):
-        rc = RedisConnection()
+        rc = get_redis_connection()
         cnt_removed = 0
         clear_prefixes = ["hash_keys:*", "graphquery:*", "ml_cache*"]
         def remove_starts_with(prefix):
-            existing_keys = rc.get_keys_starting_with(prefix)
-            for k in existing_keys:
-                rc.main.delete(k)
-            return len(existing_keys)
+            return sum(rc.del_keys(rc.scan_keys(prefix)))
         for p in clear_prefixes:
             cnt_removed += remove_starts_with(p)
         
@@ -130,7 +1140,7 @@ def clear_cache_hash_keys(func):
 # Decorator with arguments
 def suppress_redis_bgsave(redis_conn=None, connection_name=None):
     if redis_conn is None:
-        redis_conn = RedisConnection().main
+        redis_conn = get_redis_connection().main
         connection_name = "redis_cache"
     def disable_bg_save():
         d_save = redis_conn.config_get("save")
@@ -173,15 +1183,25 @@ def suppress_redis_bgsave(redis_conn=None, connection_name=None):
     
     return set_bg_save
 
+@instrument_methods
 class RedisConnection(object):
     """
     A connection to the redis server.
-    Writes only go to main. Reads from replica.
+    Writes only go to main. Reads are spread over the replicas by a ReplicaRouter.
     """
     replica = None
     main = None
+    raw_main = None
+    raw_replica = None
+    cache = None
+    cache_invalidator = None
     config_data = None
     decode_responses = True
+    # How many values go into each variadic command of the batch writers.
+    BATCH_SIZE = 1000
+    # The COUNT hint passed to SCAN: roughly how many keys each call examines.
+    SCAN_COUNT = 1000
+    GLOB_CHARACTERS = re.compile(r"[*?\[\\]")
 
     @staticmethod
     def sanitize_json_key(key):
@@ -201,69 +1221,135 @@ class RedisConnection(object):
 
     def __init__(self, decode_responses=True, main_uri=None, replica_uri=None, **kwargs):
         """
-        Creates a connection to redis using "redis_servers" from config provider
-        """
-        if not "REDIS_REPLICAS" in CONFIG_DATA and not replica_uri:
-            raise KeyError("REDIS_REPLICAS not found in config")
-        if not "REDIS_MAIN_SERVER" in CONFIG_DATA and not main_uri:
-            raise KeyError("REDIS_MAIN_SERVER not found in config")
-        if not "REDIS_CACHE_PASSWORD" in CONFIG_DATA:
-            raise KeyError("REDIS_CACHE_PASSWORD is not found in config")
-        password = CONFIG_DATA["REDIS_CACHE_PASSWORD"]  if not CONFIG_DATA["REDIS_CACHE_PASSWORD"] == "" else None
-        username = None
-        if not password is None:
-            username = "default"
-        replicas = replica_uri or CONFIG_DATA["REDIS_REPLICAS"]
-        main = main_uri or CONFIG_DATA["REDIS_MAIN_SERVER"][0]
-        self.replica_parts = []
-        self.main_parts = []
-        if isinstance(replicas, list):
-            ri = random.choice(range(0,len(replicas)))
-            self.replica_parts = replicas[ri].split(':')
-        elif replicas and isinstance(replicas, str):
-            self.replica_parts = replicas.split(":")
-
-        if isinstance(main, list):
-            # if we have a list of main instances just take the first one provided
-            main = main[0]
-        if isinstance(main, str):
-            self.main_parts = main.split(':')
-            
+        Creates a connection to redis using "redis_servers" from config provider.
+        Connections come from the shared pools; see get_redis_connection() to
+        share the RedisConnection itself.
+        """
+        self.main_parts, self.replica_parts, username, password = redis_servers(main_uri, replica_uri)
+        replica_clients = []
         if self.replica_parts:
-            self.replica = RejClient(
-                        host=self.replica_parts[0], 
-                        port=self.replica_parts[1],
-                        username=username,
-                        password=password,
-                        decode_responses=decode_responses,  
-                        **kwargs)
-            if not self.replica:
-                raise ConnectionError("unalbe to create replica connection to %s: %s" % (self.replica_parts[0], self.replica_parts[1]))
+            for replica_parts in self.replica_parts:
+                replica = JsonClient(connection_pool=connection_pool(
+                            replica_parts[0], 
+                            replica_parts[1],
+                            username=username,
+                            password=password,
+                            decode_responses=decode_responses,  
+                            **kwargs))
+                if not replica:
+                    raise ConnectionError("unalbe to create replica connection to %s: %s" % (replica_parts[0], replica_parts[1]))
+                replica_clients.append(replica)
         else:
             raise ValueError("no valid redis replica uri found.")
         if self.main_parts:
-            self.main = RejClient(
-                    host=self.main_parts[0], 
-                    port=self.main_parts[1], 
+            self.main = JsonClient(connection_pool=connection_pool(
+                    self.main_parts[0], 
+                    self.main_parts[1], 
                     password=password,
                     username=username,
                     decode_responses=decode_responses, 
-                    **kwargs)
+                    **kwargs))
             if not self.main:
                 raise ConnectionError("unalbe to create main connection to %s: %s" % (self.main_parts[0], self.main_parts[1]))
         else:
             raise ValueError("no valid redis main uri found.")
             #LOGGER.info("Master server  %s:%s", main_parts[0], main_parts[1])
+        self.replica = ReplicaRouter(replica_clients, self.main,
+            [":".join(parts) for parts in self.replica_parts])
         self.decode_responses=decode_responses
+        # binary values such as numpy arrays need clients that don't decode
+        if decode_responses:
+            self.raw_main = redis.Redis(connection_pool=connection_pool(
+                self.main_parts[0], self.main_parts[1],
+                username=username, password=password, decode_responses=False, **kwargs))
+            self.raw_replica = ReplicaRouter([redis.Redis(connection_pool=connection_pool(
+                    parts[0], parts[1],
+                    username=username, password=password, decode_responses=False, **kwargs))
+                for parts in self.replica_parts],
+                self.raw_main, self.replica.names)
+        else:
+            self.raw_main = self.main
+            self.raw_replica = self.replica
+        if READ_CACHE:
+            self.enable_read_cache(**(READ_CACHE if isinstance(READ_CACHE, dict) else {}))
+        if METRICS and _metrics is None:
+            self.enable_metrics(**(METRICS if isinstance(METRICS, dict) else {}))
+
+    def replica_stats(self):
+        """
+        Per replica request, error, latency and health figures from the read router.
+        """
+        return self.replica.stats()
+
+    def enable_read_cache(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=300,
+            tracking=False, prefixes=None):
+        """
+        Serve get_json_value, get_hash_key_value, get_application_endpoint and
+        get_json_dump from an in-process ReadCache. Writes made through this
+        connection invalidate it directly; with tracking, writes made by any
+        other client are reported by main and invalidate it too, otherwise
+        those are only picked up once an entry's ttl runs out.
+        """
+        self.disable_read_cache()
+        self.cache = ReadCache(max_entries, max_bytes, ttl)
+        if tracking:
+            self.cache_invalidator = CacheInvalidator(self.main, self.cache, prefixes).start()
+        return self.cache
+
+    def disable_read_cache(self):
+        if self.cache_invalidator is not None:
+            self.cache_invalidator.stop()
+            self.cache_invalidator = None
+        self.cache = None
+
+    def read_cache_stats(self):
+        """
+        Hit, miss and size figures of the read cache, or None when it is off.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _cached_read(self, key, read, *args):
+        """
+        The result of read(), served from the read cache when it is on.
+        args name the read within key, ie. the hash field or json path.
+        """
+        cache = self.cache
+        if cache is None:
+            return read()
+        value = cache.get(key, *args)
+        if value is ReadCache.MISSING:
+            epoch = cache.epoch
+            value = read()
+            cache.set(key, value, *args, epoch=epoch)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drop the keys from the read cache after a write.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(*keys)
 
     def add_list(self, key, values):
         """
         Create a list and add values or just append the values if the list already exists
         """
-        for v in reversed(values):
-            self.main.lpush(key, v)
+        self.add_list_batch(key, values)
         return True
 
+    def add_list_batch(self, key, values, batch_size=None):
+        """
+        Push values onto the front of a list, keeping their order, with one
+        variadic LPUSH per batch sent in a single pipeline.
+        Returns the length of the list after each batch.
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        for batch in batched(reversed(values), batch_size or self.BATCH_SIZE):
+            pipeline.lpush(key, *batch)
+        return pipeline.execute()
+
     def add_to_set(self, set_name, value):
         """
         Add value to set.
@@ -290,23 +1376,40 @@ class RedisConnection(object):
         return self.main.config_set(key, value)
         
     def del_key(self, key):
-        return self.main.delete(key)
+        try:
+            return self.main.delete(key)
+        finally:
+            self.invalidate(key)
 
-    def del_keys_by_filter(self, filter=""):
-        result = 0
+    def del_keys(self, keys, batch_size=None, unlink=True):
+        """
+        Delete keys with one variadic UNLINK (or DEL) per batch. UNLINK frees
+        the values in the background so large deletes don't block the server.
+        keys can be any iterable, ie. scan_keys(), and each batch is sent as
+        soon as it fills, so keys are never all held at once.
+        Returns the number of keys removed by each batch.
+        """
+        command = self.main.unlink if unlink else self.main.delete
+        results = []
+        for batch in batched(keys, batch_size or self.BATCH_SIZE):
+            results.append(command(*batch))
+            self.invalidate(*batch)
+        return results
+
+    def del_keys_by_filter(self, filter="", batch_size=None):
         if filter:
-            keys = self.get_keys(filter)
-            if keys:
-                for key in keys:
-                    result += self.main.delete(key)
-                    if result:
-                        LOGGER.info("Dropped cache key: %s", key)
-                    else:
-                        LOGGER.info("Failed to drop key %s", key)
+            results = self.del_keys(self.scan_keys(filter), batch_size)
+            if results:
+                result = sum(results)
+                LOGGER.info("Dropped %s cache keys matching %s in %s batches",
+                    result, filter, len(results))
                 return result
 
-    def del_json_value(self, base, path=Path.rootPath()):
-        return self.main.jsondel(base, path)
+    def del_json_value(self, base, path=ROOT_PATH):
+        try:
+            return self.main.jsondel(base, path)
+        finally:
+            self.invalidate(base)
 
     def set_application_endpoint(self, name, value):
         """
@@ -330,14 +1433,56 @@ class RedisConnection(object):
         return set(self.replica.smembers(name))
 
     def get_json_dump(self, key_name):
-        json_string = self.replica.get(key_name)
-        if json_string:
-            return json.loads(json_string)
-        return None
+        def read():
+            json_string = self.replica.get(key_name)
+            if json_string:
+                return json.loads(json_string)
+            return None
+        return self._cached_read(key_name, read, "dump")
 
     def get_keys_starting_with(self, key_prefix):
-        iter_keys = self.replica.scan_iter(key_prefix)
-        return list(iter_keys)
+        return list(self.scan_keys(key_prefix))
+
+    def get_passage(self, translation, start, end, batch_size=None):
+        """
+        The verse documents of a translation with ids from start to end
+        inclusive, in order, ie. get_passage("KJV", 1001001, 2001005) is
+        Genesis 1:1 through Exodus 1:5. One ZRANGEBYSCORE of the verse index
+        finds the ids and one pipeline of JSON.MGETs fetches the verses.
+        """
+        return self.get_passages(translation, [(start, end)], batch_size)[0]
+
+    def get_passages(self, translation, spans, batch_size=None):
+        """
+        The verse documents of each (start, end) span of verse ids, with one
+        pipeline of ZRANGEBYSCOREs and one of JSON.MGETs for all of them.
+        """
+        pipeline = self.replica.pipeline(transaction=False)
+        for start, end in spans:
+            pipeline.zrangebyscore(verse_index_key(translation), start, end)
+        spans_ids = pipeline.execute() if spans else []
+        pipeline = self.replica.pipeline(transaction=False)
+        batches = []
+        for ids in spans_ids:
+            batches.append(0)
+            for batch in batched(ids, batch_size or self.BATCH_SIZE):
+                pipeline.jsonmget(ROOT_PATH, *[verse_key(translation, int(vid)) for vid in batch])
+                batches[-1] += 1
+        results = iter(pipeline.execute() if any(batches) else [])
+        return [[verse for verses in itertools.islice(results, count) for verse in verses if verse is not None]
+            for count in batches]
+
+    def get_reference(self, translation, reference, batch_size=None):
+        """
+        The verse documents of each reference in a list such as
+        "Gen 1:1-Exo 1:5" or "John 3:16, Rom 3:23; 5:8", one list per
+        reference. The list is parsed by pdf_builder's references module,
+        which must be importable; callers that already hold verse id spans
+        should pass them to get_passages() instead.
+        :raises ValueError: If the references can't be parsed.
+        """
+        from references import parse_references
+        return self.get_passages(translation, parse_references(reference), batch_size)
 
     def get_in_set(self, set_name, value):
         """
@@ -352,22 +1497,17 @@ class RedisConnection(object):
         
     def get_json_obj_keys(self, base, path="."):
         """
-        retrieve rejson object keys at the path or base key
+        retrieve RedisJSON object keys at the path or base key
         """
-        if not path:
-            path = Path.rootPath()
-        return self.replica.jsonobjkeys(base, path)
+        return self.replica.jsonobjkeys(base, path or ROOT_PATH)
 
     def get_json_value(self, base, path=None):
         """
-        retrieve an rejson object from the base cache key or 
+        retrieve a RedisJSON object from the base cache key or 
         from any node in the object using its x_path.
         """
-        if not path:
-            path=Path.rootPath()
-        else:
-            path = Path(path)
-        return self.replica.jsonget(base, path)
+        path = str(path or ROOT_PATH)
+        return self._cached_read(base, lambda: self.replica.jsonget(base, path), "json", path)
        
     def get_keys_for_hash(self, hash_name):
         return self.replica.hkeys(hash_name)
@@ -385,15 +1525,28 @@ class RedisConnection(object):
         return self.replica.hgetall(key_name)
 
     def get_hash_key_value(self, hash_name, key_name):
-        return self.replica.hget(hash_name, key_name)
+        return self._cached_read(hash_name, lambda: self.replica.hget(hash_name, key_name), "hash", key_name)
 
-    def get_keys(self, key_filter="*"):
-        result = self.replica.keys(key_filter)
-        return result
+    def get_keys(self, key_filter="*", count=None, type=None):
+        return list(self.scan_keys(key_filter, count, type))
 
-    def get_key_exists(self, key_filter="*"):
-        keys = self.get_keys(key_filter)
-        return True if keys else False
+    def get_key_exists(self, key_filter="*", count=None, type=None):
+        """
+        True if any key matches key_filter. A plain key name is checked with
+        EXISTS, otherwise the scan stops at the first match.
+        """
+        if not type and not self.GLOB_CHARACTERS.search(key_filter):
+            return self.key_exist(key_filter) > 0
+        return next(self.scan_keys(key_filter, count, type), None) is not None
+
+    def scan_keys(self, key_filter="*", count=None, type=None):
+        """
+        Iterate the keys matching key_filter on the replica with SCAN, which
+        never blocks the server the way KEYS does.
+        count: the COUNT hint for each SCAN call (default SCAN_COUNT).
+        type: only return keys holding this type, ie. "hash" or "ReJSON-RL".
+        """
+        return self.replica.scan_iter(key_filter, count or self.SCAN_COUNT, type)
 
     def get_list(self, key):
         """
@@ -406,10 +1559,17 @@ class RedisConnection(object):
         return None
 
     def get_np_array(self, key):
-        encoded = self.replica.get(key)
-        h, w = struct.unpack(">II", encoded[:8])
-        a = np.frombuffer(encoded, dtype=np.numeric, offset=8).reshape(h,w)
-        return a
+        """
+        The numpy array stored at key by set_np_array, or None.
+        """
+        encoded = self.raw_replica.get(key)
+        if encoded is None:
+            return None
+        chunks = None
+        count = decode_np_header(encoded)[3]
+        if count:
+            chunks = self.raw_replica.mget([np_chunk_key(key, i) for i in range(count)])
+        return decode_np_array(encoded, chunks)
 
     def key_exist(self, key_name):
         """
@@ -417,6 +1577,13 @@ class RedisConnection(object):
         """
         return self.replica.exists(key_name) 
 
+    def lock(self, lockname, lock_timeout=30, acquire_timeout=30, renew=False):
+        """
+        A RedisLock on main, ie.
+            with rc.lock("importer", renew=True) as lock:
+        """
+        return RedisLock(self.main, lockname, lock_timeout, acquire_timeout, renew)
+
     def pop_set(self, set_name, count=1):
         return self.main.spop(set_name, count)
 
@@ -442,7 +1609,10 @@ class RedisConnection(object):
         """
         Remove a item from a hash by it's key name
         """
-        return self.main.hdel(hash_name, key)
+        try:
+            return self.main.hdel(hash_name, key)
+        finally:
+            self.invalidate(hash_name)
 
     def save(self, bg=True):
         if bg:
@@ -452,36 +1622,77 @@ class RedisConnection(object):
     
     def set_json_value(self, base, key, value):
         """
-        Save the value under the key name (key) at the redis cache location (base)
+        Save the value under the key name (key) at the redis cache location (base),
+        creating the base document first if it doesn't exist.
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        self._pipeline_json_set(pipeline, base, key, value)
+        try:
+            return pipeline.execute()[-1]
+        finally:
+            self.invalidate(base)
+
+    def set_json_values(self, values, batch_size=None):
+        """
+        Save many (base, key, value) triples as set_json_value would, with one
+        pipeline per batch so the cost of each write doesn't depend on how
+        many keys the server holds.
+        Returns the number of values written.
+        """
+        written = 0
+        for batch in batched(values, batch_size or self.BATCH_SIZE):
+            pipeline = self.main.pipeline(transaction=False)
+            # each value's own set is the last command queued for it
+            positions = []
+            for base, key, value in batch:
+                self._pipeline_json_set(pipeline, base, key, value)
+                positions.append(len(pipeline) - 1)
+            try:
+                results = pipeline.execute()
+            finally:
+                self.invalidate(*{base for base, _, _ in batch})
+            written += sum(1 for i in positions if results[i])
+        return written
+
+    @staticmethod
+    def _pipeline_json_set(pipeline, base, key, value):
         """
-        #rej_client = RejClient(host=self.main_parts[0], port=self.main_parts[1], decode_responses=True)
-        # check for and handle missing base ke
-        existing_base = self.get_keys_starting_with(base)
-        if not existing_base:
-            self.main.jsonset(base, Path.rootPath(), {"created":time.time()})
-        if not key:
-            key = Path.rootPath()
-        ret_val = self.main.jsonset(base, key, value)
-        return ret_val
+        Queue the commands that save value under key in base. Unless key is
+        the root, JSON.SET NX first gives a missing base its root document.
+        """
+        if not key or key == ROOT_PATH:
+            pipeline.jsonset(base, ROOT_PATH, value)
+        else:
+            pipeline.jsonset(base, ROOT_PATH, {"created": time.time()}, nx=True)
+            pipeline.jsonset(base, key, value)
 
     def set_hash_values (self, key, d_values):
         """
         Set the dictionary values to a hash_key
         """
-        return self.main.hmset(key, d_values)
+        try:
+            return self.main.hmset(key, d_values)
+        finally:
+            self.invalidate(key)
 
     def set_hash_value_by_key(self, hash_name, key, value):
         """
         Set a hash object's key/value pair in redis
         """
-        return self.main.hset(hash_name, key, value)
+        try:
+            return self.main.hset(hash_name, key, value)
+        finally:
+            self.invalidate(hash_name)
         
     def set_json_dump(self, key_name ,json_data, ex=None):
         json_string = json.dumps(json_data, default=np_encoder)
-        if ex:
-            return self.main.set(key_name, json_string, ex)
-        else:
-            return self.main.set(key_name, json_string)
+        try:
+            if ex:
+                return self.main.set(key_name, json_string, ex)
+            else:
+                return self.main.set(key_name, json_string)
+        finally:
+            self.invalidate(key_name)
 
     def set_pop(self, name, count):
         return self.main.spop(name, count)
@@ -493,30 +1704,90 @@ class RedisConnection(object):
         return self.replica.sdiff(set_a, set_b)
     
     def set_string(self, key, value):
-        return self.main.set(key, value)
+        try:
+            return self.main.set(key, value)
+        finally:
+            self.invalidate(key)
     def get_string(self, key):
         return self.replica.get(key)
 
-    def set_np_array(self, key,  np_array_numeric):
+    def set_np_array(self, key, np_array_numeric, compression=None, ex=None, chunk_size=None):
         """
-        Convert a numpy numeric array to bytes and store in the key provided
+        Store a numpy array of any dtype and shape at key, optionally
+        compressed ("zlib"). The array's memory is sent as is, without
+        building a copy of it. Payloads over chunk_size (NP_CHUNK_SIZE) are
+        split over "<key>:chunk:<n>" keys, all written in one transaction.
         """
-        h, w = np_array_numeric.shape
-        shape = struct.pack(">II", h, w)
-        encoded = shape + np_array_numeric.tobyes()
-        self.main.set(key, encoded)
+        header, chunks = encode_np_array(np_array_numeric, compression, chunk_size or NP_CHUNK_SIZE)
+        old_header = self.raw_main.getrange(key, 0, NP_HEADER.size - 1)
+        old_count = 0
+        if len(old_header) == NP_HEADER.size and old_header[:4] == NP_MAGIC:
+            old_count = NP_HEADER.unpack(old_header)[4]
+        count = len(chunks) if len(chunks) > 1 else 0
+
+        pipeline = self.raw_main.pipeline(transaction=True)
+        if count:
+            pipeline.set(key, header, ex=ex)
+            for i, chunk in enumerate(chunks):
+                pipeline.set(np_chunk_key(key, i), chunk, ex=ex)
+        else:
+            # SET then APPEND, so the payload isn't joined onto the header
+            pipeline.set(key, header)
+            pipeline.append(key, chunks[0])
+            if ex:
+                pipeline.expire(key, ex)
+        stale = [np_chunk_key(key, i) for i in range(count, old_count)]
+        if stale:
+            pipeline.unlink(*stale)
+        pipeline.execute()
         return 1
 
     def x_ack(self, stream_name, group_name, l_ids):
-        results = {}
+        l_ids = list(l_ids)
+        pipeline = self.main.pipeline(transaction=False)
         for id in l_ids:
-            results[id] = self.main.xack(stream_name, group_name, id)
-        return results
+            pipeline.xack(stream_name, group_name, id)
+        return dict(zip(l_ids, pipeline.execute()))
+
+    def x_ack_batch(self, stream_name, group_name, l_ids, batch_size=None):
+        """
+        Acknowledge ids with one variadic XACK per batch, sent in a single pipeline.
+        Returns the number of messages acknowledged by each batch.
+        """
+        pipeline = self.main.pipeline(transaction=False)
+        for batch in batched(l_ids, batch_size or self.BATCH_SIZE):
+            pipeline.xack(stream_name, group_name, *batch)
+        return pipeline.execute()
 
-    def x_add(self, stream_name, d_values):
+    def x_add(self, stream_name, d_values, maxlen=None, approximate=True):
+        """
+        Add an entry to a stream, trimming it to about maxlen entries if set.
+        """
         if d_values is None:
             raise ValueError("No items specified to save to log.")
-        return self.main.xadd(stream_name, d_values, )
+        return self.main.xadd(stream_name, d_values, maxlen=maxlen, approximate=approximate)
+
+    def x_autoclaim(self, stream_name, group_name, consumer_name, min_idle_time, start="0-0", count=None):
+        """
+        Claim entries pending for more than min_idle_time milliseconds in a
+        consumer group, ie. those of a consumer that died, for consumer_name.
+        Returns the id to continue scanning from ("0-0" once the whole pending
+        list has been scanned) and the claimed (id, fields) entries.
+        Entries deleted from the stream while pending are dropped from it.
+        """
+        args = ["XAUTOCLAIM", stream_name, group_name, consumer_name, int(min_idle_time), start]
+        if count:
+            args += ["COUNT", count]
+        reply = self.main.execute_command(*args)
+        entries = []
+        for entry in reply[1]:
+            if entry and entry[1] is not None:
+                fields = entry[1]
+                # newer clients parse the reply, older ones leave field lists
+                if not isinstance(fields, dict):
+                    fields = dict(zip(fields[::2], fields[1::2]))
+                entries.append((entry[0], fields))
+        return reply[0], entries
 
     def x_len(self, stream_name):
         return self.replica.xlen(stream_name)
@@ -524,9 +1795,24 @@ class RedisConnection(object):
     def x_del(self, stream_name, id):
         return self.main.xdel(stream_name, id)
 
-    def x_group_create(self, stream_name, group_name, mkstream=True):
-        return self.main.xgroup_create(stream_name, group_name, id="$", mkstream=True)
-            
+    def x_group_create(self, stream_name, group_name, mkstream=True, id="$"):
+        """
+        Create a consumer group reading the stream from after id ("$" for new
+        entries only, "0" for all of them). Returns False if it already exists.
+        """
+        try:
+            return self.main.xgroup_create(stream_name, group_name, id=id, mkstream=mkstream)
+        except ResponseError as err:
+            if not str(err).startswith("BUSYGROUP"):
+                raise
+            return False
+
+    def x_group_delete_consumer(self, stream_name, group_name, consumer_name):
+        """
+        Remove a consumer from a group. Returns how many entries were still
+        pending for it, which are dropped from the pending list.
+        """
+        return self.main.xgroup_delconsumer(stream_name, group_name, consumer_name)
 
     def x_group_delete(self, stream_name, group_name):
 
@@ -571,42 +1857,168 @@ class RedisConnection(object):
     def x_rev_range(self, log_name, min_ts="+", max_ts='-', count_items=1):
         return self.replica.xrevrange(log_name, min_ts, max_ts, count_items)
 
+    def x_trim(self, stream_name, maxlen, approximate=True):
+        return self.main.xtrim(stream_name, maxlen, approximate)
+
     def zset_add_increment(self,name, key):
         self.main.zadd(name, {key:1}, incr=True)
 
     def zset_add_index(self, name, idx, value):
         self.main.zadd(name, {idx:value})
 
+    def index_verses(self, translation, vids, batch_size=None, index=None):
+        """
+        Add BBCCCVVV verse ids to a translation's verse index, with one
+        variadic ZADD per batch sent in a single pipeline.
+        Returns the number of ids added.
+        """
+        index = index or verse_index_key(translation)
+        pipeline = self.main.pipeline(transaction=False)
+        for batch in batched(vids, batch_size or self.BATCH_SIZE):
+            pipeline.zadd(index, {"%08d" % vid: vid for vid in batch})
+        return sum(pipeline.execute())
+
+    def rebuild_verse_index(self, translation, batch_size=None):
+        """
+        Rebuild a translation's verse index from the verse keys it holds.
+        The new index is built aside and renamed over the old one, so queries
+        never see it half built.
+        Returns the number of verses indexed.
+        """
+        prefix = verse_key(translation, 0)[:-8]
+        index = verse_index_key(translation)
+        building = index + ":rebuild"
+        self.del_key(building)
+        vids = (int(key[len(prefix):]) for key in self.scan_keys(prefix + "*"))
+        count = self.index_verses(translation, vids, batch_size, building)
+        if count:
+            self.main.rename(building, index)
+        else:
+            self.del_key(index)
+        return count
+
     def zset_remove(self, name, values):
         self.main.zrem(name, values)
 
-    PRECISION = [1, 60, 300, 3600, 18000, 86400]       
+    PRECISION = COUNTER_PRECISION
 
     def update_counter(self, name, count=1, now=None):
-        now = now or time.time()                          
-        pipe = self.main.pipeline()                              
-        for prec in self.PRECISION:                              
-            pnow = int(now / prec) * prec                   
-            hash = '%s:%s'%(prec, name)                     
-            pipe.zadd('count:known:', {hash: 0})                    
-            pipe.hincrby('count:' + hash, pnow, count)      
+        pipe = self.main.pipeline()
+        pipeline_counters(pipe, {(name, now or time.time()): count})
         pipe.execute()
 
-def count(method):
-    def counted(*args, **kw):
-        result = method(*args, **kw)
-        #rc = RedisConnection()
-        #rc.update_counter("hits:%s" % method.__name__, 1)
-        return result
-    return counted
+    def get_counter_names(self, precision=None):
+        """
+        The names of the counters in count:known:, at one precision or at any.
+        """
+        names = set()
+        for known in self.replica.zrange(COUNTER_KNOWN, 0, -1):
+            if isinstance(known, bytes):
+                known = known.decode()
+            prec, _, name = known.partition(":")
+            if precision is None or int(prec) == precision:
+                names.add(name)
+        return sorted(names)
+
+    def get_counter(self, name, precision=60, since=None):
+        """
+        The (sample start time, count) samples of a counter at a precision,
+        oldest first, optionally only those starting at or after since.
+        """
+        samples = self.replica.hgetall("%s%s:%s" % (COUNTER_PREFIX, precision, name))
+        samples = sorted((int(pnow), int(count)) for pnow, count in samples.items())
+        if since is not None:
+            samples = [sample for sample in samples if sample[0] >= since]
+        return samples
 
-def timeit(method):
-    def method_timer(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-        runtime = round((te -ts)*1000,1)
-        
-        LOGGER.info("%s.%s took %s msec" % (method.__module__, method.__name__, int(runtime)))
-        return result
-    return method_timer
+    def clean_counters(self, samples=120, batch_size=None):
+        """
+        Drop all but the newest samples of every counter, and forget counters
+        left with none. Returns the number of samples dropped.
+        """
+        now = time.time()
+        dropped = 0
+        for batch in batched(self.main.zrange(COUNTER_KNOWN, 0, -1), batch_size or self.BATCH_SIZE):
+            pipeline = self.main.pipeline(transaction=False)
+            for known in batch:
+                pipeline.hkeys(COUNTER_PREFIX + (known.decode() if isinstance(known, bytes) else known))
+            deletes = self.main.pipeline(transaction=False)
+            for known, pnows in zip(batch, pipeline.execute()):
+                if isinstance(known, bytes):
+                    known = known.decode()
+                prec = int(known.partition(":")[0])
+                cutoff = int(now / prec) * prec - (samples - 1) * prec
+                old = [pnow for pnow in pnows if int(pnow) < cutoff]
+                if old:
+                    deletes.hdel(COUNTER_PREFIX + known, *old)
+                    dropped += len(old)
+                if len(old) == len(pnows):
+                    deletes.zrem(COUNTER_KNOWN, known)
+            deletes.execute()
+        return dropped
+
+    def enable_metrics(self, interval=METRICS_INTERVAL):
+        """
+        Count the calls, errors and latency of every RedisConnection method
+        in this process, flushed to the count:* counters on main every
+        interval seconds. See method_stats() to read them back.
+        """
+        global _metrics
+        self.disable_metrics()
+        _metrics = Metrics(self.main, interval).start()
+        return _metrics
+
+    def disable_metrics(self):
+        global _metrics
+        metrics, _metrics = _metrics, None
+        if metrics is not None:
+            metrics.stop()
+
+    def method_stats(self, precision=60, window=3600, methods=None):
+        """
+        Calls, errors and latency of each instrumented method over the last
+        window seconds, read from the counters of one precision on the
+        replicas, most total time first:
+            {method: {"calls", "errors", "total_ms", "mean_ms", "p50_ms", "p95_ms", "p99_ms"}}
+        Percentiles are the upper bound of the latency bucket they fall in.
+        """
+        since = int((time.time() - window) / precision) * precision
+        names = [name for name in self.get_counter_names(precision)
+            if name.startswith(("calls:", "errors:", "us:", "latency:"))]
+        if methods is not None:
+            methods = set(methods)
+            names = [name for name in names if name.split(":")[1] in methods]
+        pipeline = self.replica.pipeline(transaction=False)
+        for name in names:
+            pipeline.hgetall("%s%s:%s" % (COUNTER_PREFIX, precision, name))
+
+        stats = {}
+        for name, samples in zip(names, pipeline.execute()):
+            total = sum(int(count) for pnow, count in samples.items() if int(pnow) >= since)
+            kind, _, method = name.partition(":")
+            if kind == "latency":
+                method, _, bucket = method.rpartition(":")
+            entry = stats.setdefault(method, {"calls": 0, "errors": 0, "us": 0, "buckets": {}})
+            if kind == "latency":
+                entry["buckets"][bucket] = total
+            else:
+                entry[kind] = total
+
+        results = {}
+        for method, entry in stats.items():
+            if not entry["calls"]:
+                continue
+            timed = sum(entry["buckets"].values())
+            result = {"calls": entry["calls"], "errors": entry["errors"],
+                "total_ms": entry["us"] / 1000.0,
+                "mean_ms": entry["us"] / 1000.0 / timed if timed else None}
+            for percentile in (50, 95, 99):
+                result["p%d_ms" % percentile] = None
+                seen = 0
+                for label, bound in zip(LATENCY_LABELS, LATENCY_BUCKETS + [math.inf]):
+                    seen += entry["buckets"].get(label, 0)
+                    if timed and seen >= timed * percentile / 100.0:
+                        result["p%d_ms" % percentile] = bound
+                        break
+            results[method] = result
+        return dict(sorted(results.items(), key=lambda item: -item[1]["total_ms"]))
@@ -0,0 +1,392 @@
+"""
+A work queue on a redis stream.
+
+Producers put jobs, flat dicts of strings, on a StreamQueue, and a consumer
+group shares them out. A ConsumerPool runs consumer threads in one or more
+processes, and pools on any number of nodes can read the same group. Each
+consumer reads a batch of jobs with one XREADGROUP, runs the handler on each
+job and finishes the batch with one pipeline that acknowledges and deletes
+the entries, so the stream's length is the work still to do.
+
+    queue = StreamQueue("render", "renderers")
+    queue.create()
+    queue.put({"translation": "KJV", "book": "1"})
+    ConsumerPool(queue, render, consumers=2, processes=4).run()
+
+A job whose handler raises goes back on the stream with its _attempts
+counted, and after max_attempts onto <stream>:dead. A job whose consumer died
+is claimed with XAUTOCLAIM by another consumer once it has been pending for
+claim_idle_ms, and each delivery that died counts as an attempt too, so a job
+that keeps killing its consumer ends up on <stream>:dead as well. put() waits while the stream holds max_backlog jobs, and every
+XADD trims the stream to about maxlen entries as a last resort.
+Because finished entries are deleted, a stream should be read by one group.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+import redis
+
+from redis_client import LOGGER, batched, get_redis_connection
+from settings import CONFIG_DATA
+
+# Jobs a consumer reads, and acknowledges, at a time.
+BATCH_SIZE = CONFIG_DATA.get("STREAM_QUEUE_BATCH_SIZE", 16)
+# Consumer threads in each process of a ConsumerPool.
+CONSUMERS = CONFIG_DATA.get("STREAM_QUEUE_CONSUMERS", 4)
+# Milliseconds an XREADGROUP waits for jobs; a stopping consumer notices
+# within this.
+BLOCK_MS = 2000
+# Milliseconds a job may be pending before another consumer claims it. It
+# must be longer than a consumer takes over a whole batch.
+CLAIM_IDLE_MS = CONFIG_DATA.get("STREAM_QUEUE_CLAIM_IDLE_MS", 5 * 60 * 1000)
+# Jobs the stream may hold before put() waits.
+MAX_BACKLOG = CONFIG_DATA.get("STREAM_QUEUE_MAX_BACKLOG", 10000)
+# Entries XADD trims the stream to, well past MAX_BACKLOG.
+MAXLEN = CONFIG_DATA.get("STREAM_QUEUE_MAXLEN", 1000000)
+MAX_ATTEMPTS = 3
+ATTEMPTS = "_attempts"
+DEAD_SUFFIX = ":dead"
+# put() checks a full stream again after the first delay, doubling up to the last.
+BACKPRESSURE_MIN = 0.05
+BACKPRESSURE_MAX = 2
+
+class QueueFull(Exception):
+    """The stream held max_backlog jobs for longer than put() could wait."""
+
+class StreamQueue(object):
+    """
+    The producer and consumer side of a stream read by a consumer group.
+    """
+    def __init__(self, stream, group, rc=None, maxlen=MAXLEN, max_backlog=MAX_BACKLOG,
+            max_attempts=MAX_ATTEMPTS):
+        self.stream = stream
+        self.group = group
+        self.dead = stream + DEAD_SUFFIX
+        self.maxlen = maxlen
+        self.max_backlog = max_backlog
+        self.max_attempts = max_attempts
+        self._rc = rc
+
+    @property
+    def rc(self):
+        if self._rc is None:
+            self._rc = get_redis_connection()
+        return self._rc
+
+    def __getstate__(self):
+        # connections don't cross processes, each one gets its own
+        state = dict(self.__dict__)
+        state["_rc"] = None
+        return state
+
+    def create(self):
+        """
+        Create the stream and the consumer group, which reads every job
+        already on the stream. Returns False if the group exists.
+        """
+        return self.rc.x_group_create(self.stream, self.group, mkstream=True, id="0")
+
+    def backlog(self):
+        """
+        The jobs on the stream: waiting, or being worked on.
+        """
+        return self.rc.main.xlen(self.stream)
+
+    def put(self, job, block=True, timeout=None):
+        """
+        Add a job, returning its id. See put_many().
+        """
+        self.wait_for_room(1, block, None if timeout is None else time.monotonic() + timeout)
+        return self.rc.x_add(self.stream, job, maxlen=self.maxlen)
+
+    def put_many(self, jobs, block=True, timeout=None):
+        """
+        Add jobs with a pipeline of XADDs per batch, returning their ids.
+        While the stream holds max_backlog jobs this waits, for up to timeout
+        seconds if set.
+        :raises QueueFull: if the stream stayed full, or was full and block is False.
+        """
+        ids = []
+        end = None if timeout is None else time.monotonic() + timeout
+        batch_size = min(self.rc.BATCH_SIZE, self.max_backlog or self.rc.BATCH_SIZE)
+        for batch in batched(jobs, batch_size):
+            self.wait_for_room(len(batch), block, end)
+            pipeline = self.rc.main.pipeline(transaction=False)
+            for job in batch:
+                pipeline.xadd(self.stream, job, maxlen=self.maxlen, approximate=True)
+            ids.extend(pipeline.execute())
+        return ids
+
+    def wait_for_room(self, count, block=True, end=None):
+        if not self.max_backlog:
+            return
+        delay = BACKPRESSURE_MIN
+        while True:
+            backlog = self.backlog()
+            if backlog + count <= self.max_backlog:
+                return
+            remaining = None if end is None else end - time.monotonic()
+            if not block or (remaining is not None and remaining <= 0):
+                raise QueueFull("%s holds %d jobs, the most it may hold is %d" % (
+                    self.stream, backlog, self.max_backlog))
+            time.sleep(delay if remaining is None else min(delay, remaining))
+            delay = min(delay * 2, BACKPRESSURE_MAX)
+
+    def read(self, consumer, count=BATCH_SIZE, block_ms=BLOCK_MS):
+        """
+        Up to count new (id, job) entries for consumer, waiting up to block_ms
+        for the first.
+        """
+        reply = self.rc.x_read_group(self.group, consumer, {self.stream: ">"}, count, block_ms)
+        return [entry for _, entries in reply or [] for entry in entries]
+
+    def claim(self, consumer, min_idle_ms=CLAIM_IDLE_MS, start="0-0", count=BATCH_SIZE):
+        """
+        Claim up to count jobs pending for min_idle_ms for consumer. Returns
+        where to continue from ("0-0" once the pending list has been scanned)
+        and the (id, job) entries.
+        Every earlier delivery of a claimed entry ended without finish(), ie.
+        its consumer died on it, and counts as an attempt: an entry that has
+        had max_attempts goes onto the dead stream rather than being returned.
+        """
+        cursor, entries = self.rc.x_autoclaim(self.stream, self.group, consumer, min_idle_ms,
+            start, count)
+        if not entries:
+            return cursor, entries
+        deliveries = self.deliveries([id for id, _ in entries])
+        claimed, dead = [], []
+        for id, job in entries:
+            # the delivery this claim just made hasn't been attempted yet
+            attempts = int(job.get(ATTEMPTS, 0)) + deliveries.get(id, 1) - 1
+            if attempts >= self.max_attempts:
+                dead.append((id, dict(job, **{ATTEMPTS: attempts})))
+            else:
+                claimed.append((id, job))
+        self.finish((), dead=dead)
+        return cursor, claimed
+
+    def deliveries(self, ids):
+        """
+        How many times each of the pending ids has been delivered, by id.
+        """
+        pipeline = self.rc.main.pipeline(transaction=False)
+        for id in ids:
+            pipeline.xpending_range(self.stream, self.group, id, id, 1)
+        return {pending["message_id"]: pending["times_delivered"]
+            for reply in pipeline.execute() for pending in reply}
+
+    def finish(self, done, failed=(), returned=(), dead=()):
+        """
+        Acknowledge and delete a batch of entries in one transaction:
+        done ids have finished; failed (id, job) entries go back on the
+        stream with an attempt counted, or onto the dead stream after
+        max_attempts; returned (id, job) entries, which a stopping consumer
+        didn't get to, go back on the stream as they were; dead (id, job)
+        entries, already out of attempts, go onto the dead stream.
+        """
+        ids = (list(done) + [id for id, _ in failed] + [id for id, _ in returned]
+            + [id for id, _ in dead])
+        if not ids:
+            return
+        pipeline = self.rc.main.pipeline(transaction=True)
+        for id, job in dead:
+            LOGGER.error("Job %s of %s failed or lost its consumer %s times, moved to %s",
+                id, self.stream, job[ATTEMPTS], self.dead)
+            pipeline.xadd(self.dead, job, maxlen=self.maxlen, approximate=True)
+        for id, job in failed:
+            job = dict(job)
+            job[ATTEMPTS] = int(job.get(ATTEMPTS, 0)) + 1
+            if job[ATTEMPTS] >= self.max_attempts:
+                LOGGER.error("Job %s of %s failed %d times, moved to %s",
+                    id, self.stream, job[ATTEMPTS], self.dead)
+            pipeline.xadd(self.dead if job[ATTEMPTS] >= self.max_attempts else self.stream,
+                job, maxlen=self.maxlen, approximate=True)
+        for id, job in returned:
+            pipeline.xadd(self.stream, job, maxlen=self.maxlen, approximate=True)
+        pipeline.xack(self.stream, self.group, *ids)
+        pipeline.xdel(self.stream, *ids)
+        pipeline.execute()
+
+    def info(self):
+        """
+        The backlog, pending, consumer and dead job figures of the queue.
+        """
+        pending = self.rc.main.xpending(self.stream, self.group)
+        return {"backlog": self.backlog(),
+            "pending": pending["pending"],
+            "consumers": {consumer["name"]: consumer["pending"] for consumer in pending["consumers"]},
+            "dead": self.rc.main.xlen(self.dead)}
+
+class ConsumerPool(object):
+    """
+    Consumer threads, in one or more processes, running handler(id, job) on
+    the jobs of a StreamQueue until stopped. Stopping is graceful: each
+    consumer finishes the job it is on, returns the rest of its batch to the
+    stream and leaves the group.
+    """
+    def __init__(self, queue, handler, consumers=CONSUMERS, processes=1, batch_size=BATCH_SIZE,
+            block_ms=BLOCK_MS, claim_idle_ms=CLAIM_IDLE_MS):
+        self.queue = queue
+        self.handler = handler
+        self.consumers = consumers
+        self.processes = processes
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.stopping = threading.Event()
+        self.threads = []
+        self.workers = []
+        # shared with the pool's processes, so stats() covers all of them
+        self.counts = {name: multiprocessing.Value("q", 0) for name in ("done", "failed", "claimed")}
+
+    def start(self):
+        """
+        Start the consumer threads, or with several processes, the processes.
+        """
+        if self.processes > 1:
+            for _ in range(self.processes):
+                worker = multiprocessing.Process(target=run_consumers, args=(self.queue, self.handler,
+                    self.consumers, self.batch_size, self.block_ms, self.claim_idle_ms, self.counts))
+                worker.start()
+                self.workers.append(worker)
+            return self
+        prefix = "%s-%d" % (socket.gethostname(), os.getpid())
+        for i in range(self.consumers):
+            thread = threading.Thread(target=self.consume, args=("%s-%d" % (prefix, i),),
+                name="%s-%d" % (self.queue.stream, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, *args):
+        """
+        Ask the consumers to stop. Usable as a signal handler.
+        """
+        self.stopping.set()
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    def join(self):
+        # joined with a timeout so the main thread still handles signals
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        for worker in self.workers:
+            while worker.is_alive():
+                worker.join(0.5)
+
+    def run(self):
+        """
+        Consume until SIGINT or SIGTERM, or stop() from another thread.
+        """
+        previous = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.start()
+            self.join()
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+        return self.stats()
+
+    def stats(self):
+        """
+        The jobs done, failed and claimed by every consumer of the pool.
+        """
+        return {name: value.value for name, value in self.counts.items()}
+
+    def count(self, name, amount):
+        if amount:
+            with self.counts[name].get_lock():
+                self.counts[name].value += amount
+
+    def consume(self, consumer):
+        queue = self.queue
+        cursor = "0-0"
+        next_claim = 0
+        try:
+            while not self.stopping.is_set():
+                try:
+                    jobs = []
+                    if self.claim_idle_ms and time.monotonic() >= next_claim:
+                        cursor, jobs = queue.claim(consumer, self.claim_idle_ms, cursor, self.batch_size)
+                        self.count("claimed", len(jobs))
+                        if cursor in ("0-0", b"0-0") and not jobs:
+                            next_claim = time.monotonic() + self.claim_idle_ms / 4000.0
+                    if not jobs:
+                        jobs = queue.read(consumer, self.batch_size, self.block_ms)
+                    if jobs:
+                        self.run_batch(jobs)
+                except redis.exceptions.RedisError as err:
+                    LOGGER.warning("Consumer %s of %s failed, retrying: %s", consumer, queue.stream, err)
+                    self.stopping.wait(1)
+                except Exception as err:
+                    LOGGER.error("Consumer %s of %s failed, retrying: %s", consumer, queue.stream, err,
+                        exc_info=True)
+                    self.stopping.wait(1)
+        finally:
+            self.leave(consumer)
+
+    def run_batch(self, jobs):
+        done, failed = [], []
+        for i, (id, job) in enumerate(jobs):
+            if self.stopping.is_set():
+                self.queue.finish(done, failed, jobs[i:])
+                break
+            try:
+                self.handler(id, job)
+            except Exception as err:
+                LOGGER.error("Job %s of %s failed: %s", id, self.queue.stream, err, exc_info=True)
+                failed.append((id, job))
+            else:
+                done.append(id)
+        else:
+            self.queue.finish(done, failed)
+        self.count("done", len(done))
+        self.count("failed", len(failed))
+
+    def leave(self, consumer):
+        """
+        Remove a stopped consumer from the group, unless jobs are still
+        pending for it, which another consumer will claim.
+        """
+        try:
+            main = self.queue.rc.main
+            if not main.xpending_range(self.queue.stream, self.queue.group, "-", "+", 1, consumer):
+                self.queue.rc.x_group_delete_consumer(self.queue.stream, self.queue.group, consumer)
+        except redis.exceptions.RedisError as err:
+            LOGGER.warning("Consumer %s could not leave %s: %s", consumer, self.queue.group, err)
+
+def run_consumers(queue, handler, consumers, batch_size, block_ms, claim_idle_ms, counts=None):
+    """
+    Run a single process ConsumerPool, ie. in one of a pool's processes,
+    adding to the pool's counts.
+    """
+    pool = ConsumerPool(queue, handler, consumers, 1, batch_size, block_ms, claim_idle_ms)
+    if counts is not None:
+        pool.counts = counts
+    pool.run()
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Create a stream work queue or show how it is doing")
+    p.add_argument("stream", help="The stream the jobs are on")
+    p.add_argument("group", help="The consumer group working on them")
+    p.add_argument(
+        "--create", help="Create the stream and group if they don't exist",
+        action="store_true",
+    )
+    args = p.parse_args()
+    queue = StreamQueue(args.stream, args.group)
+    if args.create:
+        print("Created" if queue.create() else "Already exists", queue.stream, queue.group)
+    for name, value in queue.info().items():
+        print("%s: %s" % (name, value))
+
+if __name__ == "__main__":
+    main()